@@ -6,9 +6,12 @@ import sys
 import logging
 
 from models import db, User
+from schema import ensure_schema
 from forms import LoginForm
 from routes.main import main_bp
 from routes.admin import admin_bp
+from routes.telegram import telegram_bp
+from commands import register_commands
 import config
 
 # Configure logging
@@ -35,12 +38,17 @@ def create_app(config_class=config.Config):
     # Register blueprints
     app.register_blueprint(main_bp)
     app.register_blueprint(admin_bp, url_prefix='/admin')
+    app.register_blueprint(telegram_bp, url_prefix='/telegram')
+
+    # Register CLI commands
+    register_commands(app)
 
     # Create database tables and admin user
     with app.app_context():
         try:
             # TEMPORARY: Just create the tables directly
-            db.create_all()
+            # (plus any columns/indexes added to existing tables since)
+            ensure_schema()
 
             # Check and create admin user
             admin_user = User.query.filter_by(username='admin').first()
@@ -0,0 +1,186 @@
+import logging
+
+import numpy as np
+
+from models import IPHONE_MODELS
+from exports import iter_preferences
+from matching import NEAR_GOOD_DEAL_MARGIN, Subscriber, normalize_location, active_preferences_query
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# notification_mode -> code in BatchMatcher.mode_codes (-1 for unknown modes, which never match)
+MODE_CODES = {'all': 0, 'only_preferred': 1, 'near_good_deal': 2, 'good_deal': 3}
+
+def collect_product_cells(row, products, models, cells):
+    """Record the (is_preferred, max_price) that counts for each model of one preference.
+
+    models maps product_name -> column and grows for unknown names. A
+    preferred entry beats a non-preferred one, then the higher price wins,
+    as in MatchIndex.
+    """
+    for product in products:
+        column = models.setdefault(product.product_name, len(models))
+        value = (bool(product.is_preferred), product.max_price)
+        if (row, column) not in cells or value > cells[(row, column)]:
+            cells[(row, column)] = value
+
+def product_matrices(cells, rows, columns):
+    """Turn collected cells into (max_prices, preferred) matrices of shape (rows, columns)"""
+    max_prices = np.zeros((rows, columns), dtype=np.int64)
+    preferred = np.zeros((rows, columns), dtype=bool)
+    if cells:
+        row_index, column_index = np.array(list(cells.keys())).T
+        values = list(cells.values())
+        preferred[row_index, column_index] = [is_preferred for is_preferred, _ in values]
+        max_prices[row_index, column_index] = [max_price for _, max_price in values]
+    return max_prices, preferred
+
+class BatchMatcher:
+    """Vectorized counterpart of matching.MatchIndex for bursts of listings.
+
+    Active preferences are packed into dense arrays: a subscribers x models
+    max_price matrix, a matching preferred mask and a mode code vector, with
+    rows grouped by location. These combine into one matrix of the highest
+    price each subscriber accepts per model (-inf where they never match).
+
+    Each (location, model) column is kept sorted, so the subscribers matching
+    a listing are a suffix of it. The columns are laid end to end in one key
+    array, each in its own key range, and a whole batch of listings is
+    resolved with a single np.searchsorted. Recipient lists are identical to
+    MatchIndex.match() for the same listing, including their order.
+    """
+
+    def __init__(self, subscribers, location_codes, mode_codes, max_prices, preferred, locations, models):
+        # Rows sorted by location (stable, so each location stays in preference id order)
+        order = np.argsort(location_codes, kind='stable')
+        self.subscribers = [subscribers[row] for row in order]
+        self.location_codes = location_codes[order]     # (subscribers,) int
+        self.mode_codes = mode_codes[order]             # (subscribers,) int
+        self.max_prices = max_prices[order]             # (subscribers, models) int
+        self.preferred = preferred[order]               # (subscribers, models) bool
+        self.locations = locations                      # normalized location -> code
+        self.models = models                            # product_name -> column
+
+        modes = self.mode_codes[:, None]
+        self.thresholds = np.select(
+            [self.preferred & (modes == MODE_CODES['only_preferred']),
+             self.preferred & (modes == MODE_CODES['near_good_deal']),
+             self.preferred & (modes == MODE_CODES['good_deal'])],
+            [np.inf, self.max_prices + NEAR_GOOD_DEAL_MARGIN, self.max_prices],
+            default=-np.inf
+        ).astype(np.float64)
+
+        # Location code -> (first row, end row) and its 'all' subscribers
+        codes = np.arange(len(locations))
+        starts = np.searchsorted(self.location_codes, codes, side='left')
+        ends = np.searchsorted(self.location_codes, codes, side='right')
+        self._bounds = dict(zip(codes.tolist(), zip(starts.tolist(), ends.tolist())))
+        self._everything = {
+            code: [self.subscribers[row] for row in range(start, end)
+                   if self.mode_codes[row] == MODE_CODES['all']]
+            for code, (start, end) in self._bounds.items()
+        }
+        self._columns = {
+            (code, column): self._sorted_column(code, column)
+            for code in self._bounds for column in range(len(models))
+        }
+
+        # Threshold t of segment k is stored as the key k * span + (t - low), with inf at
+        # span - 1, so every column sorts after the one before it and prices clip into range.
+        # A sentinel key closes each segment, so a search result identifies (segment, suffix) alone.
+        finite = self.thresholds[np.isfinite(self.thresholds)]
+        self._low = float(finite.min()) if finite.size else 0.0
+        self._span = (float(finite.max()) - self._low if finite.size else 0.0) + 2
+        self._segments = {}     # (location code, column) -> (base key, first position in _keys, everyone, subscribers)
+        keys = []
+        first = 0
+        for (code, column), (thresholds, subscribers) in self._columns.items():
+            if not subscribers:
+                continue
+            base = len(self._segments) * self._span
+            self._segments[(code, column)] = (base, first, self._everything[code], subscribers)
+            keys.append(base + np.minimum(thresholds - self._low, self._span - 1))
+            keys.append([base + self._span - 0.5])
+            first += len(subscribers) + 1
+        self._keys = np.concatenate(keys) if keys else np.zeros(0)
+
+    @property
+    def subscriber_count(self):
+        return len(self.subscribers)
+
+    @classmethod
+    def build(cls, preferences):
+        """Pack preferences (ordered by id, with their products loaded) into arrays"""
+        subscribers = []
+        locations = {}
+        location_codes = []
+        mode_codes = []
+        models = {name: column for column, name in enumerate(IPHONE_MODELS)}
+        cells = {}  # (row, column) -> (is_preferred, max_price)
+
+        for row, pref in enumerate(preferences):
+            subscribers.append(Subscriber.from_preference(pref))
+            location_codes.append(locations.setdefault(normalize_location(pref.location), len(locations)))
+            mode_codes.append(MODE_CODES.get(pref.notification_mode, -1))
+            collect_product_cells(row, pref.products, models, cells)
+
+        max_prices, preferred = product_matrices(cells, len(subscribers), len(models))
+        return cls(subscribers, np.array(location_codes, dtype=np.int64), np.array(mode_codes, dtype=np.int64),
+                   max_prices, preferred, locations, models)
+
+    def _sorted_column(self, location_code, column):
+        """Matchable subscribers of one location for one model, sorted by (threshold, preference id)"""
+        start, end = self._bounds[location_code]
+        thresholds = self.thresholds[start:end, column]
+        rows = np.flatnonzero(thresholds > -np.inf)
+        rows = rows[np.lexsort((rows, thresholds[rows]))]
+        return thresholds[rows], [self.subscribers[start + row] for row in rows.tolist()]
+
+    def match_batch(self, listings):
+        """Return one recipient list per (product_name, price, location) listing"""
+        location_codes = {}     # raw location -> code, so each distinct spelling is normalized once
+        results = [None] * len(listings)
+        # Listings that reach a sorted column, in parallel lists: per-listing tuples kept
+        # alive until the end would make the garbage collector rescan the results
+        hit_positions = []
+        hit_segments = []
+        prices = []
+        bases = []
+
+        for position, (product_name, price, location) in enumerate(listings):
+            location_code = location_codes.get(location)
+            if location_code is None:
+                location_code = location_codes[location] = self.locations.get(normalize_location(location), -1)
+            if location_code < 0:
+                results[position] = []
+                continue
+            segment = self._segments.get((location_code, self.models.get(product_name)))
+            if segment is None:
+                # Unknown models, and models nobody here prices, only reach 'all' subscribers
+                results[position] = list(self._everything[location_code])
+                continue
+            hit_positions.append(position)
+            hit_segments.append(segment)
+            prices.append(price)
+            bases.append(segment[0])
+
+        if hit_positions:
+            keys = np.clip(np.array(prices, dtype=np.float64) - self._low, 0, self._span - 1) + bases
+            found = np.searchsorted(self._keys, keys, side='left').tolist()
+            # Listings that match the same suffix share its recipients; each still gets a list of its own
+            built = {}
+            for position, (_, first, everyone, subscribers), index in zip(hit_positions, hit_segments, found):
+                recipients = built.get(index)
+                if recipients is None:
+                    results[position] = built[index] = everyone + subscribers[index - first:]
+                else:
+                    results[position] = list(recipients)
+
+        return results
+
+def load_batch_matcher(batch_size, today=None):
+    """Build a BatchMatcher from the database, batch_size preferences at a time"""
+    matcher = BatchMatcher.build(iter_preferences(active_preferences_query(today), batch_size))
+    logger.info(f"Built batch matcher for {matcher.subscriber_count} subscribers x {len(matcher.models)} models")
+    return matcher
@@ -0,0 +1,79 @@
+import re
+from functools import lru_cache
+
+from models import IPHONE_MODELS, DEFAULT_EXCLUDED_WORDS
+
+# Letters (plus the @ and $ of spellings like 'C@$h') and digits form separate
+# tokens, so 'iPhone15 Pro' and 'iPhone 15 Pro' tokenize the same way
+TOKEN_PATTERN = re.compile(r'[a-z@$]+|[0-9]+')
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class TitleClassifier:
+    """Maps listing titles to an IPHONE_MODELS name in a single pass over their tokens.
+
+    Model names and excluded words are compiled once into a token trie. At
+    every token the trie is walked as far as the title allows; the longest
+    model match wins ('iPhone 15 Pro Max' over 'iPhone 15 Pro' over
+    'iPhone 15'), with ties going to the earliest one. A title containing
+    any excluded word is rejected outright.
+    """
+
+    _MODEL = 'model'
+    _EXCLUDED = 'excluded'
+
+    def __init__(self, models, excluded_words=()):
+        self._root = {}
+        for excluded_word in excluded_words:
+            self._add(tokenize(excluded_word), (self._EXCLUDED, excluded_word))
+        for model in models:
+            self._add(tokenize(model), (self._MODEL, model))
+
+    def _add(self, tokens, terminal):
+        if not tokens:
+            return
+        node = self._root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        # Terminals are stored under None, which can never be a token; the first one added wins
+        node.setdefault(None, terminal)
+
+    def scan(self, title):
+        """Return (model, excluded_word); model is None when nothing matched or the title was rejected"""
+        return self.scan_tokens(tokenize(title))
+
+    def scan_tokens(self, tokens):
+        """scan() for an already tokenized title, so one tokenization can serve several classifiers"""
+        root = self._root
+        best_model = None
+        best_length = 0
+
+        for start in range(len(tokens)):
+            node = root.get(tokens[start])
+            position = start
+            while node is not None:
+                terminal = node.get(None)
+                if terminal is not None:
+                    kind, value = terminal
+                    if kind == self._EXCLUDED:
+                        return None, value
+                    length = position - start + 1
+                    if length > best_length:
+                        best_model = value
+                        best_length = length
+                position += 1
+                if position == len(tokens):
+                    break
+                node = node.get(tokens[position])
+
+        return best_model, None
+
+    def classify(self, title):
+        """Return the IPHONE_MODELS name a listing title refers to, or None"""
+        return self.scan(title)[0]
+
+@lru_cache(maxsize=1)
+def default_classifier():
+    """Classifier for IPHONE_MODELS with DEFAULT_EXCLUDED_WORDS, compiled on first use"""
+    return TitleClassifier(IPHONE_MODELS, DEFAULT_EXCLUDED_WORDS)
@@ -0,0 +1,366 @@
+import gc
+import io
+import os
+import json
+import time
+import random
+import asyncio
+import secrets
+import zipfile
+
+import click
+import requests
+
+from models import Preference, IPHONE_MODELS, DEFAULT_EXCLUDED_WORDS, backfill_geo
+from config import Config
+from parallel_export import stream_parallel_export_zip, warm_export_pool
+from exports import stream_export_zip, iter_preferences
+from matching import load_match_index, load_geo_index, active_preferences_query, IdMatchIndex
+from batch_matching import load_batch_matcher
+from sharded_matching import ShardedMatcher, match_ids, split_ids
+from classifier import tokenize, default_classifier
+from word_filters import load_word_filters
+from subscriber_index import write_subscriber_index, MappedSubscriberIndex
+from notifier import NotificationDispatcher, BotApiTransport, FakeBotApi, StubTransport
+from webhook_bot import get_webhook_bot
+
+def _timed_export(chunks):
+    """Drain an export generator, returning (seconds, zip bytes)"""
+    output = io.BytesIO()
+    start = time.perf_counter()
+    for chunk in chunks:
+        output.write(chunk)
+    return time.perf_counter() - start, output.getvalue()
+
+def _best_time(function, repeat):
+    """Run function repeat times, returning (fastest seconds, last result).
+
+    Each run starts from a fresh garbage collection, so a collection the
+    previous run left pending isn't charged to the next one.
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+def _synthetic_titles(count, rng):
+    """Marketplace-style listing titles: mostly iPhones, some with excluded words, some other phones"""
+    storage = ['64GB', '128GB', '256GB', '512GB', '1TB', '']
+    colours = ['Black', 'White', 'Blue', 'Natural Titanium', 'Midnight', 'Starlight', '']
+    extras = ['Unlocked', 'Excellent condition', 'Like new', 'with box', 'Battery 89%', 'Pickup only', '']
+    others = ['Samsung Galaxy S24 Ultra', 'Google Pixel 8 Pro', 'iPad Air 5th gen', 'Apple Watch Series 9']
+
+    titles = []
+    for _ in range(count):
+        roll = rng.random()
+        product = rng.choice(others) if roll < 0.1 else rng.choice(IPHONE_MODELS)
+        if rng.random() < 0.2:
+            product = product.replace('iPhone ', 'iPhone')
+        words = [product, rng.choice(storage), rng.choice(colours), rng.choice(extras)]
+        if roll > 0.8:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(DEFAULT_EXCLUDED_WORDS))
+        titles.append(' '.join(word for word in words if word))
+    return titles
+
+def _read_updates(path):
+    """Telegram Update dicts from a file holding one Update, a JSON array of them, or JSON Lines"""
+    with open(path, encoding='utf-8') as update_file:
+        text = update_file.read()
+    try:
+        updates = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return updates if isinstance(updates, list) else [updates]
+
+def _naive_classify(title, models, excluded_words):
+    """Reference classifier: one substring check per excluded word and per model, longest model first"""
+    text = f" {' '.join(tokenize(title))} "
+    if any(f' {word} ' in text for word in excluded_words):
+        return None
+    for model, pattern in models:
+        if f' {pattern} ' in text:
+            return model
+    return None
+
+def register_commands(app):
+    """Register the maintenance and benchmark commands on the Flask CLI"""
+
+    @app.cli.command('benchmark-export')
+    @click.option('--workers', default=os.cpu_count() or 2, show_default=True, help='Processes for the sharded export.')
+    @click.option('--shard-size', default=Config.EXPORT_SHARD_SIZE, show_default=True, help='Preferences per shard.')
+    def benchmark_export(workers, shard_size):
+        """Compare the serial and the sharded full export on the current database."""
+        users = Preference.query.count()
+        click.echo(f"Exporting {users} preferences")
+
+        serial_seconds, serial_zip = _timed_export(stream_export_zip(Preference.query, Config.EXPORT_BATCH_SIZE))
+        click.echo(f"serial:              {serial_seconds:8.2f}s  {len(serial_zip)} bytes")
+
+        # Exports share a pool that stays up, so its start-up is paid once per web worker, not per export
+        start = time.perf_counter()
+        warm_export_pool(workers)
+        click.echo(f"pool start:          {time.perf_counter() - start:8.2f}s")
+
+        parallel_seconds, parallel_zip = _timed_export(stream_parallel_export_zip(shard_size, workers))
+        click.echo(f"sharded ({workers} workers): {parallel_seconds:8.2f}s  {len(parallel_zip)} bytes")
+
+        # Both paths must produce the same files
+        serial_files = zipfile.ZipFile(io.BytesIO(serial_zip))
+        parallel_files = zipfile.ZipFile(io.BytesIO(parallel_zip))
+        mismatched = [name for name in serial_files.namelist()
+                      if serial_files.read(name) != parallel_files.read(name)]
+        if mismatched:
+            raise click.ClickException(f"Exports differ in: {', '.join(mismatched)}")
+
+        click.echo(f"speedup: {serial_seconds / parallel_seconds:.2f}x (contents identical)")
+        chosen = 'sharded' if workers > 1 and users >= Config.EXPORT_PARALLEL_MIN_ROWS else 'serial'
+        click.echo(f"full exports of this size run {chosen} (EXPORT_PARALLEL_MIN_ROWS={Config.EXPORT_PARALLEL_MIN_ROWS})")
+
+    @app.cli.command('match-listing')
+    @click.argument('product_name')
+    @click.argument('price', type=int)
+    @click.argument('location')
+    @click.option('--title', help="Listing title, checked against each subscriber's keywords and excluded words.")
+    def match_listing(product_name, price, location, title):
+        """List the subscribers who would be notified about a listing."""
+        start = time.perf_counter()
+        index = load_match_index(Config.EXPORT_BATCH_SIZE)
+        word_filters = load_word_filters()
+        click.echo(f"Indexed {index.subscriber_count} subscribers in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        recipients = index.match(product_name, price, location)
+        if title:
+            recipients = word_filters.filter_recipients(title, recipients)
+        click.echo(f"{len(recipients)} recipients in {(time.perf_counter() - start) * 1000:.3f}ms")
+        for subscriber in recipients:
+            click.echo(f"  {subscriber.unique_userid}\t{subscriber.notification_mode}")
+
+    @app.cli.command('benchmark-matching')
+    @click.option('--listings', default=500, show_default=True, help='Random listings in the burst.')
+    @click.option('--seed', default=0, show_default=True, help='Random seed for the listings.')
+    @click.option('--repeat', default=5, show_default=True, help='Runs of each matcher; the fastest counts.')
+    def benchmark_matching(listings, seed, repeat):
+        """Compare one-by-one and batched matching of a burst of random listings."""
+        index = load_match_index(Config.EXPORT_BATCH_SIZE)
+        matcher = load_batch_matcher(Config.EXPORT_BATCH_SIZE)
+        click.echo(f"Matching {listings} listings against {index.subscriber_count} subscribers")
+
+        rng = random.Random(seed)
+        locations = sorted(matcher.locations) or ['']
+        burst = [(rng.choice(IPHONE_MODELS), rng.randint(100, 1500), rng.choice(locations)) for _ in range(listings)]
+
+        scalar_seconds, scalar_results = _best_time(lambda: [index.match(*listing) for listing in burst], repeat)
+        click.echo(f"scalar:  {scalar_seconds:8.3f}s")
+
+        batch_seconds, batch_results = _best_time(lambda: matcher.match_batch(burst), repeat)
+        click.echo(f"batched: {batch_seconds:8.3f}s")
+
+        # Both paths must notify the same subscribers in the same order
+        for listing, scalar, batch in zip(burst, scalar_results, batch_results):
+            if [s.preference_id for s in scalar] != [s.preference_id for s in batch]:
+                raise click.ClickException(f"Results differ for listing {listing}")
+
+        recipients = sum(len(result) for result in batch_results)
+        click.echo(f"speedup: {scalar_seconds / batch_seconds:.2f}x ({recipients} recipients, results identical)")
+
+    @app.cli.command('benchmark-classifier')
+    @click.option('--titles', default=100000, show_default=True, help='Synthetic listing titles to classify.')
+    @click.option('--seed', default=0, show_default=True, help='Random seed for the titles.')
+    def benchmark_classifier(titles, seed):
+        """Compare the token-trie title classifier with per-model substring checks."""
+        corpus = _synthetic_titles(titles, random.Random(seed))
+
+        models = sorted(((model, ' '.join(tokenize(model))) for model in IPHONE_MODELS),
+                        key=lambda item: len(item[1]), reverse=True)
+        excluded_words = [' '.join(tokenize(word)) for word in DEFAULT_EXCLUDED_WORDS]
+        start = time.perf_counter()
+        naive_results = [_naive_classify(title, models, excluded_words) for title in corpus]
+        naive_seconds = time.perf_counter() - start
+        click.echo(f"substring checks: {naive_seconds:8.3f}s  {titles / naive_seconds:12,.0f} titles/s")
+
+        classifier = default_classifier()
+        start = time.perf_counter()
+        trie_results = [classifier.classify(title) for title in corpus]
+        trie_seconds = time.perf_counter() - start
+        click.echo(f"token trie:       {trie_seconds:8.3f}s  {titles / trie_seconds:12,.0f} titles/s")
+
+        mismatched = [title for title, naive, trie in zip(corpus, naive_results, trie_results) if naive != trie]
+        if mismatched:
+            raise click.ClickException(f"{len(mismatched)} titles classified differently, e.g. {mismatched[0]!r}")
+
+        matched = sum(result is not None for result in trie_results)
+        click.echo(f"speedup: {naive_seconds / trie_seconds:.2f}x ({matched} of {titles} titles matched a model)")
+
+    @app.cli.command('backfill-geo')
+    @click.option('--all', 'recompute_all', is_flag=True, help='Recompute every row, e.g. after changing the grid size.')
+    @click.option('--batch-size', default=Config.IMPORT_BATCH_SIZE, show_default=True, help='Rows updated per commit.')
+    def backfill_coordinates(recompute_all, batch_size):
+        """Fill latitude/longitude/geo_cell from fixed_lat/fixed_lon, or geocode location/suburb."""
+        updated = backfill_geo(batch_size, recompute_all)
+        click.echo(f"Backfilled coordinates for {updated} preferences")
+
+    @app.cli.command('nearby')
+    @click.argument('lat', type=float)
+    @click.argument('lon', type=float)
+    @click.argument('radius_km', type=float)
+    def nearby(lat, lon, radius_km):
+        """List the active subscribers within RADIUS_KM of a point."""
+        index = load_geo_index(Config.EXPORT_BATCH_SIZE)
+
+        start = time.perf_counter()
+        found = index.within(lat, lon, radius_km)
+        click.echo(f"{len(found)} of {index.size} subscribers in {(time.perf_counter() - start) * 1000:.3f}ms")
+        for distance, subscriber in found:
+            click.echo(f"  {distance:8.2f} km  {subscriber.unique_userid}")
+
+    @app.cli.command('benchmark-sharded-matching')
+    @click.option('--workers', default=os.cpu_count() or 2, show_default=True, help='Shard processes.')
+    @click.option('--listings', default=20000, show_default=True, help='Random listings in the burst.')
+    @click.option('--seed', default=0, show_default=True, help='Random seed for the listings.')
+    @click.option('--repeat', default=5, show_default=True, help='Runs of each matcher; the fastest counts.')
+    @click.option('--index-path', help='Start the shards from this subscriber index file instead of the database.')
+    def benchmark_sharded_matching(workers, listings, seed, repeat, index_path):
+        """Compare in-process matching with matching sharded by location over worker processes."""
+        index = load_match_index(Config.EXPORT_BATCH_SIZE)
+        with ShardedMatcher(workers, index_path=index_path) as sharded:
+            locations = sharded.locations or ['']
+            rng = random.Random(seed)
+            burst = [(rng.choice(IPHONE_MODELS), rng.randint(100, 1500), rng.choice(locations))
+                     for _ in range(listings)]
+            click.echo(f"Matching {listings} listings against {index.subscriber_count} subscribers "
+                       f"in {len(locations)} locations")
+
+            # Both sides run the same IdMatchIndex matching, so the ratio is the sharding alone
+            single_index = IdMatchIndex(index)
+            single_seconds, single_results = _best_time(
+                lambda: split_ids(*match_ids(single_index, burst)), repeat
+            )
+            click.echo(f"single process:        {single_seconds:8.3f}s")
+
+            sharded_seconds, sharded_results = _best_time(lambda: sharded.match_batch(burst), repeat)
+            click.echo(f"sharded ({sharded.shard_count} processes): {sharded_seconds:8.3f}s")
+
+        expected = [[subscriber.preference_id for subscriber in index.match(*listing)] for listing in burst]
+        if [list(ids) for ids in single_results] != expected or [list(ids) for ids in sharded_results] != expected:
+            raise click.ClickException("Sharded results differ from the single-process index")
+        click.echo(f"speedup: {single_seconds / sharded_seconds:.2f}x on {os.cpu_count()} CPUs (results identical)")
+
+    @app.cli.command('write-subscriber-index')
+    @click.option('--path', default=Config.SUBSCRIBER_INDEX_PATH, show_default=True, help='Index file to write.')
+    def write_index(path):
+        """Write the active subscribers to a memory-mappable index file for matcher workers."""
+        start = time.perf_counter()
+        count = write_subscriber_index(path, iter_preferences(active_preferences_query(), Config.EXPORT_BATCH_SIZE))
+        click.echo(f"Wrote {count} subscribers ({os.path.getsize(path)} bytes) to {path} "
+                   f"in {time.perf_counter() - start:.2f}s")
+
+    @app.cli.command('benchmark-subscriber-index')
+    @click.option('--path', default=Config.SUBSCRIBER_INDEX_PATH, show_default=True, help='Index file to read.')
+    @click.option('--listings', default=2000, show_default=True, help='Random listings to compare.')
+    @click.option('--seed', default=0, show_default=True, help='Random seed for the listings.')
+    def benchmark_subscriber_index(path, listings, seed):
+        """Compare matcher startup from the database with mapping the subscriber index file."""
+        start = time.perf_counter()
+        index = load_match_index(Config.EXPORT_BATCH_SIZE)
+        load_seconds = time.perf_counter() - start
+        click.echo(f"database load: {load_seconds * 1000:10.1f}ms  {index.subscriber_count} subscribers")
+
+        start = time.perf_counter()
+        mapped = MappedSubscriberIndex.open(path)
+        open_seconds = time.perf_counter() - start
+        click.echo(f"mapped open:   {open_seconds * 1000:10.1f}ms  {mapped.subscriber_count} subscribers")
+
+        rng = random.Random(seed)
+        locations = sorted(mapped.locations) or ['']
+        burst = [(rng.choice(IPHONE_MODELS), rng.randint(100, 1500), rng.choice(locations)) for _ in range(listings)]
+        for listing in burst:
+            expected = [subscriber.preference_id for subscriber in index.match(*listing)]
+            if mapped.match_ids(*listing) != expected:
+                raise click.ClickException(f"Results differ for listing {listing}; rewrite the index if it is stale")
+        click.echo(f"startup speedup: {load_seconds / open_seconds:.0f}x ({listings} listings, results identical)")
+
+    @app.cli.command('benchmark-notifier')
+    @click.option('--messages', default=600, show_default=True, help='Messages to send.')
+    @click.option('--chats', default=100, show_default=True, help='Distinct chats they are spread over.')
+    @click.option('--latency', default=0.05, show_default=True, help='Seconds the fake Bot API takes per request.')
+    def benchmark_notifier(messages, chats, latency):
+        """Send messages through the dispatcher to a local fake Bot API that enforces Telegram's limits."""
+        rng = random.Random(0)
+        jobs = [(str(100000 + rng.randrange(chats)), f"Test message {number}") for number in range(messages)]
+        with FakeBotApi(Config.NOTIFY_GLOBAL_RATE, Config.NOTIFY_CHAT_RATE, latency=latency) as api:
+            transport = BotApiTransport('TEST', api.url)
+            start = time.perf_counter()
+            try:
+                stats = asyncio.run(NotificationDispatcher(transport).dispatch(jobs))
+            finally:
+                transport.close()
+            seconds = time.perf_counter() - start
+
+        click.echo(f"{stats.sent} of {messages} messages to {chats} chats in {seconds:.2f}s "
+                   f"({stats.sent / seconds:.1f}/s, limit {Config.NOTIFY_GLOBAL_RATE:g}/s)")
+        click.echo(f"429 responses: {api.rejected}, retries: {stats.retries}, failed: {stats.failed}")
+        click.echo(f"shortest gap between messages to one chat: {api.min_chat_interval():.3f}s")
+
+    @app.cli.command('replay-updates')
+    @click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option('--repeat', default=1, show_default=True, help='Times to post each update, with fresh update_ids.')
+    @click.option('--latency', default=0.0, show_default=True, help='Seconds each recorded reply takes.')
+    def replay_updates(paths, repeat, latency):
+        """Post recorded Telegram Update JSON to the webhook route and print the bot's replies.
+
+        Replies are recorded instead of sent, so no network access is needed.
+        """
+        updates = [recorded for path in paths for recorded in _read_updates(path)]
+        secret = app.config['TELEGRAM_WEBHOOK_SECRET'] or secrets.token_urlsafe(16)
+        app.config['TELEGRAM_WEBHOOK_SECRET'] = secret
+        transport = StubTransport(latency)
+        bot = get_webhook_bot(app, transport)
+
+        client = app.test_client()
+        start = time.perf_counter()
+        for copy in range(repeat):
+            for recorded in updates:
+                replayed = dict(recorded, update_id=recorded['update_id'] + copy * 10 ** 9)
+                response = client.post('/telegram/webhook', json=replayed,
+                                       headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+                if response.status_code != 200:
+                    raise click.ClickException(f"Update {replayed['update_id']} got HTTP {response.status_code}")
+        posted = time.perf_counter() - start
+        bot.wait_idle()
+        seconds = time.perf_counter() - start
+        bot.stop()
+
+        if repeat == 1:
+            for _, chat_id, text, options in sorted(transport.sent, key=lambda sent: sent[0]):
+                buttons = [button['text'] for row in options.get('reply_markup', {}).get('inline_keyboard', [])
+                           for button in row]
+                click.echo(f"-> {chat_id}: {text}" + (f"  {buttons}" if buttons else ''))
+        click.echo(f"{len(updates) * repeat} updates posted in {posted:.2f}s, all handled in {seconds:.2f}s: "
+                   f"{bot.stats.as_dict()}")
+
+    @app.cli.command('set-webhook')
+    @click.argument('url', required=False)
+    @click.option('--delete', is_flag=True, help='Remove the webhook, e.g. to go back to polling.')
+    def set_webhook(url, delete):
+        """Point the bot's webhook at URL (https://<host>/telegram/webhook), or remove it."""
+        api = f"{app.config['TELEGRAM_API_URL'].rstrip('/')}/bot{app.config['TELEGRAM_BOT_TOKEN']}"
+        if delete:
+            response = requests.post(f"{api}/deleteWebhook", timeout=10)
+        else:
+            if not url or not app.config['TELEGRAM_WEBHOOK_SECRET']:
+                raise click.ClickException("Give the webhook URL and set TELEGRAM_WEBHOOK_SECRET")
+            response = requests.post(f"{api}/setWebhook", timeout=10, json={
+                'url': url,
+                'secret_token': app.config['TELEGRAM_WEBHOOK_SECRET'],
+                'allowed_updates': ['message', 'edited_message'],
+                'max_connections': 40,
+            })
+        body = response.json()
+        if not body.get('ok'):
+            raise click.ClickException(body.get('description', f"HTTP {response.status_code}"))
+        click.echo(body.get('description', 'OK'))
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import timedelta
 
 class Config:
@@ -30,4 +31,55 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     
     # Pagination settings
-    RESPONSES_PER_PAGE = 10
\ No newline at end of file
+    RESPONSES_PER_PAGE = 10
+
+    # Export settings
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))  # Rows fetched and flushed per chunk
+    EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 1))  # >1 renders full exports on a process pool
+    EXPORT_SHARD_SIZE = int(os.environ.get('EXPORT_SHARD_SIZE', 5000))  # Preferences per shard in parallel exports
+    EXPORT_PARALLEL_MIN_ROWS = int(os.environ.get('EXPORT_PARALLEL_MIN_ROWS', 5000))  # Smaller full exports stay serial
+    EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'iphone_flippers_exports'))
+    DELTA_EXPORT_LAG = int(os.environ.get('DELTA_EXPORT_LAG', 300))  # Seconds of changes every delta export sends again
+
+    # Import settings
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))  # Users written per bulk statement and commit
+
+    # Background job settings
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # Threads per web worker running imports/exports
+    JOB_STORAGE_DIR = os.environ.get('JOB_STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'iphone_flippers_jobs'))  # Uploads and export artifacts
+
+    # Matching settings
+    SUBSCRIBER_INDEX_PATH = os.environ.get('SUBSCRIBER_INDEX_PATH', os.path.join(tempfile.gettempdir(), 'iphone_flippers_subscribers.idx'))  # Written by `flask write-subscriber-index`
+
+    # Notification settings (Telegram allows about 30 messages/s overall and 1/s per chat)
+    TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', 'YOUR_BOT_TOKEN')
+    TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+    NOTIFY_GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', 30))  # Messages per second across all chats
+    NOTIFY_CHAT_RATE = float(os.environ.get('NOTIFY_CHAT_RATE', 1))  # Messages per second to one chat
+    NOTIFY_MAX_IN_FLIGHT = int(os.environ.get('NOTIFY_MAX_IN_FLIGHT', 20))  # Concurrent Bot API requests
+    NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', 5))  # Retries per message after 429s/errors
+    DIGEST_WINDOW = float(os.environ.get('DIGEST_WINDOW', 60))  # Seconds matches are collected into one message (0 disables)
+    DIGEST_MAX_ITEMS = int(os.environ.get('DIGEST_MAX_ITEMS', 10))  # Matches per digest before it is sent early
+    DIGEST_MAX_USERS = int(os.environ.get('DIGEST_MAX_USERS', 50000))  # Open digests kept in memory
+    DIGEST_MODES = [mode.strip() for mode in os.environ.get('DIGEST_MODES', 'all').split(',') if mode.strip()]  # notification_modes sent as digests
+
+    # Deduplication settings
+    DEDUP_MODE = os.environ.get('DEDUP_MODE', 'bloom')  # 'lru' (exact) or 'bloom' (rotating Bloom filters)
+    DEDUP_TTL = float(os.environ.get('DEDUP_TTL', 86400))  # Seconds a (listing, preference) pair stays notified
+    DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', 1000000))  # Pairs kept (lru) or per filter generation (bloom)
+    DEDUP_ERROR_RATE = float(os.environ.get('DEDUP_ERROR_RATE', 0.001))  # Bloom false positive rate
+    DEDUP_STATE_PATH = os.environ.get('DEDUP_STATE_PATH', os.path.join(tempfile.gettempdir(), 'iphone_flippers_dedup.npz'))  # Saved between ingest runs
+    DEDUP_SAVE_EVERY = int(os.environ.get('DEDUP_SAVE_EVERY', 10000))  # Deduplicated listings between ingest saves of the store
+    DEDUP_SAVE_INTERVAL = float(os.environ.get('DEDUP_SAVE_INTERVAL', 60))  # Seconds between ingest saves of the store
+
+    # Repost and reseller detection settings
+    REPOST_CAPACITY = int(os.environ.get('REPOST_CAPACITY', 100000))  # Recent listings checked for near-duplicates
+    REPOST_MAX_DISTANCE = int(os.environ.get('REPOST_MAX_DISTANCE', 3))  # SimHash bits a repost may differ by
+    RESELLER_WINDOW = float(os.environ.get('RESELLER_WINDOW', 86400))  # Seconds after which per-seller counts halve
+    RESELLER_POST_THRESHOLD = int(os.environ.get('RESELLER_POST_THRESHOLD', 20))  # Recent posts that flag a reseller
+    RESELLER_REPOST_THRESHOLD = int(os.environ.get('RESELLER_REPOST_THRESHOLD', 5))  # Recent reposts that flag a reseller
+
+    # Webhook bot settings (see webhook_bot.py)
+    WEBAPP_URL = os.environ.get('WEBAPP_URL', 'http://localhost:5000')  # Base URL of the preference links the bot sends
+    TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')  # Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; empty disables the webhook
+    WEBHOOK_MAX_CONCURRENCY = int(os.environ.get('WEBHOOK_MAX_CONCURRENCY', 50))  # Updates handled at once per web worker
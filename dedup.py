@@ -0,0 +1,213 @@
+import os
+import math
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from config import Config
+from classifier import tokenize
+from matching import normalize_location
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+def listing_fingerprint(title, price, location):
+    """64-bit fingerprint of a listing's content.
+
+    Titles are compared by their tokens, so a repost with different spacing
+    or case is the same listing, while a price change makes a new one.
+    """
+    text = f"{' '.join(tokenize(title))}|{price}|{normalize_location(location)}"
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def pair_key(fingerprint, preference_id):
+    """128-bit key for one (listing fingerprint, preference id) pair"""
+    return hashlib.blake2b(f'{fingerprint}:{preference_id}'.encode('ascii'), digest_size=16).digest()
+
+class DedupStats:
+    def __init__(self):
+        self.checked = 0
+        self.duplicates = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+def _save_arrays(path, **arrays):
+    """np.savez to path, atomically"""
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as state_file:
+        np.savez(state_file, **arrays)
+    os.replace(temp_path, path)
+
+class LruDedupStore:
+    """Exact "already notified" set of (listing, preference) pairs.
+
+    Pairs are remembered for ttl seconds after they were first notified,
+    and at most capacity of them are kept, dropping the least recently seen
+    first. Costs about 200 bytes per pair.
+    """
+
+    mode = 'lru'
+
+    def __init__(self, capacity=None, ttl=None, clock=time.time):
+        self.capacity = capacity or Config.DEDUP_CAPACITY
+        self.ttl = ttl or Config.DEDUP_TTL
+        self.clock = clock
+        self.stats = DedupStats()
+        self._seen = OrderedDict()    # pair key -> time first notified
+
+    def __len__(self):
+        return len(self._seen)
+
+    def check_and_add(self, fingerprint, preference_id):
+        """True if the pair was notified within the TTL; otherwise remember it and return False"""
+        self.stats.checked += 1
+        key = pair_key(fingerprint, preference_id)
+        now = self.clock()
+        notified_at = self._seen.get(key)
+        if notified_at is not None and now - notified_at < self.ttl:
+            self._seen.move_to_end(key)
+            self.stats.duplicates += 1
+            return True
+
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        # Expired pairs at the cold end go first, then anything over capacity
+        while self._seen:
+            oldest_key, oldest_at = next(iter(self._seen.items()))
+            if len(self._seen) <= self.capacity and now - oldest_at < self.ttl:
+                break
+            del self._seen[oldest_key]
+        return False
+
+    def save(self, path):
+        keys = np.frombuffer(b''.join(self._seen.keys()), dtype='u1').reshape(-1, 16)
+        _save_arrays(path, mode=np.array(self.mode), keys=keys,
+                     times=np.fromiter(self._seen.values(), dtype='<f8', count=len(self._seen)))
+
+    def _restore(self, state):
+        now = self.clock()
+        for key, notified_at in zip(state['keys'], state['times'].tolist()):
+            if now - notified_at < self.ttl:
+                self._seen[key.tobytes()] = notified_at
+        while len(self._seen) > self.capacity:
+            self._seen.popitem(last=False)
+
+class BloomDedupStore:
+    """Probabilistic "already notified" set using rotating Bloom filters.
+
+    The TTL is split over generations filters. New pairs go into the newest
+    one, lookups check all of them, and every ttl / generations seconds (or
+    once the newest filter holds capacity pairs) the oldest filter is
+    cleared and becomes the newest. A pair is therefore remembered for
+    between (generations - 1) / generations of the TTL and the full TTL.
+    There are no false negatives. A small error_rate of new pairs is wrongly
+    reported as duplicates, in exchange for about 2 bytes per pair at 0.1%.
+    """
+
+    mode = 'bloom'
+
+    def __init__(self, capacity=None, ttl=None, error_rate=None, generations=4, clock=time.time):
+        self.capacity = capacity or Config.DEDUP_CAPACITY
+        self.ttl = ttl or Config.DEDUP_TTL
+        self.error_rate = error_rate or Config.DEDUP_ERROR_RATE
+        self.generations = generations
+        self.clock = clock
+        self.stats = DedupStats()
+
+        # Optimal bits and hash count for capacity pairs per filter at error_rate overall
+        per_filter_rate = self.error_rate / generations
+        self.bits = int(math.ceil(-self.capacity * math.log(per_filter_rate) / math.log(2) ** 2 / 8)) * 8
+        self.hashes = max(1, int(round(self.bits / self.capacity * math.log(2))))
+        self._filters = [bytearray(self.bits // 8) for _ in range(generations)]
+        self._counts = [0] * generations
+        self._newest = 0
+        self._rotated_at = self.clock()
+
+    def __len__(self):
+        """Pairs added to the filters still in use"""
+        return sum(self._counts)
+
+    @property
+    def nbytes(self):
+        return sum(len(bloom_filter) for bloom_filter in self._filters)
+
+    def _probes(self, key):
+        """(byte, bit mask) of every bit for a key; the two halves of the key give them by double hashing"""
+        first = int.from_bytes(key[:8], 'little')
+        second = int.from_bytes(key[8:], 'little') | 1
+        positions = [(first + index * second) % self.bits for index in range(self.hashes)]
+        return [(position >> 3, 1 << (position & 7)) for position in positions]
+
+    def _rotate(self, now):
+        self._newest = (self._newest + 1) % self.generations
+        self._filters[self._newest] = bytearray(self.bits // 8)
+        self._counts[self._newest] = 0
+        self._rotated_at = now
+
+    def check_and_add(self, fingerprint, preference_id):
+        """True if the pair was (probably) notified within the TTL; otherwise remember it and return False"""
+        self.stats.checked += 1
+        now = self.clock()
+        period = self.ttl / self.generations
+        if now - self._rotated_at >= self.ttl:
+            for _ in range(self.generations):
+                self._rotate(now)
+        while now - self._rotated_at >= period:
+            self._rotate(self._rotated_at + period)
+
+        probes = self._probes(pair_key(fingerprint, preference_id))
+        for bloom_filter in self._filters:
+            for byte, mask in probes:
+                if not bloom_filter[byte] & mask:
+                    break
+            else:
+                self.stats.duplicates += 1
+                return True
+
+        if self._counts[self._newest] >= self.capacity:
+            self._rotate(now)
+        newest = self._filters[self._newest]
+        for byte, mask in probes:
+            newest[byte] |= mask
+        self._counts[self._newest] += 1
+        return False
+
+    def save(self, path):
+        _save_arrays(
+            path, mode=np.array(self.mode),
+            filters=np.frombuffer(b''.join(self._filters), dtype='u1').reshape(self.generations, -1),
+            counts=np.array(self._counts, dtype='<i8'),
+            state=np.array([self._newest, self._rotated_at, self.bits, self.hashes], dtype='<f8')
+        )
+
+    def _restore(self, state):
+        newest, rotated_at, bits, hashes = state['state'].tolist()
+        filters = state['filters']
+        if (int(bits), int(hashes), len(filters)) != (self.bits, self.hashes, self.generations):
+            logger.warning("Dedup state was saved with other Bloom filter settings; starting empty")
+            return
+        self._filters = [bytearray(bloom_filter.tobytes()) for bloom_filter in filters]
+        self._counts = state['counts'].tolist()
+        self._newest = int(newest)
+        self._rotated_at = rotated_at
+
+DEDUP_STORES = {store.mode: store for store in (LruDedupStore, BloomDedupStore)}
+
+def open_dedup_store(path=None, mode=None, **options):
+    """A dedup store of the given mode ('lru' or 'bloom'), restored from path when it exists"""
+    mode = mode or Config.DEDUP_MODE
+    if mode not in DEDUP_STORES:
+        raise ValueError(f"Unknown dedup mode {mode!r}; expected one of {', '.join(DEDUP_STORES)}")
+    store = DEDUP_STORES[mode](**options)
+    if path and os.path.exists(path):
+        with np.load(path, allow_pickle=False) as state:
+            if str(state['mode']) == mode:
+                store._restore(state)
+                logger.info(f"Restored {len(store)} notified pairs from {path}")
+            else:
+                logger.warning(f"{path} holds a {state['mode']} dedup store, not {mode}; starting empty")
+    return store
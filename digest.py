@@ -0,0 +1,201 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from config import Config
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_CHARS = 4096
+
+def format_digest(messages):
+    """One message for a user's buffered matches; a single match is sent unchanged"""
+    if len(messages) == 1:
+        return messages[0]
+    return f"{len(messages)} new matches:\n\n" + "\n\n".join(messages)
+
+class DigestStats:
+    def __init__(self):
+        self.matches = 0
+        self.messages = 0
+        self.window_flushes = 0     # The window ran out
+        self.full_flushes = 0       # max_items reached, or the next match wouldn't fit
+        self.pressure_flushes = 0   # Flushed early to stay within max_users
+        self.final_flushes = 0      # Flushed at the end of the input
+
+    @property
+    def saved(self):
+        """Messages not sent thanks to digests"""
+        return self.matches - self.messages
+
+    def as_dict(self):
+        return dict(vars(self), saved=self.saved)
+
+class _Pending:
+    __slots__ = ('sequence', 'messages', 'chars')
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.messages = []
+        self.chars = 0
+
+class DigestBuffer:
+    """Per-user buffers of matches, each flushed as one message.
+
+    A buffer opens with a user's first match and is flushed window seconds
+    later, or earlier once it holds max_items matches or the next match would
+    push the digest past Telegram's message size. Because every buffer lives
+    for the same window, deadlines expire in the order buffers were opened:
+    one deque replaces per-user timers, and the only timer needed is for its
+    head. At most max_users buffers are open at once; beyond that the oldest
+    one is flushed early, so memory stays bounded.
+    """
+
+    def __init__(self, window=None, max_items=None, max_users=None, max_chars=MAX_MESSAGE_CHARS,
+                 clock=time.monotonic):
+        self.window = Config.DIGEST_WINDOW if window is None else window
+        self.max_items = max_items or Config.DIGEST_MAX_ITEMS
+        self.max_users = max_users or Config.DIGEST_MAX_USERS
+        self.max_chars = max_chars
+        self.clock = clock
+        self.stats = DigestStats()
+        self._pending = {}          # chat id -> _Pending
+        self._deadlines = deque()   # (deadline, chat id, sequence), oldest first
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, chat_id, message):
+        """Buffer one match; returns the (chat_id, text) messages ready to send now"""
+        self.stats.matches += 1
+        ready = []
+        pending = self._pending.get(chat_id)
+        if pending is not None and self._digest_chars(pending, message) > self.max_chars:
+            ready.append(self._flush(chat_id))
+            self.stats.full_flushes += 1
+            pending = None
+
+        if pending is None:
+            if len(self._pending) >= self.max_users:
+                ready.append(self._flush_oldest())
+                self.stats.pressure_flushes += 1
+            pending = self._open(chat_id)
+
+        pending.messages.append(message)
+        pending.chars += len(message) + 2
+        if len(pending.messages) >= self.max_items:
+            ready.append(self._flush(chat_id))
+            self.stats.full_flushes += 1
+        return ready
+
+    def expired(self):
+        """Flush the buffers whose window has run out"""
+        ready = []
+        now = self.clock()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, chat_id, sequence = self._deadlines.popleft()
+            if self._is_current(chat_id, sequence):
+                ready.append(self._flush(chat_id))
+                self.stats.window_flushes += 1
+        return ready
+
+    def seconds_to_next_flush(self):
+        """Seconds until the oldest buffer is due, or None when nothing is buffered"""
+        self._drop_stale_deadlines()
+        if not self._deadlines:
+            return None
+        return max(0.0, self._deadlines[0][0] - self.clock())
+
+    def flush_all(self):
+        ready = [self._flush(chat_id) for chat_id in list(self._pending)]
+        self.stats.final_flushes += len(ready)
+        self._deadlines.clear()
+        return ready
+
+    def _open(self, chat_id):
+        self._sequence += 1
+        pending = self._pending[chat_id] = _Pending(self._sequence)
+        self._deadlines.append((self.clock() + self.window, chat_id, self._sequence))
+        if len(self._deadlines) > 2 * self.max_users:
+            # Buffers flushed early leave stale deadlines behind; drop them so the deque stays bounded
+            self._deadlines = deque(entry for entry in self._deadlines if self._is_current(entry[1], entry[2]))
+        return pending
+
+    def _is_current(self, chat_id, sequence):
+        pending = self._pending.get(chat_id)
+        return pending is not None and pending.sequence == sequence
+
+    def _drop_stale_deadlines(self):
+        while self._deadlines and not self._is_current(*self._deadlines[0][1:]):
+            self._deadlines.popleft()
+
+    def _flush_oldest(self):
+        self._drop_stale_deadlines()
+        _, chat_id, _ = self._deadlines.popleft()
+        return self._flush(chat_id)
+
+    def _flush(self, chat_id):
+        pending = self._pending.pop(chat_id)
+        self.stats.messages += 1
+        return chat_id, format_digest(pending.messages)
+
+    def _digest_chars(self, pending, message):
+        header = len(f"{len(pending.messages) + 1} new matches:\n\n")
+        return header + pending.chars + len(message)
+
+class DigestStage:
+    """Async stage between the notification jobs and the dispatcher.
+
+    Jobs are (user_id, message, notification_mode); those whose mode is in
+    modes go through a DigestBuffer, the rest pass straight through. The
+    stage sleeps until the next digest is due or the next job arrives.
+    """
+
+    def __init__(self, buffer=None, modes=None):
+        self.buffer = DigestBuffer() if buffer is None else buffer
+        self.modes = set(Config.DIGEST_MODES if modes is None else modes)
+
+    @property
+    def stats(self):
+        return self.buffer.stats
+
+    async def run(self, inbox, outbox):
+        """Read jobs from inbox until None, writing (user_id, message) jobs to outbox, then None"""
+        # One get() is kept pending across deadlines rather than wrapped in
+        # asyncio.wait_for(): before Python 3.12, wait_for's timeout can
+        # cancel a get() that has already taken a job, and the job is lost.
+        getter = None
+        try:
+            while True:
+                if getter is None:
+                    getter = asyncio.ensure_future(inbox.get())
+                await asyncio.wait({getter}, timeout=self.buffer.seconds_to_next_flush())
+                job = ()
+                if getter.done():
+                    job = getter.result()
+                    getter = None
+
+                if job is None:
+                    break
+                if job:
+                    chat_id, message = job[0], job[1]
+                    notification_mode = job[2] if len(job) > 2 else None
+                    if not chat_id or notification_mode not in self.modes:
+                        await outbox.put((chat_id, message))
+                    else:
+                        for ready in self.buffer.add(chat_id, message):
+                            await outbox.put(ready)
+                for ready in self.buffer.expired():
+                    await outbox.put(ready)
+        finally:
+            if getter is not None:
+                getter.cancel()
+
+        for ready in self.buffer.flush_all():
+            await outbox.put(ready)
+        await outbox.put(None)
+        logger.info(f"Digests: {self.stats.as_dict()}")
@@ -0,0 +1,536 @@
+import io
+import os
+import csv
+import json
+import base64
+import hashlib
+import zipfile
+import tempfile
+import xlsxwriter
+from datetime import datetime, timedelta
+from sqlalchemy import or_, and_, func
+from sqlalchemy.orm import selectinload
+
+from config import Config
+from models import db, Preference, DeletedPreference, WordSet, default_word_set_ids
+
+# Column headers for the files inside the export ZIP
+USER_HEADERS = [
+    'unique_userid', 'user_id', 'user_name', 'location', 'activation_status',
+    'expiry_date', 'fixed_lat', 'fixed_lon', 'password',
+    'mode_only_preferred', 'non_good_deals', 'good_deals', 'near_good_deals',
+    'keyword_set_id', 'excluded_set_id'
+]
+
+PRODUCT_HEADERS = [
+    'unique_userid', 'name', 'min_price', 'max_price', 'preferred'
+]
+
+# Each word set is written once; users reference it by set_id
+KEYWORD_SET_HEADERS = ['set_id', 'version', 'keyword']
+EXCLUDED_SET_HEADERS = ['set_id', 'version', 'excluded_word']
+
+# Header of the single-file CSV export
+COMBINED_HEADERS = [
+    'unique_userid', 'user_id', 'user_name', 'location', 'activation_status',
+    'expiry_date', 'fixed_lat', 'fixed_lon', 'password',
+    'products', 'keywords', 'excluded_words', 'resellers',
+    'mode_only_preferred', 'non_good_deals', 'good_deals', 'near_good_deals'
+]
+
+# Bump whenever the content of an export changes, so cached files are regenerated
+EXPORT_FORMAT_VERSION = 2
+
+# Export flags per notification mode:
+# (mode_only_preferred, non_good_deals, good_deals, near_good_deals)
+MODE_FLAGS = {
+    'all': (0, 1, 0, 0),
+    'only_preferred': (1, 0, 0, 0),
+    'near_good_deal': (1, 0, 0, 1),
+    'good_deal': (1, 0, 1, 1)
+}
+
+README_CONTENT = """iPhone Flippers Data Export
+
+This ZIP file contains the following CSV files:
+
+1. users.csv - Main user information and notification modes
+2. products.csv - Product preferences (with min_price set to 100)
+3. keyword_sets.csv - Search keyword sets (each set listed once)
+4. excluded_word_sets.csv - Excluded word sets (each set listed once)
+5. resellers.csv - Template for adding preferred resellers
+
+Users reference their sets through the keyword_set_id and excluded_set_id columns of users.csv.
+For importing, make sure unique_userid values match across all files.
+"""
+
+DELTA_README_CONTENT = """iPhone Flippers Delta Export
+
+This ZIP file contains only the changes since the watermark it was requested with:
+
+1. users.csv - Users created or updated since the watermark
+2. products.csv - The complete current product list of every user in users.csv
+3. keyword_sets.csv - Keyword sets referenced by users.csv
+4. excluded_word_sets.csv - Excluded word sets referenced by users.csv
+5. resellers.csv - Template for adding preferred resellers
+6. deleted.csv - Users deleted since the watermark
+7. watermark.txt - Pass this value as ?since= on the next sync
+
+Apply deleted.csv first, then replace each user in users.csv together with its products.
+The last few minutes of changes are sent again by the next sync, so skip deletions
+of users that are already gone.
+"""
+
+def mode_flags(notification_mode):
+    """Return the export flags for a notification mode (unknown modes fall back to 'all')"""
+    return MODE_FLAGS.get(notification_mode, MODE_FLAGS['all'])
+
+def user_row(pref, default_set_ids):
+    """Build the users.csv row for a preference (an ORM object or a Core row)
+
+    default_set_ids is the (keyword, excluded) set id pair used for
+    preferences that don't reference a set of their own.
+    """
+    # Format expiry_date if exists - Ensuring YYYY-MM-DD format
+    expiry_date_str = ""
+    if pref.expiry_date:
+        expiry_date_str = pref.expiry_date.strftime('%Y-%m-%d')
+
+    return [
+        pref.unique_userid or f"user_{pref.id}",  # unique_userid
+        pref.user_id or "",                 # user_id
+        pref.user_name or "",               # user_name
+        pref.location,                      # location
+        1 if pref.activation_status else 0, # activation_status
+        expiry_date_str,                    # expiry_date
+        pref.fixed_lat or "",               # fixed_lat
+        pref.fixed_lon or "",               # fixed_lon
+        "",                                 # password (not in original schema)
+        *mode_flags(pref.notification_mode),
+        pref.keyword_set_id or default_set_ids[0],   # keyword_set_id
+        pref.excluded_set_id or default_set_ids[1]   # excluded_set_id
+    ]
+
+def product_row(unique_userid, product):
+    """Build the products.csv row for a product preference"""
+    return [
+        unique_userid,                      # unique_userid
+        product.product_name,               # name
+        100,                                # min_price (set to 100 as requested)
+        product.max_price,                  # max_price
+        1 if product.is_preferred else 0    # preferred
+    ]
+
+def combined_row(pref, default_set_ids, set_words):
+    """Build the single-file CSV row for a preference, with products and words joined by ';'
+
+    set_words maps word set id -> the set's words already joined by ';'.
+    """
+    # Extract products with better formatting
+    # Format: name:min_price:max_price:preferred (using 100 as min_price as requested)
+    products_str = ";".join(
+        f"{product.product_name}:100:{product.max_price}:{1 if product.is_preferred else 0}"
+        for product in pref.products
+    )
+
+    user = user_row(pref, default_set_ids)
+    return user[:9] + [
+        products_str,                       # products
+        set_words[user[13]],                # keywords
+        set_words[user[14]],                # excluded_words
+        "",                                 # resellers (left empty as requested)
+    ] + user[9:13]
+
+def iter_preferences(query, batch_size, with_products=True):
+    """Iterate over a preference query in id order with its products, batch_size preferences at a time.
+
+    Every batch is its own keyset query (id > the last id seen, LIMIT
+    batch_size), read completely before its rows are handed out, and loads
+    the products of all its preferences in a single SELECT ... WHERE
+    preference_id IN (...). An export therefore costs two queries per batch
+    instead of one per user, and no cursor stays open between batches, so
+    callers can write to the database while iterating (SQLite answers
+    "database is locked" to writers while another connection has a
+    half-read cursor).
+    """
+    if with_products:
+        query = query.options(selectinload(Preference.products))
+    query = query.order_by(None).order_by(Preference.id)
+
+    last_id = None
+    while True:
+        page = query if last_id is None else query.filter(Preference.id > last_id)
+        batch = db.session.execute(page.limit(batch_size).statement).scalars().all()
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+        # Let the batch go before the next one loads, or two batches of objects are alive at once
+        del batch
+
+def referenced_word_sets(query, default_set_ids):
+    """Return (keyword sets, excluded sets) used by the preferences in query, ordered by id"""
+    keyword_ids = {set_id or default_set_ids[0]
+                   for (set_id,) in query.with_entities(Preference.keyword_set_id).distinct()}
+    excluded_ids = {set_id or default_set_ids[1]
+                    for (set_id,) in query.with_entities(Preference.excluded_set_id).distinct()}
+
+    def load(ids):
+        if not ids:
+            return []
+        return WordSet.query.filter(WordSet.id.in_(ids)).order_by(WordSet.id).all()
+
+    return load(keyword_ids), load(excluded_ids)
+
+def word_set_rows(word_sets):
+    """keyword_sets.csv/excluded_word_sets.csv rows: one row per word of every set"""
+    for word_set in word_sets:
+        for word in word_set.word_list:
+            yield [word_set.id, word_set.version, word]
+
+def _user_rows(query, batch_size, default_set_ids):
+    for pref in iter_preferences(query, batch_size, with_products=False):
+        yield user_row(pref, default_set_ids)
+
+def _product_rows(query, batch_size):
+    for pref in iter_preferences(query, batch_size):
+        unique_userid = pref.get_unique_userid()
+        for product in pref.products:
+            yield product_row(unique_userid, product)
+
+def export_members(query, batch_size):
+    """Return (filename, header, rows) for every CSV in the export ZIP"""
+    default_set_ids = default_word_set_ids()
+    keyword_sets, excluded_sets = referenced_word_sets(query, default_set_ids)
+
+    return [
+        ('users.csv', USER_HEADERS, _user_rows(query, batch_size, default_set_ids)),
+        ('products.csv', PRODUCT_HEADERS, _product_rows(query, batch_size)),
+        ('keyword_sets.csv', KEYWORD_SET_HEADERS, word_set_rows(keyword_sets)),
+        ('excluded_word_sets.csv', EXCLUDED_SET_HEADERS, word_set_rows(excluded_sets)),
+        ('resellers.csv', ['unique_userid', 'reseller_name'], iter(()))
+    ]
+
+class ChunkBuffer:
+    """Write-only, unseekable file object that hands back whatever was written since the last drain.
+
+    zipfile detects the missing tell() and switches to streaming mode (data
+    descriptors after each member), so nothing has to be kept around once a
+    chunk has been sent to the client.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_export_zip(query, batch_size, readme_content=README_CONTENT, progress=None, extra_members=()):
+    """Generate the export ZIP for the given preference query as a series of byte chunks.
+
+    Each CSV is written straight into its compressed ZIP member while rows are
+    read from the database, and the compressed bytes are yielded every
+    batch_size rows, so memory use does not depend on the number of preferences.
+
+    progress, if given, is called with the total number of CSV rows written so
+    far every time a chunk is produced.
+    """
+    buffer = ChunkBuffer()
+    rows_done = 0
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for filename, header, rows in export_members(query, batch_size) + list(extra_members):
+            with zipf.open(filename, 'w') as member:
+                text = io.TextIOWrapper(member, encoding='utf-8', newline='', write_through=True)
+                writer = csv.writer(text)
+                writer.writerow(header)
+
+                count = 0
+                for count, row in enumerate(rows, 1):
+                    writer.writerow(row)
+                    if count % batch_size == 0:
+                        if progress:
+                            progress(rows_done + count)
+                        chunk = buffer.drain()
+                        if chunk:
+                            yield chunk
+
+                rows_done += count
+
+                # Hand the member back to the with-block so it gets closed only once
+                text.detach()
+
+            if progress:
+                progress(rows_done)
+            yield buffer.drain()
+
+        # Add a README file
+        zipf.writestr('README.txt', readme_content)
+
+    yield buffer.drain()
+
+def stream_export_csv(query, batch_size):
+    """Generate the single-file CSV export (UTF-8 with BOM for Excel) in chunks of batch_size rows"""
+    output = io.StringIO()
+    writer = csv.writer(output, quoting=csv.QUOTE_NONNUMERIC)  # Quote all fields to preserve formatting
+    writer.writerow(COMBINED_HEADERS)
+
+    def drain():
+        data = output.getvalue()
+        output.seek(0)
+        output.truncate()
+        return data.encode('utf-8')
+
+    # Word sets are shared, so each set's joined words are built once
+    default_set_ids = default_word_set_ids()
+    keyword_sets, excluded_sets = referenced_word_sets(query, default_set_ids)
+    set_words = {word_set.id: ";".join(word_set.word_list) for word_set in keyword_sets + excluded_sets}
+
+    yield '\ufeff'.encode('utf-8') + drain()
+
+    for count, pref in enumerate(iter_preferences(query, batch_size), 1):
+        writer.writerow(combined_row(pref, default_set_ids, set_words))
+        if count % batch_size == 0:
+            yield drain()
+
+    yield drain()
+
+class SheetWriter:
+    """Appends rows to an xlsxwriter worksheet in order, as constant_memory mode requires.
+
+    Continues on a new "<name> (2)", "<name> (3)", ... sheet when Excel's row
+    limit is reached.
+    """
+
+    MAX_ROWS = 1048576
+
+    def __init__(self, workbook, name, header, header_format):
+        self.workbook = workbook
+        self.name = name
+        self.header = header
+        self.header_format = header_format
+        self.sheets = 0
+        self._new_sheet()
+
+    def _new_sheet(self):
+        self.sheets += 1
+        name = self.name if self.sheets == 1 else f'{self.name} ({self.sheets})'
+        self.worksheet = self.workbook.add_worksheet(name)
+        self.worksheet.write_row(0, 0, self.header, self.header_format)
+        self.row = 1
+
+    def append(self, values):
+        if self.row == self.MAX_ROWS:
+            self._new_sheet()
+        self.worksheet.write_row(self.row, 0, values)
+        self.row += 1
+
+def stream_export_xlsx(query, batch_size, chunk_size=64 * 1024):
+    """Generate a multi-sheet XLSX export (users, products, keyword sets, excluded word sets, resellers).
+
+    The workbook is written in xlsxwriter's constant_memory mode while
+    preferences stream from the database, so only the current row of each
+    sheet is held in memory. Each sheet is staged in its own temp file. The
+    finished file is then yielded in chunk_size pieces and deleted.
+    """
+    default_set_ids = default_word_set_ids()
+    keyword_sets, excluded_sets = referenced_word_sets(query, default_set_ids)
+
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+
+    try:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        header_format = workbook.add_format({'bold': True})
+
+        users = SheetWriter(workbook, 'Users', USER_HEADERS, header_format)
+        products = SheetWriter(workbook, 'Products', PRODUCT_HEADERS, header_format)
+        keywords = SheetWriter(workbook, 'Keyword Sets', KEYWORD_SET_HEADERS, header_format)
+        excluded = SheetWriter(workbook, 'Excluded Word Sets', EXCLUDED_SET_HEADERS, header_format)
+        SheetWriter(workbook, 'Resellers', ['unique_userid', 'reseller_name'], header_format)
+
+        for pref in iter_preferences(query, batch_size):
+            unique_userid = pref.get_unique_userid()
+            users.append(user_row(pref, default_set_ids))
+            for product in pref.products:
+                products.append(product_row(unique_userid, product))
+
+        for row in word_set_rows(keyword_sets):
+            keywords.append(row)
+        for row in word_set_rows(excluded_sets):
+            excluded.append(row)
+
+        workbook.close()
+
+        with open(path, 'rb') as xlsx_file:
+            while True:
+                chunk = xlsx_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+def export_version(kind):
+    """Return (etag, last_modified) identifying the current contents of a full export.
+
+    Built from cheap aggregates: any insert or edit moves max(updated_at) or
+    the row count, and any delete adds a tombstone.
+    """
+    max_updated, count = db.session.query(func.max(Preference.updated_at), func.count(Preference.id)).one()
+    last_deleted_id, last_deleted_at = db.session.query(
+        func.max(DeletedPreference.id), func.max(DeletedPreference.deleted_at)
+    ).one()
+
+    version = f"{kind}:{EXPORT_FORMAT_VERSION}:{count}:{last_deleted_id or 0}:{max_updated.isoformat() if max_updated else ''}"
+    etag = hashlib.sha1(version.encode()).hexdigest()
+
+    last_modified = max(filter(None, [max_updated, last_deleted_at]), default=None)
+    return etag, last_modified
+
+def cache_path(cache_dir, kind, etag):
+    return os.path.join(cache_dir, f'{kind}_{etag}')
+
+def write_through_cache(chunks, cache_dir, kind, etag):
+    """Pass chunks through while saving them as the cached export for etag.
+
+    The file only becomes visible once the export has completed, and older
+    cached versions of the same kind are then removed. An interrupted
+    download leaves nothing behind.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, kind, etag)
+    # A name of its own for every download: threads of one worker can fill the same etag at once
+    cache_file = tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+                                             delete=False)
+    temp_path = cache_file.name
+
+    try:
+        with cache_file:
+            for chunk in chunks:
+                cache_file.write(chunk)
+                yield chunk
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    for filename in os.listdir(cache_dir):
+        if filename.startswith(f'{kind}_') and not filename.endswith('.tmp') and filename != os.path.basename(path):
+            os.remove(os.path.join(cache_dir, filename))
+
+def encode_watermark(updated_at, pref_id, deleted_id):
+    """Pack a delta export position into an opaque URL-safe cursor"""
+    data = {
+        'updated_at': updated_at.isoformat() if updated_at else None,
+        'id': pref_id,
+        'deleted_id': deleted_id
+    }
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+def decode_watermark(watermark):
+    """Return (updated_at, pref_id, deleted_id) for a cursor, a plain ISO timestamp, or nothing.
+
+    Raises ValueError for anything else.
+    """
+    if not watermark:
+        return None, 0, 0
+
+    try:
+        # A plain timestamp covers every change after it, including deletions
+        updated_at = datetime.fromisoformat(watermark)
+        deleted_id = db.session.query(func.max(DeletedPreference.id))\
+            .filter(DeletedPreference.deleted_at <= updated_at).scalar()
+        return updated_at, 0, deleted_id or 0
+    except ValueError:
+        pass
+
+    try:
+        padded = watermark + '=' * (-len(watermark) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        updated_at = datetime.fromisoformat(data['updated_at']) if data['updated_at'] else None
+        return updated_at, int(data['id']), int(data['deleted_id'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid watermark: {watermark}")
+
+def delta_export(watermark, lag=None):
+    """Work out what a delta export since watermark contains.
+
+    Returns (changed preferences query, tombstone query, next watermark). Both
+    queries are capped at the newest change, so rows changed while the export
+    streams are picked up by the following sync. updated_at and tombstone ids
+    are assigned before a transaction commits, so a row can become visible
+    after a sync that already passed its position. The next watermark is
+    therefore held back to lag seconds (DELTA_EXPORT_LAG) ago: changes from
+    that window are sent again by the following sync, and clients must apply
+    them as upserts. A change is only missed if its transaction took longer
+    than lag to commit.
+    """
+    updated_at, pref_id, deleted_id = decode_watermark(watermark)
+    lag = Config.DELTA_EXPORT_LAG if lag is None else lag
+    settled = datetime.utcnow() - timedelta(seconds=lag)
+
+    changed = Preference.query
+    if updated_at:
+        changed = changed.filter(or_(
+            Preference.updated_at > updated_at,
+            and_(Preference.updated_at == updated_at, Preference.id > pref_id)
+        ))
+
+    last = changed.with_entities(Preference.updated_at, Preference.id)\
+        .filter(Preference.updated_at.isnot(None))\
+        .order_by(Preference.updated_at.desc(), Preference.id.desc()).first()
+    if last:
+        changed = changed.filter(or_(
+            Preference.updated_at.is_(None),
+            Preference.updated_at < last.updated_at,
+            and_(Preference.updated_at == last.updated_at, Preference.id <= last.id)
+        ))
+        position = min((last.updated_at, last.id), (settled, 0))
+        if updated_at is None or position > (updated_at, pref_id):
+            updated_at, pref_id = position
+
+    deleted = DeletedPreference.query.filter(DeletedPreference.id > deleted_id)
+    last_deleted_id = deleted.with_entities(func.max(DeletedPreference.id)).scalar()
+    if last_deleted_id:
+        deleted = deleted.filter(DeletedPreference.id <= last_deleted_id)
+        settled_id = deleted.with_entities(func.max(DeletedPreference.id))\
+            .filter(DeletedPreference.deleted_at <= settled).scalar()
+        deleted_id = settled_id or deleted_id
+
+    return changed, deleted, encode_watermark(updated_at, pref_id, deleted_id)
+
+def _deleted_rows(deleted, batch_size):
+    """Tombstone rows in id order, paged like iter_preferences() so no cursor stays open between batches"""
+    query = deleted.with_entities(DeletedPreference.id, DeletedPreference.unique_userid, DeletedPreference.deleted_at)
+    query = query.order_by(None).order_by(DeletedPreference.id)
+
+    last_id = None
+    while True:
+        page = query if last_id is None else query.filter(DeletedPreference.id > last_id)
+        batch = db.session.execute(page.limit(batch_size).statement).all()
+        for _, unique_userid, deleted_at in batch:
+            yield [unique_userid, deleted_at.isoformat() if deleted_at else ""]
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1].id
+
+def stream_delta_export_zip(watermark, batch_size, progress=None):
+    """Return (chunk generator, next watermark) for a delta export ZIP"""
+    changed, deleted, next_watermark = delta_export(watermark)
+
+    extra_members = [
+        ('deleted.csv', ['unique_userid', 'deleted_at'], _deleted_rows(deleted, batch_size)),
+        ('watermark.txt', ['watermark'], iter([[next_watermark]]))
+    ]
+    chunks = stream_export_zip(changed, batch_size, DELTA_README_CONTENT, progress, extra_members)
+    return chunks, next_watermark
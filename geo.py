@@ -0,0 +1,87 @@
+import math
+from collections import defaultdict
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+# Side of a grid cell in degrees (about 28 km of latitude). Cells are stored in
+# Preference.geo_cell, so run `flask backfill-geo --all` after changing this.
+GRID_CELL_DEGREES = 0.25
+GRID_COLUMNS = int(round(360 / GRID_CELL_DEGREES))
+
+def parse_coordinate(value, limit):
+    """Parse a latitude (limit 90) or longitude (limit 180) string, or None if it isn't one"""
+    try:
+        number = float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number) or abs(number) > limit:
+        return None
+    return number
+
+def grid_cell(lat, lon):
+    """Key of the grid cell containing a point, e.g. '497:1564'"""
+    row = int(math.floor((lat + 90) / GRID_CELL_DEGREES))
+    column = int(math.floor((lon + 180) / GRID_CELL_DEGREES)) % GRID_COLUMNS
+    return f'{row}:{column}'
+
+def geo_fields(fixed_lat, fixed_lon):
+    """Numeric latitude/longitude and grid cell for the fixed_lat/fixed_lon strings (all None unless both parse)"""
+    lat = parse_coordinate(fixed_lat, 90)
+    lon = parse_coordinate(fixed_lon, 180)
+    if lat is None or lon is None:
+        return {'latitude': None, 'longitude': None, 'geo_cell': None}
+    return point_fields(lat, lon)
+
+def point_fields(lat, lon):
+    return {'latitude': lat, 'longitude': lon, 'geo_cell': grid_cell(lat, lon)}
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in km"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def cells_within(lat, lon, radius_km):
+    """Keys of every grid cell that may hold points within radius_km of (lat, lon)"""
+    lat_span = radius_km / KM_PER_DEGREE
+    min_lat = max(-90.0, lat - lat_span)
+    max_lat = min(90.0, lat + lat_span)
+
+    # Longitude degrees shrink towards the poles, so size the span for the widest latitude
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if cos_lat * 180 * KM_PER_DEGREE <= radius_km:
+        columns = range(GRID_COLUMNS)
+    else:
+        lon_span = radius_km / (KM_PER_DEGREE * cos_lat)
+        first = int(math.floor((lon - lon_span + 180) / GRID_CELL_DEGREES))
+        last = int(math.floor((lon + lon_span + 180) / GRID_CELL_DEGREES))
+        columns = sorted({column % GRID_COLUMNS for column in range(first, last + 1)})
+
+    first_row = int(math.floor((min_lat + 90) / GRID_CELL_DEGREES))
+    last_row = int(math.floor((max_lat + 90) / GRID_CELL_DEGREES))
+    return [f'{row}:{column}' for row in range(first_row, last_row + 1) for column in columns]
+
+class GeoIndex:
+    """In-memory grid of points; radius lookups probe the neighbouring cells instead of every point"""
+
+    def __init__(self):
+        self._cells = defaultdict(list)
+        self.size = 0
+
+    def add(self, lat, lon, item):
+        self._cells[grid_cell(lat, lon)].append((lat, lon, item))
+        self.size += 1
+
+    def within(self, lat, lon, radius_km):
+        """Return [(distance_km, item)] for the points within radius_km, nearest first"""
+        found = []
+        for cell in cells_within(lat, lon, radius_km):
+            for point_lat, point_lon, item in self._cells.get(cell, ()):
+                distance = haversine_km(lat, lon, point_lat, point_lon)
+                if distance <= radius_km:
+                    found.append((distance, item))
+        found.sort(key=lambda pair: pair[0])
+        return found
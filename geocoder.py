@@ -0,0 +1,85 @@
+import os
+import re
+import csv
+from functools import lru_cache
+
+from geo import haversine_km
+
+# Bundled list of Australian cities and suburbs (approximate centroids)
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'au_gazetteer.csv')
+
+STATES = {
+    'nsw': 'NSW', 'new south wales': 'NSW', 'vic': 'VIC', 'victoria': 'VIC',
+    'qld': 'QLD', 'queensland': 'QLD', 'wa': 'WA', 'western australia': 'WA',
+    'sa': 'SA', 'south australia': 'SA', 'tas': 'TAS', 'tasmania': 'TAS',
+    'act': 'ACT', 'australian capital territory': 'ACT', 'nt': 'NT', 'northern territory': 'NT'
+}
+_STATE_SUFFIXES = sorted(STATES, key=len, reverse=True)
+
+def _split_state(name):
+    for state_name in _STATE_SUFFIXES:
+        if name.endswith(' ' + state_name):
+            return name[:-len(state_name) - 1].strip(), STATES[state_name]
+    return name, None
+
+def normalize_place(text):
+    """Split free text like 'Richmond, VIC 3121' into ('richmond', 'VIC')"""
+    name = re.sub(r'[^a-z ]+', ' ', (text or '').lower())
+    name = re.sub(r'\s+', ' ', name).strip()
+
+    name, state = _split_state(name)
+    if state is None and name.endswith(' australia'):
+        name, state = _split_state(name[:-len(' australia')].strip())
+    return name, state
+
+def cache_key(location, suburb):
+    """Key identifying a (location, suburb) lookup, used by the GeocodeCache table"""
+    location_name, location_state = normalize_place(location)
+    suburb_name, suburb_state = normalize_place(suburb)
+    return f"{suburb_name}|{suburb_state or ''}|{location_name}|{location_state or ''}"[:255]
+
+class Gazetteer:
+    """Normalized place name -> ((state, kind, lat, lon), ...) with dictionary lookups only"""
+
+    def __init__(self, rows):
+        places = {}
+        for name, state, kind, lat, lon in rows:
+            places.setdefault(normalize_place(name)[0], []).append((state, kind, float(lat), float(lon)))
+        # Cities first, so a bare name prefers the city over a same-named suburb
+        self._places = {name: tuple(sorted(entries, key=lambda entry: entry[1] != 'city'))
+                        for name, entries in places.items()}
+
+    @classmethod
+    def from_csv(cls, path=GAZETTEER_PATH):
+        with open(path, newline='', encoding='utf-8') as gazetteer_file:
+            reader = csv.DictReader(gazetteer_file)
+            return cls([(row['name'], row['state'], row['kind'], row['lat'], row['lon']) for row in reader])
+
+    def _candidates(self, text):
+        name, state = normalize_place(text)
+        entries = self._places.get(name, ())
+        if state:
+            entries = tuple(entry for entry in entries if entry[0] == state) or entries
+        return entries
+
+    def lookup(self, location, suburb=None):
+        """Return (lat, lon) for a suburb within a location (city), falling back to the location, or None"""
+        cities = self._candidates(location)
+        city = cities[0] if cities else None
+
+        suburbs = self._candidates(suburb) if suburb else ()
+        if suburbs:
+            if city is not None and len(suburbs) > 1:
+                # Same-named suburbs in several states: take the one nearest the city
+                return min(((entry[2], entry[3]) for entry in suburbs),
+                           key=lambda point: haversine_km(city[2], city[3], point[0], point[1]))
+            return suburbs[0][2], suburbs[0][3]
+
+        if city is not None:
+            return city[2], city[3]
+        return None
+
+@lru_cache(maxsize=1)
+def default_gazetteer():
+    """The bundled gazetteer, loaded on first use"""
+    return Gazetteer.from_csv()
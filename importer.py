@@ -0,0 +1,482 @@
+import io
+import csv
+import secrets
+import sqlite3
+import zipfile
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import select, insert, update, delete
+
+from models import db, Preference, ProductPreference, WordSet, IPHONE_MODELS, DEFAULT_PRICES, locate_preferences
+from config import Config
+
+def parse_expiry_date(expiry_date_str):
+    """Parse an expiry date in YYYY-MM-DD or one of the common alternative formats"""
+    for date_format in ['%Y-%m-%d', '%d-%m-%Y', '%m-%d-%Y', '%Y/%m/%d', '%d/%m/%Y']:
+        try:
+            return datetime.strptime(expiry_date_str, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+def parse_user_row(unique_userid, user_row, product_rows, error_log, word_sets=None):
+    """Validate one imported user and its products.
+
+    Returns the preference fields plus a 'products' list, or None if the row
+    has to be rejected (the reason is appended to error_log). word_sets maps
+    'keyword'/'excluded' -> {file set_id: local WordSet id}; without it the
+    user's word sets are left as they are.
+    """
+    # Get basic user data
+    location = user_row.get('location', '').strip()
+    if not location:
+        error_log.append(f"Error: Missing location for {unique_userid}")
+        return None
+
+    # Parse notification mode flags
+    try:
+        mode_only_preferred = int(user_row.get('mode_only_preferred', 0))
+        non_good_deals = int(user_row.get('non_good_deals', 0))
+        good_deals = int(user_row.get('good_deals', 0))
+        near_good_deals = int(user_row.get('near_good_deals', 0))
+    except (ValueError, TypeError):
+        mode_only_preferred = 0
+        non_good_deals = 1
+        good_deals = 0
+        near_good_deals = 0
+        error_log.append(f"Warning: Invalid mode flags for {unique_userid}, defaulting to 'all'")
+
+    # Determine notification mode
+    if non_good_deals == 1 and mode_only_preferred == 0 and good_deals == 0 and near_good_deals == 0:
+        notification_mode = 'all'
+    elif mode_only_preferred == 1 and non_good_deals == 0 and good_deals == 0 and near_good_deals == 0:
+        notification_mode = 'only_preferred'
+    elif mode_only_preferred == 1 and non_good_deals == 0 and good_deals == 0 and near_good_deals == 1:
+        notification_mode = 'near_good_deal'
+    elif mode_only_preferred == 1 and non_good_deals == 0 and good_deals == 1 and near_good_deals == 1:
+        notification_mode = 'good_deal'
+    else:
+        notification_mode = 'all'  # Default
+        error_log.append(f"Warning: Ambiguous notification mode for {unique_userid}, defaulting to 'all'")
+
+    # Parse activation status with fallback
+    try:
+        activation_status = int(user_row.get('activation_status', 1)) == 1
+    except (ValueError, TypeError):
+        activation_status = True
+        error_log.append(f"Warning: Invalid activation_status for {unique_userid}, defaulting to active")
+
+    # Handle expiry date
+    expiry_date = None
+    expiry_date_str = user_row.get('expiry_date', '').strip()
+    if expiry_date_str:
+        expiry_date = parse_expiry_date(expiry_date_str)
+        if not expiry_date:
+            error_log.append(f"Warning: Invalid expiry date '{expiry_date_str}' for {unique_userid}")
+
+    fields = {
+        'location': location,
+        'suburb': user_row.get('suburb', '').strip(),
+        'notification_mode': notification_mode,
+        'unique_userid': unique_userid,
+        'user_id': user_row.get('user_id', '').strip(),
+        'user_name': user_row.get('user_name', '').strip(),
+        'activation_status': activation_status,
+        'expiry_date': expiry_date,
+        'fixed_lat': user_row.get('fixed_lat', '').strip(),
+        'fixed_lon': user_row.get('fixed_lon', '').strip(),
+        'products': parse_products(unique_userid, user_row, product_rows, error_log)
+    }
+
+    if word_sets is not None:
+        fields['keyword_set_id'] = resolve_word_set(
+            unique_userid, user_row.get('keyword_set_id', ''), word_sets['keyword'], error_log)
+        fields['excluded_set_id'] = resolve_word_set(
+            unique_userid, user_row.get('excluded_set_id', ''), word_sets['excluded'], error_log)
+
+    return fields
+
+def resolve_word_set(unique_userid, file_set_id, set_ids, error_log):
+    """Map a set_id from the import files to a local WordSet id (None means the default set)"""
+    file_set_id = (file_set_id or '').strip()
+    if not file_set_id:
+        return None
+    if file_set_id not in set_ids:
+        error_log.append(f"Warning: Unknown word set '{file_set_id}' for {unique_userid}, using the default")
+        return None
+    return set_ids[file_set_id]
+
+def load_word_sets(sets_stream, kind):
+    """Store the sets of a keyword_sets.csv/excluded_word_sets.csv file.
+
+    Returns file set_id -> local WordSet id. Sets are matched by content, so
+    importing an export back into the same database creates no new sets.
+    """
+    word_column = 'keyword' if kind == 'keyword' else 'excluded_word'
+    words_by_set = {}
+    for row in csv.DictReader(sets_stream):
+        set_id = (row.get('set_id') or '').strip()
+        if set_id:
+            words_by_set.setdefault(set_id, []).append(row.get(word_column) or '')
+
+    set_ids = {set_id: WordSet.get_or_create(kind, words).id for set_id, words in words_by_set.items()}
+    db.session.commit()
+    return set_ids
+
+def parse_products(unique_userid, user_row, product_rows, error_log):
+    """Collect (product_name, max_price, is_preferred) from products.csv rows and the combined users.csv format"""
+    products = []
+
+    # Add new products from products.csv
+    for product_row in product_rows:
+        try:
+            name = product_row.get('name', '').strip()
+            if name in IPHONE_MODELS:
+                try:
+                    max_price = int(float(product_row.get('max_price', 0)))
+                    preferred = int(float(product_row.get('preferred', 0))) == 1
+                except (ValueError, TypeError):
+                    max_price = DEFAULT_PRICES.get(name, 500)
+                    preferred = True
+                    error_log.append(f"Warning: Invalid price or preferred value for {name} ({unique_userid})")
+
+                products.append((name, max_price, preferred))
+            else:
+                error_log.append(f"Warning: Unknown product '{name}' for {unique_userid}")
+        except Exception as product_error:
+            error_log.append(f"Error adding product for {unique_userid}: {product_error}")
+
+    # Also check if products are in the combined format (in users.csv)
+    if 'products' in user_row and user_row['products']:
+        products_str = user_row['products'].strip()
+        for product_data in products_str.split(';'):
+            if product_data and ':' in product_data:
+                try:
+                    parts = product_data.split(':')
+                    if len(parts) >= 4:
+                        name = parts[0].strip()
+                        max_price = int(float(parts[2].strip() or '0'))
+                        preferred = int(float(parts[3].strip() or '0')) == 1
+
+                        if name in IPHONE_MODELS:
+                            products.append((name, max_price, preferred))
+                        else:
+                            error_log.append(f"Warning: Unknown product name '{name}' in combined format")
+                    else:
+                        error_log.append(f"Warning: Invalid product format: {product_data}")
+                except Exception as e:
+                    error_log.append(f"Error processing product: {product_data}, Error: {e}")
+
+    # If no products were found, add defaults
+    if not products:
+        error_log.append(f"No products found for {unique_userid}, adding defaults")
+        products = [(model, DEFAULT_PRICES.get(model, 500), True) for model in IPHONE_MODELS]
+
+    return products
+
+def _id_from_userid(unique_userid):
+    """Return the preference id encoded in a user_<id>/telegram_<id> identifier, if any"""
+    for prefix in ['user_', 'telegram_']:
+        if unique_userid.startswith(prefix):
+            try:
+                return int(unique_userid.split('_')[1])
+            except (ValueError, IndexError):
+                pass
+    return None
+
+def find_existing_preferences(unique_userids):
+    """Map unique_userid -> preference id for a batch of identifiers in at most two queries"""
+    matches = {}
+    rows = db.session.execute(
+        select(Preference.id, Preference.unique_userid)
+        .where(Preference.unique_userid.in_(unique_userids))
+        .order_by(Preference.id)
+    )
+    for pref_id, unique_userid in rows:
+        matches.setdefault(unique_userid, pref_id)
+
+    # If not found, try to match by ID pattern
+    candidates = {}
+    for unique_userid in unique_userids:
+        if unique_userid not in matches:
+            pref_id = _id_from_userid(unique_userid)
+            if pref_id is not None:
+                candidates[unique_userid] = pref_id
+
+    if candidates:
+        found = set(db.session.execute(
+            select(Preference.id).where(Preference.id.in_(set(candidates.values())))
+        ).scalars())
+        for unique_userid, pref_id in candidates.items():
+            if pref_id in found:
+                matches[unique_userid] = pref_id
+
+    return matches
+
+def import_batch(batch):
+    """Write a batch of parsed users with bulk statements and commit it.
+
+    Returns (added, updated). On failure nothing from the batch is kept.
+    """
+    existing = find_existing_preferences([fields['unique_userid'] for fields in batch])
+
+    # Bulk statements skip the flush listener, so resolve coordinates for the whole batch here
+    coordinates = locate_preferences([(fields['fixed_lat'], fields['fixed_lon'], fields['location'], fields['suburb'])
+                                      for fields in batch])
+    for fields, geo in zip(batch, coordinates):
+        fields.update(geo)
+
+    # Stamped after geocoding, just before the writes, so the batch commits soon after its updated_at
+    now = datetime.utcnow()
+
+    updates = []
+    inserts = []
+    products_by_pref = {}
+
+    for fields in batch:
+        values = {key: value for key, value in fields.items() if key != 'products'}
+        pref_id = existing.get(fields['unique_userid'])
+        if pref_id is not None:
+            updates.append(dict(values, id=pref_id, updated_at=now))
+            # A later row for the same preference replaces its products
+            products_by_pref[pref_id] = fields['products']
+        else:
+            inserts.append(dict(values, edit_token=secrets.token_urlsafe(32)))
+
+    if updates:
+        db.session.execute(update(Preference), updates)
+        db.session.execute(
+            delete(ProductPreference).where(ProductPreference.preference_id.in_(list(products_by_pref)))
+        )
+
+    if inserts:
+        new_ids = db.session.execute(
+            insert(Preference).returning(Preference.id, sort_by_parameter_order=True),
+            inserts
+        ).scalars().all()
+        for pref_id, fields in zip(new_ids, (f for f in batch if f['unique_userid'] not in existing)):
+            products_by_pref[pref_id] = fields['products']
+
+    product_rows = [
+        {'preference_id': pref_id, 'product_name': name, 'max_price': max_price, 'is_preferred': preferred}
+        for pref_id, products in products_by_pref.items()
+        for name, max_price, preferred in products
+    ]
+    if product_rows:
+        db.session.execute(insert(ProductPreference), product_rows)
+
+    db.session.commit()
+    return len(inserts), len(updates)
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def process_import_data(users_data, products_data, batch_size=None, progress=None, word_sets=None):
+    """Process imported user and product data.
+
+    users_data maps unique_userid -> users.csv row (any iterable of
+    (unique_userid, row) pairs works too) and products_data maps
+    unique_userid -> list of products.csv rows. Rows are validated one by
+    one, then written batch_size users at a time with bulk statements and one
+    commit per batch. If a batch fails it is retried row by row so the error
+    is reported against the user that caused it. word_sets is passed on to
+    parse_user_row().
+
+    progress, if given, is called as progress(rows_done, errors) after every batch.
+    """
+    batch_size = batch_size or Config.IMPORT_BATCH_SIZE
+    rows_done = 0
+    added = 0
+    updated = 0
+    errors = 0
+    error_log = []
+
+    if isinstance(users_data, dict):
+        users_data = users_data.items()
+
+    for rows in _batched(users_data, batch_size):
+        rows_done += len(rows)
+        batch = []
+        # The last row wins if a user appears twice in the same batch
+        for unique_userid, user_row in dict(rows).items():
+            # Skip empty rows
+            if not unique_userid:
+                continue
+
+            try:
+                fields = parse_user_row(unique_userid, user_row, products_data.get(unique_userid, []), error_log,
+                                        word_sets)
+            except Exception as e:
+                fields = None
+                error_log.append(f"Error processing {unique_userid}: {str(e)}")
+
+            if fields is None:
+                errors += 1
+                continue
+            batch.append(fields)
+
+        if batch:
+            try:
+                batch_added, batch_updated = import_batch(batch)
+                added += batch_added
+                updated += batch_updated
+            except Exception:
+                db.session.rollback()
+
+                # Retry the failed batch one user at a time
+                for fields in batch:
+                    try:
+                        row_added, row_updated = import_batch([fields])
+                        added += row_added
+                        updated += row_updated
+                    except Exception as e:
+                        db.session.rollback()
+                        errors += 1
+                        error_message = f"Error processing {fields['unique_userid']}: {str(e)}"
+                        error_log.append(error_message)
+                        print(error_message)
+
+        if progress:
+            progress(rows_done, errors)
+
+    # Create result
+    message = f'Import completed. Added: {added}, Updated: {updated}'
+    if errors > 0:
+        message += f', Errors: {errors}'
+        print("\n".join(error_log))
+        status = 'warning'
+    else:
+        status = 'success'
+
+    return {
+        'message': message,
+        'status': status,
+        'rows_done': rows_done,
+        'added': added,
+        'updated': updated,
+        'errors': errors,
+        'error_log': error_log
+    }
+
+class ProductStore:
+    """products.csv rows indexed by unique_userid in a temporary on-disk SQLite file.
+
+    Lets users.csv be streamed in batches without holding every product row in
+    memory, whatever order products.csv is in. Supports the dict-style get()
+    that process_import_data uses.
+    """
+
+    def __init__(self, products_stream=None, batch_size=None):
+        batch_size = batch_size or Config.IMPORT_BATCH_SIZE
+        # An empty filename gives a private temporary database that is deleted on close
+        self._conn = sqlite3.connect('')
+        self._conn.execute(
+            'CREATE TABLE products (unique_userid TEXT, name TEXT, max_price TEXT, preferred TEXT)'
+        )
+
+        if products_stream is not None:
+            rows = (
+                (row.get('unique_userid'), row.get('name'), row.get('max_price'), row.get('preferred'))
+                for row in csv.DictReader(products_stream)
+            )
+            for batch in _batched(rows, batch_size):
+                self._conn.executemany('INSERT INTO products VALUES (?, ?, ?, ?)', batch)
+
+        self._conn.execute('CREATE INDEX products_uid ON products (unique_userid)')
+
+    def get(self, unique_userid, default=None):
+        rows = self._conn.execute(
+            'SELECT name, max_price, preferred FROM products WHERE unique_userid = ? ORDER BY rowid',
+            (unique_userid,)
+        ).fetchall()
+        if not rows:
+            return default
+        return [{'name': name, 'max_price': max_price, 'preferred': preferred}
+                for name, max_price, preferred in rows]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _UploadStream(io.RawIOBase):
+    """Full io interface over a bare file-like object.
+
+    Werkzeug spools uploads to a SpooledTemporaryFile, which before Python
+    3.11 has read/seek/tell but no readable() or seekable(), so neither
+    io.TextIOWrapper nor zipfile accept it.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._stream.seek(offset, whence)
+
+    def tell(self):
+        return self._stream.tell()
+
+def _binary_file(stream):
+    """stream itself if it is a complete io object, otherwise a buffered adapter around it"""
+    if hasattr(stream, 'readable') and hasattr(stream, 'seekable'):
+        return stream
+    return io.BufferedReader(_UploadStream(stream))
+
+def _csv_text(binary_stream):
+    return io.TextIOWrapper(_binary_file(binary_stream), encoding='utf-8-sig', newline='')
+
+def import_csv_streams(users_stream, products_stream=None, batch_size=None, progress=None):
+    """Import users.csv (and optionally products.csv) from binary streams, batch_size users at a time"""
+    products_text = _csv_text(products_stream) if products_stream is not None else None
+    with ProductStore(products_text, batch_size) as products:
+        users = ((row['unique_userid'], row) for row in csv.DictReader(_csv_text(users_stream)))
+        return process_import_data(users, products, batch_size, progress)
+
+def import_zip_stream(zip_stream, batch_size=None, progress=None):
+    """Import an export ZIP straight from a seekable stream (e.g. an uploaded file)"""
+    with zipfile.ZipFile(_binary_file(zip_stream), 'r') as zip_ref:
+        names = zip_ref.namelist()
+
+        # Word sets are referenced by users.csv, so store them first
+        word_sets = None
+        if 'keyword_sets.csv' in names or 'excluded_word_sets.csv' in names:
+            word_sets = {'keyword': {}, 'excluded': {}}
+            for filename, kind in [('keyword_sets.csv', 'keyword'), ('excluded_word_sets.csv', 'excluded')]:
+                if filename in names:
+                    with zip_ref.open(filename) as sets_member:
+                        word_sets[kind] = load_word_sets(_csv_text(sets_member), kind)
+
+        # Stage products first so users.csv can be streamed against them
+        products_member = zip_ref.open('products.csv') if 'products.csv' in names else None
+        try:
+            with ProductStore(_csv_text(products_member) if products_member else None, batch_size) as products:
+                if 'users.csv' not in names:
+                    return process_import_data({}, products, batch_size, progress, word_sets)
+
+                with zip_ref.open('users.csv') as users_member:
+                    users = ((row['unique_userid'], row) for row in csv.DictReader(_csv_text(users_member)))
+                    return process_import_data(users, products, batch_size, progress, word_sets)
+        finally:
+            if products_member:
+                products_member.close()
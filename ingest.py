@@ -0,0 +1,362 @@
+import re
+import sys
+import json
+import queue
+import signal
+import logging
+import argparse
+import threading
+import time
+from contextlib import nullcontext
+
+from models import IPHONE_MODELS, WordSet
+from config import Config
+from classifier import TitleClassifier, tokenize
+from matching import load_match_index
+from subscriber_index import MappedSubscriberIndex
+from word_filters import load_word_filters
+from dedup import listing_fingerprint, open_dedup_store
+from resellers import ResellerDetector
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream on a stage queue
+_DONE = object()
+
+PRICE_PATTERN = re.compile(r'[0-9][0-9,]*(\.[0-9]+)?')
+
+class StageStats:
+    """Counters for one pipeline stage; busy time excludes waiting on its queues"""
+
+    def __init__(self, name):
+        self.name = name
+        self.received = 0
+        self.emitted = 0
+        self.waiting = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def busy(self):
+        return max(self.elapsed - self.waiting, 0.0)
+
+    @property
+    def throughput(self):
+        return self.received / self.busy if self.busy else 0.0
+
+    def __str__(self):
+        return (f"{self.name:<10} in {self.received:>9}  out {self.emitted:>9}  "
+                f"busy {self.busy:8.3f}s  {self.throughput:12,.0f}/s")
+
+def parse_price(value):
+    """Listing price as an int, from numbers or text like '$1,200'; None if there isn't one"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = PRICE_PATTERN.search(str(value or ''))
+    if match is None:
+        return None
+    return int(float(match.group(0).replace(',', '')))
+
+def normalize(lines):
+    """JSON Lines -> listing dicts with title, price and location; malformed lines are dropped"""
+    for line in lines:
+        try:
+            raw = json.loads(line)
+        except ValueError:
+            logger.debug(f"Skipping invalid JSON: {line[:80]!r}")
+            continue
+        if not isinstance(raw, dict):
+            continue
+        title = str(raw.get('title') or '').strip()
+        price = parse_price(raw.get('price'))
+        location = str(raw.get('location') or '').strip()
+        if not title or price is None or not location:
+            continue
+        yield {'id': raw.get('id'), 'title': title, 'price': price, 'location': location,
+               'url': raw.get('url'), 'description': str(raw.get('description') or ''),
+               'seller': raw.get('seller'), 'tokens': tokenize(title)}
+
+def filter_spam(detector):
+    """Stage dropping reposts of recent listings and listings from sellers flagged as resellers"""
+    def stage(listings):
+        for listing in listings:
+            key = listing['id'] if listing['id'] is not None else listing['url'] or listing_fingerprint(
+                listing['title'], listing['price'], listing['location'])
+            original, is_reseller = detector.check(key, listing['title'], listing['description'],
+                                                   listing['location'], listing['price'], listing['seller'])
+            if original is None and not is_reseller:
+                yield listing
+    return stage
+
+def classify(classifier):
+    """Stage adding the IPHONE_MODELS name to each listing; listings that aren't an iPhone are dropped"""
+    def stage(listings):
+        for listing in listings:
+            model, _ = classifier.scan_tokens(listing['tokens'])
+            if model is not None:
+                listing['model'] = model
+                yield listing
+    return stage
+
+def filter_exclusions(common_filter):
+    """Stage dropping listings that contain a word every excluded word set rejects.
+
+    Each subscriber's own word sets are still applied after matching; this
+    only discards listings that could not reach anyone before they are matched.
+    """
+    def stage(listings):
+        for listing in listings:
+            if common_filter is None or common_filter.scan_tokens(listing['tokens'])[1] is None:
+                yield listing
+    return stage
+
+def match(index, word_filters):
+    """Stage pairing each listing with its recipients after their keyword/excluded-word filters"""
+    def stage(listings):
+        for listing in listings:
+            recipients = index.match(listing['model'], listing['price'], listing['location'])
+            recipients = word_filters.filter_recipients(listing['title'], recipients)
+            if recipients:
+                yield listing, recipients
+    return stage
+
+class DedupSaver:
+    """Saves a dedup store to path every `every` listings or `interval` seconds, whichever comes first.
+
+    The dedup stage updates the store while holding lock, so save_now() can
+    be called from another thread, e.g. the SIGTERM handler.
+    """
+
+    def __init__(self, store, path, every=None, interval=None, clock=time.monotonic):
+        self.store = store
+        self.path = path
+        self.every = every or Config.DEDUP_SAVE_EVERY
+        self.interval = Config.DEDUP_SAVE_INTERVAL if interval is None else interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.saves = 0
+        self._unsaved = 0
+        self._saved_at = clock()
+
+    def changed(self):
+        """Count one deduplicated listing and save if one is due; call with lock held"""
+        self._unsaved += 1
+        if self._unsaved >= self.every or self.clock() - self._saved_at >= self.interval:
+            self._save()
+
+    def save_now(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.store.save(self.path)
+        self.saves += 1
+        self._unsaved = 0
+        self._saved_at = self.clock()
+
+def deduplicate(store, saver=None):
+    """Stage dropping recipients already notified about the same listing within the store's TTL"""
+    lock = saver.lock if saver is not None else nullcontext()
+
+    def stage(matches):
+        for listing, recipients in matches:
+            fingerprint = listing_fingerprint(listing['title'], listing['price'], listing['location'])
+            with lock:
+                recipients = [subscriber for subscriber in recipients
+                              if not store.check_and_add(fingerprint, subscriber.preference_id)]
+                if saver is not None:
+                    saver.changed()
+            if recipients:
+                yield listing, recipients
+    return stage
+
+def emit(matches):
+    """Notification jobs as JSON lines, one per recipient"""
+    # The JSON for each subscriber's fields is built once and reused for every listing they match
+    prefixes = {}
+    for listing, recipients in matches:
+        message = f"{listing['model']} for ${listing['price']} in {listing['location']}\n{listing['title']}"
+        if listing['url']:
+            message += f"\n{listing['url']}"
+        suffix = f'"listing_id": {json.dumps(listing["id"])}, "message": {json.dumps(message)}}}'
+        for subscriber in recipients:
+            prefix = prefixes.get(subscriber.preference_id)
+            if prefix is None:
+                prefix = prefixes[subscriber.preference_id] = json.dumps({
+                    'user_id': subscriber.user_id,
+                    'unique_userid': subscriber.unique_userid,
+                    'preference_id': subscriber.preference_id,
+                    'notification_mode': subscriber.notification_mode,
+                })[:-1] + ', '
+            yield prefix + suffix
+
+def common_excluded_filter(word_sets):
+    """Filter for the words found in every excluded word set, or None if there are none"""
+    excluded_sets = [set(word_set.word_list) for word_set in word_sets if word_set.kind == 'excluded']
+    common_words = set.intersection(*excluded_sets) if excluded_sets else set()
+    if not common_words:
+        return None
+    return TitleClassifier([], sorted(common_words))
+
+def _drain(inbox, stats):
+    while True:
+        start = time.perf_counter()
+        item = inbox.get()
+        stats.waiting += time.perf_counter() - start
+        if item is _DONE:
+            return
+        stats.received += 1
+        yield item
+
+def _run_stage(function, inbox, outbox, stats, errors):
+    start = time.perf_counter()
+    try:
+        for item in function(_drain(inbox, stats)):
+            put_start = time.perf_counter()
+            outbox.put(item)
+            stats.waiting += time.perf_counter() - put_start
+            stats.emitted += 1
+    except Exception as error:
+        logger.exception(f"Stage {stats.name} failed")
+        errors.append(error)
+        # Keep consuming so upstream stages never block on a full queue
+        for _ in _drain(inbox, stats):
+            pass
+    finally:
+        stats.elapsed = time.perf_counter() - start
+        outbox.put(_DONE)
+
+def _feed(lines, outbox, errors):
+    try:
+        for line in lines:
+            if line.strip():
+                outbox.put(line)
+    except Exception as error:
+        logger.exception("Reading input failed")
+        errors.append(error)
+    finally:
+        outbox.put(_DONE)
+
+def run_pipeline(lines, stages, output, queue_size):
+    """Run lines through (name, generator function) stages, each on its own thread.
+
+    Stages are connected by queues holding at most queue_size items, so a
+    slow stage applies backpressure upstream and memory stays flat however
+    long the input is. Items leaving the last stage are written to output,
+    one per line. Returns the StageStats of every stage.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stats = [StageStats(name) for name, _ in stages]
+    errors = []
+
+    threads = [threading.Thread(target=_feed, args=(lines, queues[0], errors), daemon=True)]
+    for position, (_, function) in enumerate(stages):
+        threads.append(threading.Thread(
+            target=_run_stage, args=(function, queues[position], queues[position + 1], stats[position], errors),
+            daemon=True
+        ))
+    for thread in threads:
+        thread.start()
+
+    for item in _drain(queues[-1], StageStats('output')):
+        output.write(item + '\n')
+    output.flush()
+
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return stats
+
+def build_stages(index, word_filters, word_sets, dedup_store=None, detector=None, dedup_saver=None):
+    stages = [('normalize', normalize)]
+    if detector is not None:
+        stages.append(('spam', filter_spam(detector)))
+    stages += [
+        ('classify', classify(TitleClassifier(IPHONE_MODELS))),
+        ('exclusions', filter_exclusions(common_excluded_filter(word_sets))),
+        ('match', match(index, word_filters)),
+    ]
+    if dedup_store is not None:
+        stages.append(('dedup', deduplicate(dedup_store, dedup_saver)))
+    stages.append(('emit', emit))
+    return stages
+
+def save_on_sigterm(saver):
+    """SIGTERM handler saving the dedup store before exiting, so a stopped stream keeps what it sent"""
+    def handler(signum, frame):
+        saver.save_now()
+        logger.warning(f"Stopped by signal {signum}; dedup store saved to {saver.path}")
+        sys.exit(128 + signum)
+    return handler
+
+def main(argv=None):
+    """Read listings as JSON Lines and write one notification job per matching subscriber."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('input', nargs='?', default='-', help='JSON Lines file of listings (default: stdin)')
+    parser.add_argument('-o', '--output', default='-', help='File for the notification jobs (default: stdout)')
+    parser.add_argument('--index', help='Subscriber index file from `flask write-subscriber-index` '
+                                        'instead of loading subscribers from the database')
+    parser.add_argument('--queue-size', type=int, default=1000, help='Items buffered between stages')
+    parser.add_argument('--dedup-mode', choices=['lru', 'bloom', 'off'], default=Config.DEDUP_MODE,
+                        help='How already notified (listing, subscriber) pairs are remembered')
+    parser.add_argument('--keep-spam', action='store_true',
+                        help='Keep reposts and reseller listings instead of dropping them')
+    parser.add_argument('--dedup-state', default=Config.DEDUP_STATE_PATH,
+                        help='File the dedup store is loaded from and saved to')
+    parser.add_argument('--dedup-save-every', type=int, default=Config.DEDUP_SAVE_EVERY,
+                        help='Deduplicated listings between saves of the dedup store')
+    parser.add_argument('--dedup-save-interval', type=float, default=Config.DEDUP_SAVE_INTERVAL,
+                        help='Seconds between saves of the dedup store')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO,
+                        stream=sys.stderr)
+
+    # Imported here so --help works without touching the database
+    from app_fix import app
+
+    with app.app_context():
+        index = MappedSubscriberIndex.open(args.index) if args.index else load_match_index(Config.EXPORT_BATCH_SIZE)
+        word_filters = load_word_filters()
+        word_sets = WordSet.query.all()
+
+    detector = None if args.keep_spam else ResellerDetector()
+    dedup_store = dedup_saver = None
+    if args.dedup_mode != 'off':
+        dedup_store = open_dedup_store(args.dedup_state, args.dedup_mode)
+        dedup_saver = DedupSaver(dedup_store, args.dedup_state, args.dedup_save_every, args.dedup_save_interval)
+        signal.signal(signal.SIGTERM, save_on_sigterm(dedup_saver))
+
+    lines = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    start = time.perf_counter()
+    try:
+        stages = build_stages(index, word_filters, word_sets, dedup_store, detector, dedup_saver)
+        stats = run_pipeline(lines, stages, output, args.queue_size)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    # Periodic saves only cover listings that were past the dedup stage, so a failed run suppresses
+    # at most the jobs that were still queued for output; the final save waits for a complete run
+    if dedup_saver is not None:
+        dedup_saver.save_now()
+
+    for stage_stats in stats:
+        print(stage_stats, file=sys.stderr)
+    if detector is not None:
+        print(f"spam: {detector.stats.as_dict()}, {len(detector.flagged)} resellers flagged", file=sys.stderr)
+    if dedup_store is not None:
+        print(f"dedup ({dedup_store.mode}): {dedup_store.stats.as_dict()}, {len(dedup_store)} pairs kept",
+              file=sys.stderr)
+    listings = stats[0].received
+    print(f"{listings} listings -> {stats[-1].emitted} jobs in {elapsed:.2f}s "
+          f"({listings / elapsed if elapsed else 0:,.0f} listings/s)", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import os
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import update
+
+from models import db, Job
+from config import Config
+from parallel_export import stream_full_export_zip
+from importer import import_csv_streams, import_zip_stream
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# One pool per web worker process, created on first use so forked workers get their own
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.JOB_WORKERS, thread_name_prefix='job')
+        return _executor
+
+def job_dir(job_id):
+    """Directory holding a job's uploaded files and generated artifact"""
+    path = os.path.join(Config.JOB_STORAGE_DIR, job_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _update_job(job_id, **values):
+    """Write job state on its own connection so it never touches the job's session or open cursors"""
+    with db.engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(**values))
+
+def create_job(kind):
+    """Record a new queued job; files it needs can be saved to job_dir(job.id) before start_job()"""
+    job = Job(id=uuid.uuid4().hex, kind=kind, status='queued')
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def start_job(job_id, target, *args):
+    """Run target(job_id, progress, *args) on the job pool.
+
+    target returns a dict of final Job column values; progress(rows_done, errors=0)
+    can be called at any time to publish progress for polling.
+    """
+    app = current_app._get_current_object()
+    _get_executor().submit(_run_job, app, job_id, target, args)
+
+def _run_job(app, job_id, target, args):
+    with app.app_context():
+        _update_job(job_id, status='running')
+
+        def progress(rows_done, errors=0):
+            _update_job(job_id, rows_done=rows_done, errors=errors)
+
+        try:
+            values = target(job_id, progress, *args) or {}
+            _update_job(job_id, status='finished', finished_at=datetime.utcnow(), **values)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed")
+            db.session.rollback()
+            _update_job(job_id, status='failed', message=f'Job failed: {str(e)}', finished_at=datetime.utcnow())
+        finally:
+            db.session.remove()
+
+def run_import(job_id, progress, users_path, products_path=None):
+    """Import a saved upload (export ZIP, users.csv, or users.csv + products.csv)"""
+    if users_path.endswith('.zip'):
+        with open(users_path, 'rb') as zip_file:
+            result = import_zip_stream(zip_file, progress=progress)
+    else:
+        products_file = open(products_path, 'rb') if products_path else None
+        try:
+            with open(users_path, 'rb') as users_file:
+                result = import_csv_streams(users_file, products_file, progress=progress)
+        finally:
+            if products_file:
+                products_file.close()
+
+    return {
+        'rows_done': result['rows_done'],
+        'errors': result['errors'],
+        'message': result['message'],
+        'error_log': "\n".join(result['error_log'])
+    }
+
+def run_export(job_id, progress):
+    """Write the full export ZIP into the job directory"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    result_path = os.path.join(job_dir(job_id), 'export.zip')
+
+    rows_written = 0
+
+    def count_rows(rows_done):
+        nonlocal rows_written
+        rows_written = rows_done
+        progress(rows_done)
+
+    with open(result_path, 'wb') as output:
+        chunks = stream_full_export_zip(Config.EXPORT_BATCH_SIZE, Config.EXPORT_SHARD_SIZE, Config.EXPORT_WORKERS,
+                                        progress=count_rows)
+        for chunk in chunks:
+            output.write(chunk)
+
+    return {
+        'rows_done': rows_written,
+        'message': f'Export completed. Rows written: {rows_written}',
+        'result_path': result_path,
+        'result_name': f'iphone_flippers_data_{timestamp}.zip'
+    }
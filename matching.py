@@ -0,0 +1,257 @@
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import date
+
+from models import Preference
+from exports import iter_preferences
+from geo import GeoIndex
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Near Good Deal: preferred models priced within $100 above the user's maximum budget
+NEAR_GOOD_DEAL_MARGIN = 100
+
+def normalize_location(location):
+    """Locations are compared case-insensitively, ignoring surrounding whitespace"""
+    return (location or '').strip().lower()
+
+def price_threshold(notification_mode, max_price):
+    """Highest listing price a subscriber still wants for one preferred model, or None if never matched"""
+    if notification_mode == 'only_preferred':
+        return float('inf')
+    if notification_mode == 'near_good_deal':
+        return max_price + NEAR_GOOD_DEAL_MARGIN
+    if notification_mode == 'good_deal':
+        return max_price
+    return None
+
+class Subscriber:
+    """The parts of a preference needed to deliver a notification"""
+    __slots__ = ('preference_id', 'unique_userid', 'user_id', 'user_name', 'notification_mode',
+                 'keyword_set_id', 'excluded_set_id')
+
+    def __init__(self, preference_id, unique_userid, user_id, user_name, notification_mode,
+                 keyword_set_id=None, excluded_set_id=None):
+        self.preference_id = preference_id
+        self.unique_userid = unique_userid
+        self.user_id = user_id
+        self.user_name = user_name
+        self.notification_mode = notification_mode
+        self.keyword_set_id = keyword_set_id      # None means the default set
+        self.excluded_set_id = excluded_set_id
+
+    @classmethod
+    def from_preference(cls, pref):
+        return cls(pref.id, pref.get_unique_userid(), pref.user_id, pref.user_name, pref.notification_mode,
+                   pref.keyword_set_id, pref.excluded_set_id)
+
+    def __repr__(self):
+        return f'<Subscriber {self.unique_userid} ({self.notification_mode})>'
+
+def _id_position(subscribers, preference_id, low, high):
+    """First position in subscribers[low:high], which is sorted by preference id, whose id is >= preference_id"""
+    while low < high:
+        middle = (low + high) // 2
+        if subscribers[middle].preference_id < preference_id:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+class MatchIndex:
+    """Inverted index answering "who should be notified about this listing?".
+
+    'all' subscribers are kept in one list per location. Everyone else is
+    indexed under (location, product_name) for each preferred model, in a
+    list sorted by the highest price they accept (see price_threshold()).
+    A listing then matches the tail of that list from bisect_left(price)
+    onwards, so a lookup is a binary search rather than a scan.
+    """
+
+    def __init__(self):
+        self._everything = defaultdict(list)   # location -> [Subscriber]
+        self._by_product = {}                  # (location, product_name) -> ([threshold], [Subscriber])
+        self.subscriber_count = 0
+
+    @staticmethod
+    def _thresholds(pref):
+        """Highest accepted price per preferred model; a model listed twice keeps its most generous threshold"""
+        thresholds = {}
+        for product in pref.products:
+            if not product.is_preferred:
+                continue
+            threshold = price_threshold(pref.notification_mode, product.max_price)
+            if threshold is not None and threshold > thresholds.get(product.product_name, float('-inf')):
+                thresholds[product.product_name] = threshold
+        return thresholds
+
+    @classmethod
+    def build(cls, preferences):
+        """Build the index from preferences with their products loaded"""
+        index = cls()
+        entries = defaultdict(list)
+
+        for pref in preferences:
+            location = normalize_location(pref.location)
+            subscriber = Subscriber.from_preference(pref)
+            index.subscriber_count += 1
+
+            if pref.notification_mode == 'all':
+                index._everything[location].append(subscriber)
+                continue
+
+            for product_name, threshold in cls._thresholds(pref).items():
+                entries[(location, product_name)].append((threshold, pref.id, subscriber))
+
+        for key, rows in entries.items():
+            rows.sort(key=lambda row: (row[0], row[1]))
+            index._by_product[key] = ([row[0] for row in rows], [row[2] for row in rows])
+
+        return index
+
+    def updated(self, removed, added):
+        """A new index with the removed preferences taken out and the added ones put in.
+
+        removed must be the preferences as they were indexed; a changed
+        preference goes in both. Each list a change touches is copied once
+        and edited with binary searches, and self is left untouched, so the
+        cost follows the changes rather than the subscriber count and
+        readers of the old index are never disturbed. The result equals
+        build() over the new set of preferences fed in id order.
+        """
+        index = MatchIndex()
+        index._everything = defaultdict(list, self._everything)
+        index._by_product = dict(self._by_product)
+        index.subscriber_count = self.subscriber_count
+        # Lists already copied for this update
+        copied_locations = set()
+        copied_products = set()
+
+        def everything_list(location):
+            if location not in copied_locations:
+                copied_locations.add(location)
+                index._everything[location] = list(self._everything.get(location, ()))
+            return index._everything[location]
+
+        def product_lists(key):
+            if key not in copied_products:
+                copied_products.add(key)
+                thresholds, subscribers = self._by_product.get(key, ((), ()))
+                index._by_product[key] = (list(thresholds), list(subscribers))
+            return index._by_product[key]
+
+        for pref in removed:
+            index.subscriber_count -= 1
+            location = normalize_location(pref.location)
+            if pref.notification_mode == 'all':
+                subscribers = everything_list(location)
+                position = _id_position(subscribers, pref.id, 0, len(subscribers))
+                if position < len(subscribers) and subscribers[position].preference_id == pref.id:
+                    del subscribers[position]
+                continue
+
+            for product_name, threshold in self._thresholds(pref).items():
+                thresholds, subscribers = product_lists((location, product_name))
+                position = _id_position(subscribers, pref.id, bisect_left(thresholds, threshold),
+                                        bisect_right(thresholds, threshold))
+                if position < len(subscribers) and subscribers[position].preference_id == pref.id:
+                    del thresholds[position]
+                    del subscribers[position]
+
+        for pref in added:
+            index.subscriber_count += 1
+            location = normalize_location(pref.location)
+            subscriber = Subscriber.from_preference(pref)
+            if pref.notification_mode == 'all':
+                subscribers = everything_list(location)
+                subscribers.insert(_id_position(subscribers, pref.id, 0, len(subscribers)), subscriber)
+                continue
+
+            for product_name, threshold in self._thresholds(pref).items():
+                thresholds, subscribers = product_lists((location, product_name))
+                position = _id_position(subscribers, pref.id, bisect_left(thresholds, threshold),
+                                        bisect_right(thresholds, threshold))
+                thresholds.insert(position, threshold)
+                subscribers.insert(position, subscriber)
+
+        # Lists emptied by removals go, as build() never creates them
+        for location in copied_locations:
+            if not index._everything[location]:
+                del index._everything[location]
+        for key in copied_products:
+            if not index._by_product[key][1]:
+                del index._by_product[key]
+
+        return index
+
+    def match(self, product_name, price, location):
+        """Return the subscribers to notify about a listing, 'all' subscribers first"""
+        location = normalize_location(location)
+        recipients = list(self._everything.get(location, ()))
+
+        indexed = self._by_product.get((location, product_name))
+        if indexed is not None:
+            thresholds, subscribers = indexed
+            recipients.extend(subscribers[bisect_left(thresholds, price):])
+
+        return recipients
+
+class IdMatchIndex:
+    """A MatchIndex reduced to arrays of preference ids, for matchers that only pass ids on.
+
+    match_into() appends a listing's recipients, in MatchIndex.match()
+    order, with two array copies rather than one Python object per
+    recipient, and the arrays copy between processes as plain buffers.
+    """
+
+    def __init__(self, index):
+        self.subscriber_count = index.subscriber_count
+        self._everything = {location: array('q', [subscriber.preference_id for subscriber in subscribers])
+                            for location, subscribers in index._everything.items()}
+        self._by_product = {key: (thresholds, array('q', [subscriber.preference_id for subscriber in subscribers]))
+                            for key, (thresholds, subscribers) in index._by_product.items()}
+
+    def match_into(self, ids, product_name, price, location):
+        """Append the preference ids to notify about a listing to the array('q') ids"""
+        location = normalize_location(location)
+        everyone = self._everything.get(location)
+        if everyone is not None:
+            ids.extend(everyone)
+
+        indexed = self._by_product.get((location, product_name))
+        if indexed is not None:
+            thresholds, subscribers = indexed
+            ids.extend(subscribers[bisect_left(thresholds, price):])
+
+def active_conditions(today=None):
+    """WHERE conditions for preferences that should receive notifications: active and not past their expiry date"""
+    today = today or date.today()
+    return (
+        Preference.activation_status.isnot(False),
+        (Preference.expiry_date.is_(None)) | (Preference.expiry_date >= today)
+    )
+
+def active_preferences_query(today=None):
+    return Preference.query.filter(*active_conditions(today))
+
+def load_match_index(batch_size, today=None):
+    """Build a MatchIndex from the database, batch_size preferences at a time"""
+    index = MatchIndex.build(iter_preferences(active_preferences_query(today), batch_size))
+    logger.info(f"Built match index for {index.subscriber_count} subscribers")
+    return index
+
+def load_geo_index(batch_size, today=None):
+    """Build a GeoIndex of the active subscribers that have coordinates.
+
+    within(lat, lon, radius_km) on the result returns (distance_km, Subscriber)
+    pairs for the subscribers near a listing, nearest first.
+    """
+    index = GeoIndex()
+    query = active_preferences_query(today).filter(Preference.latitude.isnot(None))
+    for pref in iter_preferences(query, batch_size, with_products=False):
+        index.add(pref.latitude, pref.longitude, Subscriber.from_preference(pref))
+    logger.info(f"Built geo index for {index.size} subscribers")
+    return index
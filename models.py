@@ -1,9 +1,15 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, select, update, bindparam
+from sqlalchemy.orm import Session
 import secrets
+import hashlib
 import datetime
 
+from geo import geo_fields, point_fields
+from geocoder import cache_key, default_gazetteer
+
 db = SQLAlchemy()
 
 class User(UserMixin, db.Model):
@@ -32,6 +38,17 @@ class Preference(db.Model):
     fixed_lat = db.Column(db.String(20), nullable=True)
     fixed_lon = db.Column(db.String(20), nullable=True)
     
+    # Numeric copies of fixed_lat/fixed_lon and their grid cell (see geo.py), kept in sync on flush
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geo_cell = db.Column(db.String(16), nullable=True, index=True)
+    
+    # Shared keyword/excluded word sets (NULL means the default set)
+    keyword_set_id = db.Column(db.Integer, db.ForeignKey('word_set.id'), nullable=True)
+    excluded_set_id = db.Column(db.Integer, db.ForeignKey('word_set.id'), nullable=True)
+    keyword_set = db.relationship('WordSet', foreign_keys=[keyword_set_id])
+    excluded_set = db.relationship('WordSet', foreign_keys=[excluded_set_id])
+    
     # Relationship with product preferences
     products = db.relationship('ProductPreference', backref='preference', lazy=True, cascade="all, delete-orphan")
     
@@ -40,7 +57,7 @@ class Preference(db.Model):
     
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
     
     def __init__(self, **kwargs):
         super(Preference, self).__init__(**kwargs)
@@ -89,6 +106,158 @@ class ProductPreference(db.Model):
             'is_preferred': self.is_preferred
         }
 
+class WordSet(db.Model):
+    """Shared, immutable list of keywords or excluded words that preferences reference.
+    
+    Sets are deduplicated by content: changing a user's words means pointing
+    them at another set (a new version is created if no identical set exists).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'keyword' or 'excluded'
+    version = db.Column(db.Integer, nullable=False)
+    checksum = db.Column(db.String(40), nullable=False, index=True)
+    words = db.Column(db.Text, nullable=False, default='')  # One word per line
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    @property
+    def word_list(self):
+        return self.words.split('\n') if self.words else []
+    
+    @staticmethod
+    def make_checksum(kind, words):
+        return hashlib.sha1('\n'.join([kind] + list(words)).encode('utf-8')).hexdigest()
+    
+    @classmethod
+    def get_or_create(cls, kind, words):
+        """Return the set of this kind with exactly these words, adding a new version if needed (flushes, doesn't commit)"""
+        words = [word.strip() for word in words if word and word.strip()]
+        checksum = cls.make_checksum(kind, words)
+        
+        word_set = cls.query.filter_by(kind=kind, checksum=checksum).order_by(cls.id).first()
+        if word_set is None:
+            latest_version = db.session.query(db.func.max(cls.version)).filter(cls.kind == kind).scalar() or 0
+            word_set = cls(kind=kind, version=latest_version + 1, checksum=checksum, words='\n'.join(words))
+            db.session.add(word_set)
+            db.session.flush()
+        return word_set
+    
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'version': self.version,
+            'words': self.word_list
+        }
+
+class DeletedPreference(db.Model):
+    """Tombstone left behind when a preference is deleted, for delta exports"""
+    id = db.Column(db.Integer, primary_key=True)
+    preference_id = db.Column(db.Integer, nullable=False)
+    unique_userid = db.Column(db.String(64), nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+
+@event.listens_for(Session, 'before_flush')
+def track_preference_changes(session, flush_context, instances):
+    """Keep Preference.updated_at, its numeric coordinates and the tombstones in step with every change"""
+    now = datetime.datetime.utcnow()
+    with session.no_autoflush:
+        # Product edits don't touch the preference row itself, so bump it explicitly
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, ProductPreference) and obj.preference is not None:
+                obj.preference.updated_at = now
+        
+        # Keep the numeric coordinates in step with fixed_lat/fixed_lon, or the geocoded location/suburb
+        located = [obj for obj in list(session.new) + list(session.dirty)
+                   if isinstance(obj, Preference) and (obj in session.new or _geo_inputs_changed(obj))]
+        rows = [(obj.fixed_lat, obj.fixed_lon, obj.location, obj.suburb) for obj in located]
+        for obj, fields in zip(located, locate_preferences(rows)):
+            for key, value in fields.items():
+                if getattr(obj, key) != value:
+                    setattr(obj, key, value)
+        
+        for obj in list(session.deleted):
+            if isinstance(obj, Preference):
+                session.add(DeletedPreference(
+                    preference_id=obj.id,
+                    unique_userid=obj.get_unique_userid(),
+                    deleted_at=now
+                ))
+
+def _geo_inputs_changed(preference):
+    attrs = db.inspect(preference).attrs
+    return any(attrs[name].history.has_changes() for name in ('fixed_lat', 'fixed_lon', 'location', 'suburb'))
+
+class GeocodeCache(db.Model):
+    """Memoized gazetteer lookups, keyed on the normalized (location, suburb) pair; misses are cached too"""
+    id = db.Column(db.Integer, primary_key=True)
+    query_key = db.Column(db.String(255), nullable=False, index=True)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    @classmethod
+    def resolve_many(cls, places):
+        """Map cache_key(location, suburb) -> (lat, lon) or None for (location, suburb) pairs.
+        
+        One SELECT covers every pair; pairs seen for the first time are looked
+        up in the bundled gazetteer and added to the session (not committed).
+        """
+        wanted = {cache_key(location, suburb): (location, suburb) for location, suburb in places}
+        if not wanted:
+            return {}
+        
+        resolved = {}
+        rows = db.session.execute(
+            db.select(cls.query_key, cls.latitude, cls.longitude)
+            .where(cls.query_key.in_(list(wanted)))
+            .order_by(cls.id)
+        )
+        for key, latitude, longitude in rows:
+            resolved.setdefault(key, (latitude, longitude) if latitude is not None else None)
+        
+        gazetteer = default_gazetteer()
+        for key, (location, suburb) in wanted.items():
+            if key not in resolved:
+                point = gazetteer.lookup(location, suburb)
+                resolved[key] = point
+                db.session.add(cls(query_key=key, latitude=point[0] if point else None,
+                                   longitude=point[1] if point else None))
+        return resolved
+
+class Job(db.Model):
+    """Background import/export job run by jobs.py"""
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'import' or 'export'
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, finished, failed
+    
+    # Progress
+    rows_done = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Integer, default=0)
+    message = db.Column(db.Text, nullable=True)
+    error_log = db.Column(db.Text, nullable=True)
+    
+    # Downloadable artifact (exports)
+    result_path = db.Column(db.String(255), nullable=True)
+    result_name = db.Column(db.String(255), nullable=True)
+    
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'rows_done': self.rows_done or 0,
+            'errors': self.errors or 0,
+            'message': self.message,
+            'error_log': self.error_log.splitlines() if self.error_log else [],
+            'has_result': bool(self.result_path),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
 # Predefined list of iPhone models
 IPHONE_MODELS = [
     "iPhone 16 Pro Max", "iPhone 16 Pro", "iPhone 16 Plus", "iPhone 16",
@@ -115,4 +284,87 @@ DEFAULT_PRICES = {
 
 # Default keywords and excluded words
 DEFAULT_KEYWORDS = ["iphone"]
-DEFAULT_EXCLUDED_WORDS = ['warranty', 'controller', 'for', 'stand', 'car', 'names', 'stereo', 'LCD', 'C@$h', 'Ca$h', 'shop']
\ No newline at end of file
+DEFAULT_EXCLUDED_WORDS = ['warranty', 'controller', 'for', 'stand', 'car', 'names', 'stereo', 'LCD', 'C@$h', 'Ca$h', 'shop']
+
+def locate_preferences(rows):
+    """Coordinate fields for (fixed_lat, fixed_lon, location, suburb) rows.
+    
+    fixed_lat/fixed_lon win when both parse; otherwise the location/suburb
+    text is geocoded offline through GeocodeCache.
+    """
+    results = [geo_fields(fixed_lat, fixed_lon) for fixed_lat, fixed_lon, _, _ in rows]
+    missing = [(location, suburb) for (_, _, location, suburb), fields in zip(rows, results)
+               if fields['latitude'] is None]
+    if missing:
+        resolved = GeocodeCache.resolve_many(missing)
+        for index, ((_, _, location, suburb), fields) in enumerate(zip(rows, results)):
+            point = resolved.get(cache_key(location, suburb)) if fields['latitude'] is None else None
+            if point is not None:
+                results[index] = point_fields(*point)
+    return results
+
+def backfill_geo(batch_size, recompute_all=False):
+    """Fill latitude/longitude/geo_cell from fixed_lat/fixed_lon, or geocode location/suburb.
+
+    Only rows without a geo_cell are filled unless recompute_all. Commits
+    every batch_size rows; returns the number of rows that got coordinates.
+    """
+    table = Preference.__table__
+    condition = table.c.id.isnot(None) if recompute_all else table.c.geo_cell.is_(None)
+
+    # updated_at is set to itself so the derived columns don't show up in delta exports
+    statement = (
+        update(table)
+        .where(table.c.id == bindparam('pref_id'))
+        .values(latitude=bindparam('latitude'), longitude=bindparam('longitude'),
+                geo_cell=bindparam('geo_cell'), updated_at=table.c.updated_at)
+    )
+
+    last_id = 0
+    updated = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.fixed_lat, table.c.fixed_lon, table.c.location, table.c.suburb)
+            .where(condition, table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        coordinates = locate_preferences([tuple(row)[1:] for row in rows])
+        values = [dict(geo, pref_id=row.id) for row, geo in zip(rows, coordinates)]
+        db.session.execute(statement, values)
+        db.session.commit()
+        updated += sum(value['geo_cell'] is not None for value in values)
+        last_id = rows[-1].id
+    return updated
+
+def ensure_default_word_sets():
+    """Create the default keyword and excluded word sets if they are missing, and commit them.
+
+    Part of schema setup (schema.ensure_schema()), so readers never have to write.
+    """
+    WordSet.get_or_create('keyword', DEFAULT_KEYWORDS)
+    WordSet.get_or_create('excluded', DEFAULT_EXCLUDED_WORDS)
+    db.session.commit()
+
+def default_word_set_ids():
+    """Return (keyword set id, excluded set id) for the default word lists.
+    
+    Only reads: the sets are created at schema setup. On a database that
+    skipped it they are added to the session and flushed, never committed,
+    so the caller's pending changes and loaded objects are left alone.
+    """
+    checksums = {WordSet.make_checksum('keyword', DEFAULT_KEYWORDS): 'keyword',
+                 WordSet.make_checksum('excluded', DEFAULT_EXCLUDED_WORDS): 'excluded'}
+    ids = {}
+    rows = db.session.execute(
+        db.select(WordSet.checksum, WordSet.id).where(WordSet.checksum.in_(list(checksums))).order_by(WordSet.id)
+    )
+    for checksum, set_id in rows:
+        ids.setdefault(checksums[checksum], set_id)
+    if len(ids) < 2:
+        ids['keyword'] = WordSet.get_or_create('keyword', DEFAULT_KEYWORDS).id
+        ids['excluded'] = WordSet.get_or_create('excluded', DEFAULT_EXCLUDED_WORDS).id
+    return ids['keyword'], ids['excluded']
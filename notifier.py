@@ -0,0 +1,433 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from config import Config
+from digest import DigestBuffer, DigestStage
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class NotificationError(Exception):
+    """A message that can't be delivered, e.g. the user blocked the bot"""
+
+class TemporaryError(Exception):
+    """A failed send worth retrying (network errors, 5xx responses)"""
+
+class RetryAfter(Exception):
+    """The Bot API answered 429 Too Many Requests"""
+
+    def __init__(self, seconds):
+        super().__init__(f"Retry after {seconds}s")
+        self.seconds = seconds
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to capacity"""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = None
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        """Take a token if one is available; returns the seconds to wait otherwise (0 on success)"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def is_full(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def drain(self, seconds):
+        """Take the tokens of the next seconds away, e.g. after the server asked us to back off"""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next seconds; unlike drain, overlapping pauses don't add up"""
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def available_in(self):
+        """Seconds until a token is available, without taking it"""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    async def wait(self):
+        """Wait until a token is available, without taking it"""
+        wait = self.available_in()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.available_in()
+
+    async def acquire(self):
+        """Wait for a token and take it; concurrent waiters are served in arrival order"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            wait = self.take()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.take()
+
+class DispatchStats:
+    def __init__(self):
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+class NotificationDispatcher:
+    """Sends (user_id, message) jobs through a transport within Telegram's rate limits.
+
+    Every chat gets its own FIFO and at most one sender task, so a chat's
+    messages go out in order and never faster than its token bucket allows,
+    while other chats carry on. All sends also take a token from one global
+    bucket, and a semaphore caps the requests in flight. A 429 drains the
+    chat's bucket for the retry_after the server asked for and pauses the
+    global bucket for as long, since the limit hit may be the global one;
+    network errors and 5xx responses are retried with exponential backoff
+    and jitter. Jobs stop being read once max_pending are waiting, so memory
+    stays bounded.
+    """
+
+    def __init__(self, transport, global_rate=None, chat_rate=None, max_in_flight=None, max_retries=None,
+                 max_pending=10000, max_idle_chats=10000):
+        self.transport = transport
+        self.global_bucket = TokenBucket(global_rate or Config.NOTIFY_GLOBAL_RATE)
+        self.chat_rate = chat_rate or Config.NOTIFY_CHAT_RATE
+        self.max_in_flight = max_in_flight or Config.NOTIFY_MAX_IN_FLIGHT
+        self.max_retries = Config.NOTIFY_MAX_RETRIES if max_retries is None else max_retries
+        self.max_pending = max_pending
+        self.max_idle_chats = max_idle_chats
+        self.stats = DispatchStats()
+        self._chat_buckets = {}
+        self._pending = {}        # chat id -> deque of messages
+        self._senders = {}        # chat id -> sender task
+        self._pending_count = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_idle_chats:
+                # A full bucket is the same as a new one, so forgetting it loses nothing
+                self._chat_buckets = {chat: chat_bucket for chat, chat_bucket in self._chat_buckets.items()
+                                      if chat in self._senders or not chat_bucket.is_full()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    async def run(self, jobs):
+        """Deliver (user_id, message) jobs from an asyncio.Queue until it yields None; returns the stats"""
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._room = asyncio.Condition()
+        while True:
+            job = await jobs.get()
+            if job is None:
+                break
+            chat_id, message = job[0], job[1]
+            if not chat_id:
+                self.stats.skipped += 1
+                continue
+
+            async with self._room:
+                await self._room.wait_for(lambda: self._pending_count < self.max_pending)
+            self.stats.queued += 1
+            self._pending_count += 1
+            self._pending.setdefault(chat_id, deque()).append(message)
+            if chat_id not in self._senders:
+                self._senders[chat_id] = asyncio.ensure_future(self._drain_chat(chat_id))
+
+        while self._senders:
+            await asyncio.gather(*list(self._senders.values()))
+        return self.stats
+
+    async def dispatch(self, jobs, digest=None):
+        """Deliver an iterable of (user_id, message[, notification_mode]) jobs, through a DigestStage if given"""
+        queue = asyncio.Queue(maxsize=self.max_pending)
+        if digest is None:
+            tasks = [asyncio.ensure_future(self.run(queue))]
+        else:
+            digested = asyncio.Queue(maxsize=self.max_pending)
+            tasks = [asyncio.ensure_future(self.run(digested)), asyncio.ensure_future(digest.run(queue, digested))]
+        # Jobs may come from a blocking source like stdin, so read them off the event loop
+        loop = asyncio.get_running_loop()
+        jobs = iter(jobs)
+        while True:
+            job = await loop.run_in_executor(None, next, jobs, None)
+            if job is None:
+                break
+            await queue.put(job)
+        await queue.put(None)
+        return (await asyncio.gather(*tasks))[0]
+
+    async def _drain_chat(self, chat_id):
+        messages = self._pending[chat_id]
+        bucket = self._chat_bucket(chat_id)
+        try:
+            while messages:
+                try:
+                    await self._deliver(chat_id, messages[0], bucket)
+                except Exception:
+                    logger.exception(f"Unexpected error sending to {chat_id}")
+                    self.stats.failed += 1
+                messages.popleft()
+                self._pending_count -= 1
+                async with self._room:
+                    self._room.notify()
+        finally:
+            del self._pending[chat_id]
+            del self._senders[chat_id]
+
+    async def _deliver(self, chat_id, message, bucket):
+        for attempt in range(self.max_retries + 1):
+            backoff = 0.0
+            await bucket.wait()
+            try:
+                async with self._in_flight:
+                    await self.global_bucket.acquire()
+                    # Only this chat's sender uses its bucket, so the token is still there; taking
+                    # it after the global wait keeps the chat's actual sends spaced out
+                    bucket.take()
+                    await self.transport.send(chat_id, message)
+                self.stats.sent += 1
+                return
+            except RetryAfter as error:
+                self.stats.rate_limited += 1
+                bucket.drain(error.seconds)
+                self.global_bucket.pause(error.seconds)
+            except TemporaryError as error:
+                logger.debug(f"Temporary error sending to {chat_id}: {error}")
+                backoff = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+            except NotificationError as error:
+                logger.warning(f"Dropping message to {chat_id}: {error}")
+                self.stats.failed += 1
+                return
+
+            if attempt < self.max_retries:
+                self.stats.retries += 1
+                await asyncio.sleep(backoff)
+        logger.warning(f"Giving up on message to {chat_id} after {self.max_retries} retries")
+        self.stats.failed += 1
+
+class StubTransport:
+    """In-memory transport for local runs: records messages instead of sending them"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, chat_id, message, **options):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append((time.monotonic(), chat_id, message, options))
+
+class BotApiTransport:
+    """Bot API sendMessage over HTTP; api_url can point at FakeBotApi for load tests.
+
+    Requests are made with requests on a thread pool sized for the
+    dispatcher's in-flight limit, reusing pooled connections.
+    """
+
+    def __init__(self, token, api_url=None, max_in_flight=None, timeout=10):
+        self.url = f"{(api_url or Config.TELEGRAM_API_URL).rstrip('/')}/bot{token}/sendMessage"
+        self.timeout = timeout
+        pool_size = max_in_flight or Config.NOTIFY_MAX_IN_FLIGHT
+        self._session = requests.Session()
+        self._session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def _post(self, chat_id, message, options):
+        try:
+            response = self._session.post(self.url, json={'chat_id': chat_id, 'text': message, **options},
+                                          timeout=self.timeout)
+        except requests.RequestException as error:
+            raise TemporaryError(str(error))
+        if response.status_code == 200:
+            return response.json().get('result')
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        description = body.get('description', response.reason)
+        if response.status_code == 429:
+            raise RetryAfter((body.get('parameters') or {}).get('retry_after', 1))
+        if response.status_code >= 500:
+            raise TemporaryError(f"{response.status_code} {description}")
+        raise NotificationError(f"{response.status_code} {description}")
+
+    async def send(self, chat_id, message, **options):
+        """Send one message; options are extra sendMessage fields such as reply_markup or parse_mode"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._post, chat_id, message,
+                                                                options)
+
+    def close(self):
+        self._executor.shutdown()
+        self._session.close()
+
+class FakeBotApi:
+    """Local stand-in for the Bot API's sendMessage that enforces rate limits like Telegram.
+
+    Sends beyond global_rate per second, or chat_rate per chat, get a 429
+    with retry_after. Accepted messages are counted per chat, and their
+    arrival times are kept so a load test can check the spacing.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, latency=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        # 5% looser than the client's buckets, to absorb network jitter
+        self.global_bucket = TokenBucket(global_rate * 1.05, capacity=global_rate * 1.05)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.accepted = []            # (arrival time, chat id)
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _admit(self, chat_id):
+        with self._lock:
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate * 1.05, capacity=1.05))
+            wait = bucket.take() or self.global_bucket.take()
+            if wait:
+                self.rejected += 1
+                return max(1, round(wait))
+            self.accepted.append((time.monotonic(), chat_id))
+            return 0
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not self.path.endswith('/sendMessage'):
+                    return self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                try:
+                    payload = json.loads(body or b'{}')
+                except ValueError:
+                    return self._reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request'})
+                if api.latency:
+                    time.sleep(api.latency)
+                retry_after = api._admit(str(payload.get('chat_id')))
+                if retry_after:
+                    return self._reply(429, {
+                        'ok': False, 'error_code': 429,
+                        'description': f'Too Many Requests: retry after {retry_after}',
+                        'parameters': {'retry_after': retry_after}
+                    })
+                self._reply(200, {'ok': True, 'result': {'message_id': len(api.accepted),
+                                                         'chat': {'id': payload.get('chat_id')},
+                                                         'text': payload.get('text')}})
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def min_chat_interval(self):
+        """Shortest gap between two accepted messages to the same chat, in seconds"""
+        last_seen = {}
+        shortest = float('inf')
+        for arrival, chat_id in sorted(self.accepted):
+            if chat_id in last_seen:
+                shortest = min(shortest, arrival - last_seen[chat_id])
+            last_seen[chat_id] = arrival
+        return shortest
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def read_jobs(lines):
+    """(user_id, message, notification_mode) from notification job JSON lines, as written by ingest.py"""
+    for line in lines:
+        if line.strip():
+            job = json.loads(line)
+            yield job.get('user_id'), job.get('message'), job.get('notification_mode')
+
+def main(argv=None):
+    """Send notification jobs (JSON Lines from ingest.py) to Telegram."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('input', nargs='?', default='-', help='JSON Lines file of jobs (default: stdin)')
+    parser.add_argument('--stub', action='store_true', help='Record messages locally instead of sending them')
+    parser.add_argument('--api-url', default=Config.TELEGRAM_API_URL, help='Bot API base URL')
+    parser.add_argument('--digest-window', type=float, default=Config.DIGEST_WINDOW,
+                        help='Seconds to collect matches into one message for DIGEST_MODES users (0 disables)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.stub:
+        transport = StubTransport()
+    else:
+        transport = BotApiTransport(Config.TELEGRAM_BOT_TOKEN, args.api_url)
+    lines = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    digest = DigestStage(DigestBuffer(args.digest_window)) if args.digest_window > 0 else None
+
+    start = time.perf_counter()
+    try:
+        stats = asyncio.run(NotificationDispatcher(transport).dispatch(read_jobs(lines), digest))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if isinstance(transport, BotApiTransport):
+            transport.close()
+    logger.info(f"Dispatched in {time.perf_counter() - start:.2f}s: {stats.as_dict()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import io
+import csv
+import zipfile
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sqlalchemy import create_engine, select
+
+from config import Config
+from models import db, Preference, ProductPreference, default_word_set_ids
+from exports import (USER_HEADERS, PRODUCT_HEADERS, KEYWORD_SET_HEADERS, EXCLUDED_SET_HEADERS,
+                     README_CONTENT, ChunkBuffer, user_row, product_row, referenced_word_sets,
+                     word_set_rows, stream_export_zip)
+
+# CSV members rendered by the shard workers, in the order they appear in the ZIP
+SHARDED_MEMBERS = [
+    ('users.csv', USER_HEADERS),
+    ('products.csv', PRODUCT_HEADERS)
+]
+
+# One engine per worker process, created on its first shard
+_engines = {}
+
+def _engine(database_url):
+    if database_url not in _engines:
+        _engines[database_url] = create_engine(database_url)
+    return _engines[database_url]
+
+def render_shard(database_url, member, start_id, end_id, default_set_ids):
+    """Render the CSV rows of one member for preferences with start_id <= id <= end_id (no header).
+
+    Returns (rows, encoded CSV); rows is counted here because quoted fields may hold newlines.
+    """
+    preference = Preference.__table__
+    product = ProductPreference.__table__
+    in_range = preference.c.id.between(start_id, end_id)
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    rows_written = 0
+
+    with _engine(database_url).connect() as conn:
+        if member == 'users.csv':
+            for row in conn.execute(select(preference).where(in_range).order_by(preference.c.id)):
+                writer.writerow(user_row(row, default_set_ids))
+                rows_written += 1
+
+        else:
+            rows = conn.execute(
+                select(preference.c.id, preference.c.unique_userid, product.c.product_name,
+                       product.c.max_price, product.c.is_preferred)
+                .join(product, product.c.preference_id == preference.c.id)
+                .where(in_range)
+                .order_by(preference.c.id, product.c.id)
+            )
+            for row in rows:
+                writer.writerow(product_row(row.unique_userid or f"user_{row.id}", row))
+                rows_written += 1
+
+    return rows_written, output.getvalue().encode('utf-8')
+
+def _worker_ready():
+    return True
+
+# Shard workers are spawned on the first parallel export and kept for the next ones:
+# starting a worker imports the app's models, which costs more than rendering a small export
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+def export_pool(workers):
+    """The shared process pool for sharded exports, started (or restarted) with workers processes"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
+
+def warm_export_pool(workers):
+    """Start every worker of the export pool now rather than during the first export"""
+    pool = export_pool(workers)
+    for future in [pool.submit(_worker_ready) for _ in range(workers)]:
+        future.result()
+    return pool
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def shard_ranges(shard_size):
+    """Split Preference.id into consecutive (start_id, end_id) ranges of shard_size rows each"""
+    ranges = []
+    start_id = None
+    last_id = None
+
+    ids = db.session.execute(
+        select(Preference.id).order_by(Preference.id).execution_options(yield_per=shard_size * 10)
+    ).scalars()
+    for count, pref_id in enumerate(ids):
+        if count % shard_size == 0:
+            if start_id is not None:
+                ranges.append((start_id, last_id))
+            start_id = pref_id
+        last_id = pref_id
+
+    if start_id is not None:
+        ranges.append((start_id, last_id))
+    return ranges
+
+def _ordered_results(executor, fn, args_list, window):
+    """Like executor.map, but keeps at most window shards in flight so results never pile up"""
+    pending = deque()
+    for args in args_list:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def stream_parallel_export_zip(shard_size, workers, readme_content=README_CONTENT, progress=None):
+    """Generate the full export ZIP with CSV rendering spread over a process pool.
+
+    Preference ids are split into ranges of shard_size rows. Each worker
+    renders one member's rows for one range, and the fragments are appended
+    to the ZIP in id order, so the result is byte-for-byte the same CSV data
+    as the serial export. Workers are spawned rather than forked, so they
+    share no connections or threads with the web worker, and the pool stays
+    up between exports (see export_pool()).
+
+    progress, if given, is called with the number of CSV rows written so far.
+    """
+    database_url = db.engine.url.render_as_string(hide_password=False)
+    default_set_ids = default_word_set_ids()
+    keyword_sets, excluded_sets = referenced_word_sets(Preference.query, default_set_ids)
+    ranges = shard_ranges(shard_size)
+    buffer = ChunkBuffer()
+    rows_done = 0
+
+    executor = export_pool(workers)
+    try:
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for filename, header in SHARDED_MEMBERS:
+                with zipf.open(filename, 'w') as member:
+                    header_output = io.StringIO()
+                    csv.writer(header_output).writerow(header)
+                    member.write(header_output.getvalue().encode('utf-8'))
+
+                    shards = [(database_url, filename, start_id, end_id, default_set_ids)
+                              for start_id, end_id in ranges]
+                    for rows, fragment in _ordered_results(executor, render_shard, shards, workers * 2):
+                        member.write(fragment)
+                        rows_done += rows
+                        if progress:
+                            progress(rows_done)
+                        yield buffer.drain()
+
+                yield buffer.drain()
+
+            # Word sets are small and shared, so the parent writes them directly
+            for filename, header, word_sets in [('keyword_sets.csv', KEYWORD_SET_HEADERS, keyword_sets),
+                                                ('excluded_word_sets.csv', EXCLUDED_SET_HEADERS, excluded_sets)]:
+                output = io.StringIO()
+                writer = csv.writer(output)
+                writer.writerow(header)
+                rows = list(word_set_rows(word_sets))
+                writer.writerows(rows)
+                zipf.writestr(filename, output.getvalue())
+                rows_done += len(rows)
+                if progress:
+                    progress(rows_done)
+
+            zipf.writestr('resellers.csv', 'unique_userid,reseller_name\r\n')
+            zipf.writestr('README.txt', readme_content)
+    except BrokenProcessPool:
+        # A worker died; the next export starts a fresh pool
+        _discard_pool(executor)
+        raise
+
+    yield buffer.drain()
+
+def stream_full_export_zip(batch_size, shard_size, workers, progress=None, min_rows=None):
+    """Full export ZIP: sharded over the process pool when workers > 1 and there are at least
+    min_rows (EXPORT_PARALLEL_MIN_ROWS) preferences, otherwise the serial stream"""
+    min_rows = Config.EXPORT_PARALLEL_MIN_ROWS if min_rows is None else min_rows
+    if workers > 1 and Preference.query.count() >= min_rows:
+        return stream_parallel_export_zip(shard_size, workers, progress=progress)
+    return stream_export_zip(Preference.query, batch_size, progress=progress)
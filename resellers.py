@@ -0,0 +1,223 @@
+import time
+import hashlib
+import logging
+from collections import deque, OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from config import Config
+from classifier import tokenize
+from matching import normalize_location
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SIMHASH_BITS = 64
+
+@lru_cache(maxsize=65536)
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def listing_features(title, description=''):
+    """Title and description tokens plus adjacent token pairs"""
+    tokens = tokenize(f'{title} {description or ""}')
+    return tokens + [f'{first} {second}' for first, second in zip(tokens, tokens[1:])]
+
+def simhash(features):
+    """64-bit SimHash: each bit is the majority vote of that bit over the feature hashes"""
+    if not features:
+        return 0
+    hashes = np.array([_feature_hash(feature) for feature in features], dtype='<u8')
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    majority = bits.sum(axis=0) * 2 > len(features)
+    return int.from_bytes(np.packbits(majority, bitorder='little').tobytes(), 'little')
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+class RepostIndex:
+    """The last capacity listing fingerprints, with banded LSH lookups for near-duplicates.
+
+    Fingerprints are split into max_distance + 1 bands. Two fingerprints
+    differing in at most max_distance bits agree on at least one band, so
+    looking up each band finds every near-duplicate, while keeping the
+    bands wide enough that buckets stay small. A bucket only remembers its
+    max_bucket most recent slots, which bounds the work per lookup even when
+    many fingerprints share a band. Slots form a ring: adding a fingerprint
+    overwrites the oldest one, so memory never grows.
+    """
+
+    def __init__(self, capacity, max_distance=3, max_bucket=16):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.max_bucket = max_bucket
+        bands = max_distance + 1
+        edges = [round(band * SIMHASH_BITS / bands) for band in range(bands + 1)]
+        self._band_masks = [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+        self._slots = [None] * capacity                 # slot -> (simhash, group, listing key)
+        self._buckets = [{} for _ in range(bands)]      # band value -> deque of slots, oldest first
+        self._next = 0
+
+    def _bands(self, fingerprint):
+        return [(fingerprint >> shift) & mask for shift, mask in self._band_masks]
+
+    def find(self, fingerprint, group):
+        """Key of the oldest remembered listing in group within max_distance bits, or None"""
+        candidates = set()
+        for band, value in enumerate(self._bands(fingerprint)):
+            candidates.update(self._buckets[band].get(value, ()))
+
+        best = None
+        for slot in candidates:
+            other, other_group, key = self._slots[slot]
+            if other_group == group and hamming_distance(fingerprint, other) <= self.max_distance:
+                # Slots are reused in ring order, so the oldest is the one furthest behind _next
+                age = (self._next - slot - 1) % self.capacity
+                if best is None or age > best[0]:
+                    best = (age, key)
+        return None if best is None else best[1]
+
+    def add(self, fingerprint, group, key):
+        slot = self._next
+        if self._slots[slot] is not None:
+            # The slot being reused is the oldest entry, so it can only be at the front of its buckets
+            for band, value in enumerate(self._bands(self._slots[slot][0])):
+                bucket = self._buckets[band].get(value)
+                if bucket and bucket[0] == slot:
+                    bucket.popleft()
+                    if not bucket:
+                        del self._buckets[band][value]
+        self._slots[slot] = (fingerprint, group, key)
+        for band, value in enumerate(self._bands(fingerprint)):
+            bucket = self._buckets[band].get(value)
+            if bucket is None:
+                bucket = self._buckets[band][value] = deque(maxlen=self.max_bucket)
+            bucket.append(slot)
+        self._next = (slot + 1) % self.capacity
+
+class CountMinSketch:
+    """Approximate per-key counts in fixed memory; estimates never undercount"""
+
+    def __init__(self, width=1 << 16, depth=4):
+        self.width = width
+        self.depth = depth
+        self._table = np.zeros((depth, width), dtype=np.uint32)
+        self._rows = np.arange(depth)
+
+    def _columns(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count key and return its new estimate"""
+        columns = self._columns(key)
+        self._table[self._rows, columns] += count
+        return int(self._table[self._rows, columns].min())
+
+    def estimate(self, key):
+        return int(self._table[self._rows, self._columns(key)].min())
+
+    def decay(self):
+        """Halve every count, so estimates follow recent activity"""
+        self._table >>= 1
+
+    @property
+    def nbytes(self):
+        return self._table.nbytes
+
+class DetectorStats:
+    def __init__(self):
+        self.listings = 0
+        self.reposts = 0
+        self.resightings = 0
+        self.reseller_listings = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+class ResellerDetector:
+    """Streaming near-duplicate and reseller detection in constant memory.
+
+    Each listing's title and description are fingerprinted with SimHash. A
+    listing within a few bits of a recent one with the same location and
+    price is a repost of it; as in dedup.py, a new price makes a new deal,
+    and it keeps a shop's boilerplate description from merging its phones.
+    Posts and reposts per seller are counted in count-min sketches that
+    halve every window seconds. A seller whose recent posts reach
+    post_threshold, or whose reposts reach repost_threshold, is flagged as
+    a reseller. A listing key seen again (the scraper picking up the same
+    listing twice) is a re-sighting: it gets its first verdict back and
+    counts as neither a post nor a repost, leaving it to the dedup store.
+    Memory is fixed by repost_capacity and the sketch size, however long
+    the stream runs; the most recently flagged sellers are kept for
+    reporting, up to max_flagged.
+    """
+
+    def __init__(self, window=None, post_threshold=None, repost_threshold=None, repost_capacity=None,
+                 max_distance=None, max_flagged=1000, clock=time.monotonic):
+        self.window = window or Config.RESELLER_WINDOW
+        self.post_threshold = post_threshold or Config.RESELLER_POST_THRESHOLD
+        self.repost_threshold = repost_threshold or Config.RESELLER_REPOST_THRESHOLD
+        self.reposts = RepostIndex(repost_capacity or Config.REPOST_CAPACITY,
+                                   Config.REPOST_MAX_DISTANCE if max_distance is None else max_distance)
+        self.posts_by_seller = CountMinSketch()
+        self.reposts_by_seller = CountMinSketch()
+        self.max_flagged = max_flagged
+        self.flagged = {}       # seller -> (posts, reposts) estimates when last flagged, oldest first
+        self.clock = clock
+        self.stats = DetectorStats()
+        self._decayed_at = clock()
+        self._seen_keys = OrderedDict()     # recent listing key -> original key it reposted, or None
+
+    def check(self, key, title, description='', location='', price=None, seller=None):
+        """Return (original key or None, whether the seller is a reseller) for one listing"""
+        now = self.clock()
+        while now - self._decayed_at >= self.window:
+            self.posts_by_seller.decay()
+            self.reposts_by_seller.decay()
+            self._decayed_at += self.window
+
+        self.stats.listings += 1
+        seller = str(seller).strip().lower() if seller else None
+        if key in self._seen_keys:
+            self.stats.resightings += 1
+            return self._seen_keys[key], self._is_flagged(seller)
+
+        group = f'{normalize_location(location)}|{price}'
+        fingerprint = simhash(listing_features(title, description))
+        original = self.reposts.find(fingerprint, group)
+        if original == key:
+            # Still in the ring after its key fell out of _seen_keys
+            self.stats.resightings += 1
+            return None, self._is_flagged(seller)
+        if original is None:
+            self.reposts.add(fingerprint, group, key)
+        else:
+            self.stats.reposts += 1
+        self._seen_keys[key] = original
+        if len(self._seen_keys) > self.reposts.capacity:
+            self._seen_keys.popitem(last=False)
+
+        is_reseller = False
+        if seller:
+            posts = self.posts_by_seller.add(seller)
+            reposts = (self.reposts_by_seller.add(seller) if original is not None
+                       else self.reposts_by_seller.estimate(seller))
+            is_reseller = posts >= self.post_threshold or reposts >= self.repost_threshold
+            if is_reseller:
+                self.stats.reseller_listings += 1
+                self.flagged.pop(seller, None)
+                self.flagged[seller] = (posts, reposts)
+                if len(self.flagged) > self.max_flagged:
+                    del self.flagged[next(iter(self.flagged))]
+        return original, is_reseller
+
+    def _is_flagged(self, seller):
+        """Whether seller is over a threshold now, without counting anything"""
+        if not seller:
+            return False
+        return (self.posts_by_seller.estimate(seller) >= self.post_threshold
+                or self.reposts_by_seller.estimate(seller) >= self.repost_threshold)
@@ -0,0 +1,30 @@
+from flask import Blueprint, request, abort, current_app
+from webhook_bot import get_webhook_bot
+import hmac
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+telegram_bp = Blueprint('telegram', __name__)
+
+@telegram_bp.route('/webhook', methods=['POST'])
+def webhook():
+    """Receive an Update from Telegram and hand it to the asyncio bot"""
+    secret = current_app.config.get('TELEGRAM_WEBHOOK_SECRET')
+    if not secret:
+        abort(404)
+
+    # Telegram echoes the secret_token given to setWebhook in this header
+    received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(received.encode(), secret.encode()):
+        logger.warning(f"Webhook call with a bad secret token from {request.remote_addr}")
+        abort(403)
+
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or 'update_id' not in update:
+        abort(400)
+
+    # Answer at once; the bot handles the update on its own event loop
+    get_webhook_bot(current_app._get_current_object()).submit(update)
+    return '', 200
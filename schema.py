@@ -0,0 +1,58 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from models import db, Preference, backfill_geo, ensure_default_word_sets
+from config import Config
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+def add_column_statement(table, column, dialect):
+    """ALTER TABLE statement adding column to table, with names quoted and foreign keys kept for dialect"""
+    preparer = dialect.identifier_preparer
+    statement = (f'ALTER TABLE {preparer.format_table(table)} '
+                 f'ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=dialect)}')
+    for foreign_key in column.foreign_keys:
+        statement += (f' REFERENCES {preparer.format_table(foreign_key.column.table)} '
+                      f'({preparer.format_column(foreign_key.column)})')
+    return statement
+
+def ensure_schema():
+    """Bring an existing database up to date with the models.
+
+    db.create_all() only creates missing tables, so columns and indexes added
+    to existing models later are created here. Only additive, nullable
+    changes are handled, which is all the models have needed so far. The
+    default word sets are created here too.
+
+    The repo has no migrations, so this also stands in for the one adding
+    Preference.latitude/longitude/geo_cell: when those columns are added,
+    existing rows are backfilled before the app serves requests. Rows
+    written later get their coordinates on flush.
+    """
+    db.create_all()
+
+    added = set()
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    conn.execute(text(add_column_statement(table, column, conn.dialect)))
+                    added.add((table.name, column.name))
+                    logger.info(f"Added column {table.name}.{column.name}")
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    conn.execute(CreateIndex(index))
+                    logger.info(f"Created index {index.name}")
+
+    if (Preference.__tablename__, 'geo_cell') in added:
+        updated = backfill_geo(Config.IMPORT_BATCH_SIZE)
+        logger.info(f"Backfilled coordinates for {updated} preferences")
+
+    ensure_default_word_sets()
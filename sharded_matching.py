@@ -0,0 +1,224 @@
+import logging
+import multiprocessing
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from multiprocessing import shared_memory
+
+from sqlalchemy import create_engine, select, func, or_
+from sqlalchemy.orm import Session, selectinload
+
+from models import db, Preference
+from matching import MatchIndex, IdMatchIndex, normalize_location, active_conditions
+from subscriber_index import MappedSubscriberIndex
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# The shard's index, built once per worker process by _init_shard()
+_shard_index = None
+# The shard's shared results buffer, reused by every burst until one outgrows it
+_results = None
+
+def location_values(today):
+    """Active preference counts and stored location values per normalized location.
+
+    Locations are normalized here with matching.normalize_location(), the
+    same function listings are routed and matched with; SQL's lower() and
+    trim() differ from it on tabs, newlines and non-ASCII case.
+    """
+    counts = defaultdict(int)
+    values = defaultdict(list)
+    rows = db.session.execute(
+        select(Preference.location, func.count(Preference.id))
+        .where(*active_conditions(today))
+        .group_by(Preference.location)
+    )
+    for value, count in rows:
+        location = normalize_location(value)
+        counts[location] += count
+        values[location].append(value)
+    return counts, values
+
+def _init_shard(database_url, locations, values, today, index_path=None):
+    """Worker initializer: index this shard's locations, read from the database or the subscriber index file.
+
+    locations are normalized names; values are the location column values stored for them.
+    """
+    global _shard_index
+    if index_path:
+        # Only this shard's rows of the mapped file are read
+        mapped = MappedSubscriberIndex.open(index_path, today)
+        _shard_index = IdMatchIndex(MatchIndex.build(mapped.preferences(locations)))
+        return
+    engine = create_engine(database_url)
+    stored = [value for value in values if value is not None]
+    in_shard = Preference.location.in_(stored)
+    if len(stored) < len(values):
+        in_shard = or_(in_shard, Preference.location.is_(None))
+    with Session(engine) as session:
+        statement = (
+            select(Preference)
+            .where(*active_conditions(today), in_shard)
+            .options(selectinload(Preference.products))
+            .order_by(Preference.id)
+        )
+        _shard_index = IdMatchIndex(MatchIndex.build(session.execute(statement).scalars()))
+    engine.dispose()
+
+def match_ids(index, listings):
+    """Match (product_name, price, location) listings against an IdMatchIndex.
+
+    Returns (ends, ids) arrays; listing i matched ids[ends[i - 1]:ends[i]].
+    """
+    ids = array('q')
+    ends = array('q')
+    for listing in listings:
+        index.match_into(ids, *listing)
+        ends.append(len(ids))
+    return ends, ids
+
+def split_ids(ends, ids):
+    """One array of preference ids per listing from match_ids() output"""
+    starts = [0] + ends[:-1].tolist()
+    return [ids[start:end] for start, end in zip(starts, ends)]
+
+def _match_in_shard(listings):
+    """Match listings and leave their ids in the shard's shared results buffer.
+
+    Only the per-listing ends and the buffer's name go back through the pipe;
+    a burst's recipient ids are far larger than its listings.
+    """
+    global _results
+    ends, ids = match_ids(_shard_index, listings)
+    size = len(ids) * ids.itemsize
+    if _results is None or _results.size < size:
+        if _results is not None:
+            _results.close()
+            _results.unlink()
+        _results = shared_memory.SharedMemory(create=True, size=max(2 * size, 1 << 20))
+    _results.buf[:size] = memoryview(ids).cast('B')
+    return ends, _results.name
+
+def _shard_ready():
+    return _shard_index.subscriber_count
+
+def plan_shards(location_counts, shards):
+    """Spread locations over shards, largest first onto the least loaded shard"""
+    plan = [[] for _ in range(shards)]
+    loads = [0] * shards
+    for location, count in sorted(location_counts.items(), key=lambda item: (-item[1], item[0])):
+        shard = loads.index(min(loads))
+        plan[shard].append(location)
+        loads[shard] += count
+    return [locations for locations in plan if locations]
+
+class ShardedMatcher:
+    """Matching service spread over worker processes, one shard of locations each.
+
+    Active preferences are partitioned by normalized location and every
+    shard process builds a MatchIndex for its own locations only. A burst
+    of listings is split by location, each shard matches its part in
+    parallel, and the results are merged back in listing order. Workers are
+    spawned (like the sharded export), so they share nothing with the web
+    worker, and each worker is a single-process pool so listings for a
+    location always reach the process holding it.
+
+    Recipients are returned as arrays of preference ids (matching.IdMatchIndex).
+    Shards write them to a shared memory buffer each, so only the listings
+    and the per-listing offsets are pickled. One burst is matched at a time.
+    With index_path, workers read their locations from a file written by
+    `flask write-subscriber-index` instead of querying the database,
+    touching only their own rows of it.
+    """
+
+    def __init__(self, workers, today=None, index_path=None):
+        self.workers = workers
+        self.today = today or date.today()
+        self.index_path = index_path
+        self._executors = []
+        self._shard_of = {}
+        self._results = {}
+
+    def start(self):
+        """Plan the shards and wait until every worker has built its index"""
+        counts, values = location_values(self.today)
+        plan = plan_shards(counts, self.workers)
+
+        database_url = db.engine.url.render_as_string(hide_password=False)
+        context = multiprocessing.get_context('spawn')
+        for shard, locations in enumerate(plan):
+            self._executors.append(ProcessPoolExecutor(
+                max_workers=1, mp_context=context,
+                initializer=_init_shard,
+                initargs=(database_url, locations, [value for location in locations for value in values[location]],
+                          self.today, self.index_path)
+            ))
+            for location in locations:
+                self._shard_of[location] = shard
+
+        sizes = [future.result() for future in [executor.submit(_shard_ready) for executor in self._executors]]
+        logger.info(f"Started {len(sizes)} matching shards with {sizes} subscribers")
+        return self
+
+    @property
+    def locations(self):
+        """Normalized locations served by the shards"""
+        return sorted(self._shard_of)
+
+    @property
+    def shard_count(self):
+        return len(self._executors)
+
+    def match_batch(self, listings):
+        """Return one array('q') of preference ids per (product_name, price, location) listing"""
+        listings = list(listings)
+        by_shard = defaultdict(list)
+        for position, listing in enumerate(listings):
+            shard = self._shard_of.get(normalize_location(listing[2]))
+            if shard is not None:
+                by_shard[shard].append(position)
+
+        futures = {
+            shard: self._executors[shard].submit(_match_in_shard, [listings[position] for position in positions])
+            for shard, positions in by_shard.items()
+        }
+
+        results = [array('q') for _ in listings]
+        for shard, future in futures.items():
+            for position, ids in zip(by_shard[shard], self._read_ids(shard, *future.result())):
+                results[position] = ids
+        return results
+
+    def _read_ids(self, shard, ends, name):
+        """Copy each listing's ids out of a shard's shared results buffer"""
+        results = self._results.get(shard)
+        if results is None or results.name != name:
+            if results is not None:
+                results.close()
+            results = self._results[shard] = shared_memory.SharedMemory(name=name)
+        buffer = results.buf
+        start = 0
+        for end in ends:
+            ids = array('q')
+            ids.frombytes(buffer[start * ids.itemsize:end * ids.itemsize])
+            yield ids
+            start = end
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown()
+        # The shards' current buffers outlive them until unlinked here
+        for results in self._results.values():
+            results.close()
+            results.unlink()
+        self._executors = []
+        self._shard_of = {}
+        self._results = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,180 @@
+import logging
+import threading
+from collections import namedtuple
+from datetime import date
+
+from models import DeletedPreference
+from exports import iter_preferences, delta_export
+from matching import MatchIndex, normalize_location
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+ProductRecord = namedtuple('ProductRecord', ['product_name', 'max_price', 'is_preferred'])
+
+class SubscriberRecord:
+    """Read-only copy of one active preference and its products.
+
+    Has the attributes MatchIndex.build() reads, so snapshots can feed the matchers directly.
+    """
+    __slots__ = ('id', 'unique_userid', 'user_id', 'user_name', 'location', 'suburb', 'notification_mode',
+                 'expiry_date', 'latitude', 'longitude', 'keyword_set_id', 'excluded_set_id', 'products')
+
+    def __init__(self, pref):
+        self.id = pref.id
+        self.unique_userid = pref.get_unique_userid()
+        self.user_id = pref.user_id
+        self.user_name = pref.user_name
+        self.location = normalize_location(pref.location)
+        self.suburb = pref.suburb
+        self.notification_mode = pref.notification_mode
+        self.expiry_date = pref.expiry_date
+        self.latitude = pref.latitude
+        self.longitude = pref.longitude
+        self.keyword_set_id = pref.keyword_set_id
+        self.excluded_set_id = pref.excluded_set_id
+        self.products = tuple(ProductRecord(product.product_name, product.max_price, product.is_preferred)
+                              for product in pref.products)
+
+    def get_unique_userid(self):
+        return self.unique_userid
+
+    def is_active(self, today):
+        return self.expiry_date is None or self.expiry_date >= today
+
+def _is_active(pref):
+    return pref.activation_status is not False
+
+class Snapshot:
+    """Immutable set of subscriber records, with a MatchIndex over them.
+
+    Stored as a base dict plus a small overlay of records changed or removed
+    since the base was built, so a refresh copies only the overlay. Once the
+    overlay grows past a fraction of the base it is folded into a new base,
+    which keeps refreshes proportional to the changes on average. The
+    MatchIndex is ready before the snapshot is handed out: apply() derives
+    it from the previous one with MatchIndex.updated(), so readers never
+    build or wait for it.
+    """
+
+    def __init__(self, base, overlay=None, removed=frozenset(), watermark=None, match_index=None,
+                 index_date=None):
+        self._base = base              # preference id -> SubscriberRecord
+        self._overlay = overlay or {}  # preference id -> SubscriberRecord, newer than base
+        self._removed = removed        # preference ids removed since base
+        self.watermark = watermark
+        # The index holds the records not past their expiry date on index_date
+        self.index_date = index_date or date.today()
+        if match_index is None:
+            match_index = MatchIndex.build(self.records(self.index_date))
+        self._match_index = match_index
+
+    def get(self, preference_id):
+        if preference_id in self._overlay:
+            return self._overlay[preference_id]
+        if preference_id in self._removed:
+            return None
+        return self._base.get(preference_id)
+
+    def __len__(self):
+        return sum(1 for _ in self._iter_all())
+
+    def _iter_all(self):
+        for preference_id, record in self._base.items():
+            if preference_id not in self._overlay and preference_id not in self._removed:
+                yield record
+        yield from self._overlay.values()
+
+    def records(self, today=None):
+        """Records not past their expiry date, ordered by preference id"""
+        today = today or date.today()
+        return sorted((record for record in self._iter_all() if record.is_active(today)),
+                      key=lambda record: record.id)
+
+    def match_index(self):
+        """MatchIndex over this snapshot's records on index_date, shared by every reader"""
+        return self._match_index
+
+    def apply(self, removed_ids, changed, watermark, today=None):
+        """Return a new snapshot with removed ids taken out, then changed records put in.
+
+        The new snapshot's index is updated from this one's for the changed
+        records only; on a new day it is rebuilt, as records may have expired.
+        """
+        today = today or date.today()
+        overlay = dict(self._overlay)
+        removed = set(self._removed)
+        # Removals go first: a deleted id can come back as a new preference in the same delta
+        for preference_id in removed_ids:
+            overlay.pop(preference_id, None)
+            if preference_id in self._base:
+                removed.add(preference_id)
+        for record in changed:
+            overlay[record.id] = record
+            removed.discard(record.id)
+
+        match_index = None
+        if today == self.index_date:
+            touched = set(removed_ids) | {record.id for record in changed}
+            previous = (self.get(preference_id) for preference_id in touched)
+            match_index = self._match_index.updated(
+                [record for record in previous if record is not None and record.is_active(today)],
+                [record for record in changed if record.is_active(today)]
+            )
+
+        if len(overlay) + len(removed) > max(1024, len(self._base) // 8):
+            base = {record.id: record for record in self._iter_base_without(removed, overlay)}
+            base.update(overlay)
+            return Snapshot(base, watermark=watermark, match_index=match_index, index_date=today)
+        return Snapshot(self._base, overlay, frozenset(removed), watermark, match_index, today)
+
+    def _iter_base_without(self, removed, overlay):
+        for preference_id, record in self._base.items():
+            if preference_id not in removed and preference_id not in overlay:
+                yield record
+
+class SnapshotStore:
+    """Holds the current Snapshot and refreshes it from the delta since the last refresh.
+
+    Readers take store.current and keep using that object; a refresh builds
+    the next snapshot, match index included, on the side and swaps the
+    reference in one assignment, so readers never wait. Changes are found exactly like delta exports find
+    them (exports.delta_export): Preference.updated_at for edits and
+    DeletedPreference tombstones for deletions, behind an opaque watermark.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.current = Snapshot({})
+        self._refresh_lock = threading.Lock()
+
+    def load(self):
+        """Build a full snapshot, replacing the current one"""
+        with self._refresh_lock:
+            changed, _, watermark = delta_export(None)
+            base = {pref.id: SubscriberRecord(pref)
+                    for pref in iter_preferences(changed, self.batch_size) if _is_active(pref)}
+            self.current = Snapshot(base, watermark=watermark)
+            logger.info(f"Loaded subscriber snapshot with {len(base)} records")
+            return self.current
+
+    def refresh(self):
+        """Apply the changes since the last load/refresh; returns (records changed, records removed)"""
+        with self._refresh_lock:
+            snapshot = self.current
+            if snapshot.watermark is None:
+                raise RuntimeError("Load the snapshot before refreshing it")
+
+            changed_query, deleted_query, watermark = delta_export(snapshot.watermark)
+            changed = []
+            removed = deleted_query.with_entities(DeletedPreference.preference_id)\
+                .order_by(DeletedPreference.id).all()
+            removed = [preference_id for (preference_id,) in removed]
+            for pref in iter_preferences(changed_query, self.batch_size):
+                if _is_active(pref):
+                    changed.append(SubscriberRecord(pref))
+                else:
+                    removed.append(pref.id)
+
+            self.current = snapshot.apply(removed, changed, watermark)
+            return len(changed), len(removed)
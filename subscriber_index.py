@@ -0,0 +1,287 @@
+import os
+import mmap
+import struct
+import logging
+from datetime import date
+
+import numpy as np
+
+from models import IPHONE_MODELS
+from matching import NEAR_GOOD_DEAL_MARGIN, Subscriber, normalize_location
+from batch_matching import MODE_CODES, collect_product_cells, product_matrices
+from snapshot import ProductRecord
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# File layout (little-endian):
+#   header     magic, format version, section count, subscriber count, model count
+#   directory  one (name, offset, byte length) entry per section
+#   sections   fixed-width arrays, each starting on an 8-byte boundary
+# Rows are sorted by location code, then preference id. String columns are
+# stored as an offsets array (rows + 1) into a UTF-8 blob plus a null mask.
+MAGIC = b'IFSI'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+SECTION = struct.Struct('<16sQQ')
+ALIGNMENT = 8
+
+# expiry column value for preferences without an expiry date
+NO_EXPIRY = np.iinfo(np.int32).max
+EPOCH = date(1970, 1, 1)
+
+# Section name -> dtype; the product sections are (subscribers, models) matrices
+COLUMNS = {
+    'ids': '<i8',
+    'modes': 'i1',
+    'location': '<i4',
+    'expiry': '<i4',       # Days since 1970-01-01
+    'lat': '<f8',          # NaN when unknown
+    'lon': '<f8',
+    'kw_set': '<i8',       # 0 means the default word set
+    'ex_set': '<i8',
+    'prices': '<i8',
+    'pref': 'u1',
+}
+STRING_COLUMNS = ('uid', 'tg_id', 'name')       # unique_userid, user_id, user_name
+TABLES = ('models', 'locs')                     # Column and location code -> name
+MODE_NAMES = {code: mode for mode, code in MODE_CODES.items()}
+
+def _pack_strings(values):
+    """Encode strings (or None) as (offsets, blob, null mask) arrays"""
+    encoded = [(value or '').encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    nulls = np.array([value is None for value in values], dtype='u1')
+    return offsets, np.frombuffer(b''.join(encoded), dtype='u1'), nulls
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_subscriber_index(path, preferences):
+    """Write preferences (ordered by id, with products loaded) to path; returns the subscriber count.
+
+    Accepts ORM preferences or snapshot.SubscriberRecord objects. The file is
+    written next to path and renamed over it, so processes that already
+    mapped the old file keep a consistent view.
+    """
+    ids, unique_userids, user_ids, user_names, locations, mode_codes = [], [], [], [], [], []
+    expiry, latitudes, longitudes, keyword_sets, excluded_sets = [], [], [], [], []
+    models = {name: column for column, name in enumerate(IPHONE_MODELS)}
+    cells = {}
+
+    for row, pref in enumerate(preferences):
+        ids.append(pref.id)
+        unique_userids.append(pref.get_unique_userid())
+        user_ids.append(pref.user_id)
+        user_names.append(pref.user_name)
+        locations.append(normalize_location(pref.location))
+        mode_codes.append(MODE_CODES.get(pref.notification_mode, -1))
+        expiry.append(NO_EXPIRY if pref.expiry_date is None else (pref.expiry_date - EPOCH).days)
+        latitudes.append(np.nan if pref.latitude is None else pref.latitude)
+        longitudes.append(np.nan if pref.longitude is None else pref.longitude)
+        keyword_sets.append(pref.keyword_set_id or 0)
+        excluded_sets.append(pref.excluded_set_id or 0)
+        collect_product_cells(row, pref.products, models, cells)
+
+    location_names = sorted(set(locations))
+    location_codes = {name: code for code, name in enumerate(location_names)}
+    location_column = np.array([location_codes[name] for name in locations], dtype='<i4')
+    ids = np.array(ids, dtype='<i8')
+    order = np.lexsort((ids, location_column))
+
+    max_prices, preferred = product_matrices(cells, len(ids), len(models))
+    columns = {
+        'ids': ids, 'modes': mode_codes, 'location': location_column, 'expiry': expiry,
+        'lat': latitudes, 'lon': longitudes, 'kw_set': keyword_sets, 'ex_set': excluded_sets,
+        'prices': max_prices, 'pref': preferred,
+    }
+    sections = [(name, np.asarray(columns[name], dtype=dtype)[order]) for name, dtype in COLUMNS.items()]
+    for name, values in zip(STRING_COLUMNS, (unique_userids, user_ids, user_names)):
+        offsets, blob, nulls = _pack_strings([values[row] for row in order.tolist()])
+        sections += [(f'{name}.off', offsets), (f'{name}.str', blob), (f'{name}.nul', nulls)]
+    for name, values in zip(TABLES, (list(models), location_names)):
+        offsets, blob, _ = _pack_strings(values)
+        sections += [(f'{name}.off', offsets), (f'{name}.str', blob)]
+
+    directory = []
+    offset = _align(HEADER.size + SECTION.size * len(sections))
+    for name, values in sections:
+        directory.append((name, offset, values.nbytes))
+        offset = _align(offset + values.nbytes)
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), len(ids), len(models)))
+        for name, offset, nbytes in directory:
+            index_file.write(SECTION.pack(name.encode('ascii'), offset, nbytes))
+        for (name, values), (_, offset, _) in zip(sections, directory):
+            index_file.write(b'\0' * (offset - index_file.tell()))
+            index_file.write(np.ascontiguousarray(values).tobytes())
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(temp_path, path)
+
+    logger.info(f"Wrote subscriber index for {len(ids)} subscribers to {path}")
+    return len(ids)
+
+class IndexedPreference:
+    """One live row of a MappedSubscriberIndex, with the attributes MatchIndex.build() reads.
+
+    products holds the preferred models only, which are all the matchers look at.
+    """
+    __slots__ = ('id', 'unique_userid', 'user_id', 'user_name', 'location', 'notification_mode',
+                 'keyword_set_id', 'excluded_set_id', 'products')
+
+    def __init__(self, subscriber, location, products):
+        self.id = subscriber.preference_id
+        self.unique_userid = subscriber.unique_userid
+        self.user_id = subscriber.user_id
+        self.user_name = subscriber.user_name
+        self.location = location
+        self.notification_mode = subscriber.notification_mode
+        self.keyword_set_id = subscriber.keyword_set_id
+        self.excluded_set_id = subscriber.excluded_set_id
+        self.products = products
+
+    def get_unique_userid(self):
+        return self.unique_userid
+
+class MappedSubscriberIndex:
+    """Read-only subscriber index memory-mapped from a file written by write_subscriber_index().
+
+    Opening maps the file and wraps each section in a numpy view, so nothing
+    is parsed or copied per subscriber and processes mapping the same file
+    share its pages through the OS cache. match() returns the same
+    recipients, in the same order, as matching.MatchIndex built from the
+    preferences the file was written from; Subscriber objects are only
+    created for the rows a listing matches.
+    """
+
+    def __init__(self, path, buffer, today=None):
+        self.path = path
+        self._buffer = buffer
+        self.today = today or date.today()
+        self._today_days = (self.today - EPOCH).days
+
+        magic, version, section_count, subscribers, model_count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a subscriber index")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} has index format {version}, expected {FORMAT_VERSION}")
+
+        self._sections = {}
+        for position in range(section_count):
+            name, offset, nbytes = SECTION.unpack_from(buffer, HEADER.size + position * SECTION.size)
+            self._sections[name.rstrip(b'\0').decode('ascii')] = (offset, nbytes)
+
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, self._array(name, dtype))
+        self.prices = self.prices.reshape(subscribers, model_count)
+        self.pref = self.pref.reshape(subscribers, model_count)
+        self._strings = {name: (self._array(f'{name}.off', '<u8'), self._array(f'{name}.str', 'u1'))
+                         for name in STRING_COLUMNS + TABLES}
+        self._nulls = {name: self._array(f'{name}.nul', 'u1') for name in STRING_COLUMNS}
+
+        self.models = {name: column for column, name in enumerate(self._table('models'))}
+        self.locations = {name: code for code, name in enumerate(self._table('locs'))}
+        codes = np.arange(len(self.locations))
+        starts = np.searchsorted(self.location, codes, side='left').tolist()
+        ends = np.searchsorted(self.location, codes, side='right').tolist()
+        self._bounds = dict(zip(codes.tolist(), zip(starts, ends)))
+
+    @classmethod
+    def open(cls, path, today=None):
+        """Map the index at path; expiry dates are checked against today (default: the current date)"""
+        with open(path, 'rb') as index_file:
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(path, buffer, today)
+
+    @property
+    def subscriber_count(self):
+        return len(self.ids)
+
+    def _array(self, name, dtype):
+        offset, nbytes = self._sections[name]
+        dtype = np.dtype(dtype)
+        if nbytes == 0:
+            # Empty sections may point past the end of the file
+            return np.empty(0, dtype=dtype)
+        return np.frombuffer(self._buffer, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset)
+
+    def _string(self, name, row):
+        offsets, blob = self._strings[name]
+        return bytes(blob[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def _nullable_string(self, name, row):
+        if self._nulls[name][row]:
+            return None
+        return self._string(name, row)
+
+    def _table(self, name):
+        return [self._string(name, row) for row in range(len(self._strings[name][0]) - 1)]
+
+    def subscriber(self, row):
+        """Subscriber for one row of the index"""
+        keyword_set_id, excluded_set_id = int(self.kw_set[row]), int(self.ex_set[row])
+        return Subscriber(
+            int(self.ids[row]), self._string('uid', row), self._nullable_string('tg_id', row),
+            self._nullable_string('name', row), MODE_NAMES.get(int(self.modes[row])),
+            keyword_set_id or None, excluded_set_id or None
+        )
+
+    def match_rows(self, product_name, price, location):
+        """Rows to notify about a listing, ordered like MatchIndex.match()"""
+        code = self.locations.get(normalize_location(location))
+        if code is None:
+            return []
+        start, end = self._bounds[code]
+        modes = self.modes[start:end]
+        live = self.expiry[start:end] >= self._today_days
+        rows = np.flatnonzero(live & (modes == MODE_CODES['all']))
+
+        column = self.models.get(product_name)
+        if column is not None:
+            preferred = self.pref[start:end, column].astype(bool)
+            max_prices = self.prices[start:end, column]
+            thresholds = np.select(
+                [preferred & (modes == MODE_CODES['only_preferred']),
+                 preferred & (modes == MODE_CODES['near_good_deal']),
+                 preferred & (modes == MODE_CODES['good_deal'])],
+                [np.inf, max_prices + NEAR_GOOD_DEAL_MARGIN, max_prices],
+                default=-np.inf
+            )
+            # Rows within a location are in preference id order, so row breaks ties like MatchIndex
+            matched = np.flatnonzero(live & (thresholds >= price))
+            matched = matched[np.lexsort((matched, thresholds[matched]))]
+            rows = np.concatenate([rows, matched])
+
+        return (rows + start).tolist()
+
+    def preferences(self, locations):
+        """IndexedPreference for every live row in locations (normalized names), in id order per location.
+
+        Only the rows of those locations are read from the file, so a matcher
+        shard can build a MatchIndex for its own part of the index.
+        """
+        models = self._table('models')
+        for location in locations:
+            code = self.locations.get(location)
+            if code is None:
+                continue
+            start, end = self._bounds[code]
+            live = np.flatnonzero(self.expiry[start:end] >= self._today_days) + start
+            rows, columns = np.nonzero(self.pref[live].astype(bool))
+            preferred = {}
+            for row, column in zip(live[rows].tolist(), columns.tolist()):
+                preferred.setdefault(row, []).append(ProductRecord(models[column], int(self.prices[row, column]), True))
+            for row in live.tolist():
+                yield IndexedPreference(self.subscriber(row), location, tuple(preferred.get(row, ())))
+
+    def match(self, product_name, price, location):
+        """Return the subscribers to notify about a listing, 'all' subscribers first"""
+        return [self.subscriber(row) for row in self.match_rows(product_name, price, location)]
+
+    def match_ids(self, product_name, price, location):
+        """Preference ids to notify about a listing, without building Subscriber objects"""
+        return self.ids[self.match_rows(product_name, price, location)].tolist()
@@ -3,11 +3,30 @@ import hmac
 import time
 import logging
 from functools import wraps
+from urllib.parse import urlencode
 from flask import request, abort, g, current_app, redirect, url_for, session
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+def sign_link_data(secret_key, data):
+    """(query string, HMAC-SHA256 signature) for link data; keys are sorted so bot and app agree"""
+    query_string = "&".join(f"{key}={data[key]}" for key in sorted(data))
+    return query_string, hmac.new(secret_key.encode(), query_string.encode(), hashlib.sha256).hexdigest()
+
+def generate_secure_link(config, user_id, user_name):
+    """Signed /telegram-form link for a Telegram user, from an app config (SECRET_KEY, WEBAPP_URL).
+
+    verify_telegram_auth() checks the signature against the same config.
+    """
+    data = {
+        'user_id': str(user_id),
+        'user_name': user_name,
+        'timestamp': str(int(time.time()))
+    }
+    _, signature = sign_link_data(config['SECRET_KEY'], data)
+    return f"{config['WEBAPP_URL']}/telegram-form?{urlencode(dict(data, signature=signature))}"
+
 def verify_telegram_auth(f):
     """Decorator to verify Telegram authentication from URL parameters."""
     @wraps(f)
@@ -47,18 +66,8 @@ def verify_telegram_auth(f):
             'timestamp': timestamp
         }
         
-        # Create query string in the exact same order as the bot
-        query_params = []
-        for key in sorted(data.keys()):
-            query_params.append(f"{key}={data[key]}")
-        query_string = "&".join(query_params)
-        
-        # Generate expected signature
-        expected_signature = hmac.new(
-            current_app.config['SECRET_KEY'].encode(),
-            query_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        # Sign the query string exactly as generate_secure_link() did
+        query_string, expected_signature = sign_link_data(current_app.config['SECRET_KEY'], data)
         
         # Log signatures for debugging
         logger.info(f"Query string used for verification: {query_string}")
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+
+# Keep the module-level app in app_fix away from the development database and cache dirs
+_scratch = tempfile.mkdtemp(prefix='iphone_flippers_tests_')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_scratch, 'import.db')}")
+os.environ.setdefault('EXPORT_CACHE_DIR', os.path.join(_scratch, 'exports'))
+os.environ.setdefault('JOB_STORAGE_DIR', os.path.join(_scratch, 'jobs'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app_fix import create_app
+from config import Config
+from models import db, Preference, ProductPreference, IPHONE_MODELS, DEFAULT_PRICES
+
+@pytest.fixture
+def app(tmp_path):
+    class TestConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'test.db'}"
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+@pytest.fixture
+def seed(app):
+    """Add count preferences with products models each; returns the new preferences"""
+    def seed(count, products=3, start=0):
+        preferences = []
+        for number in range(start, start + count):
+            preference = Preference(location='Sydney' if number % 2 else 'Melbourne', notification_mode='all',
+                                    user_id=str(1000 + number), user_name=f'user{number}')
+            preference.products = [ProductPreference(product_name=model, max_price=DEFAULT_PRICES[model],
+                                                     is_preferred=True)
+                                   for model in IPHONE_MODELS[:products]]
+            db.session.add(preference)
+            preferences.append(preference)
+        db.session.commit()
+        return preferences
+    return seed
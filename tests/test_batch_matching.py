@@ -0,0 +1,66 @@
+import gc
+import time
+import random
+
+from batch_matching import load_batch_matcher
+from matching import load_match_index
+from models import db, IPHONE_MODELS, DEFAULT_PRICES
+
+MODES = ['all', 'only_preferred', 'near_good_deal', 'good_deal', 'unknown_mode']
+
+def _vary(preferences, locations):
+    """Spread seeded preferences over modes, locations, prices and preferred flags"""
+    rng = random.Random(0)
+    for number, preference in enumerate(preferences):
+        preference.notification_mode = MODES[number % len(MODES)]
+        preference.location = rng.choice(locations)
+        for product in preference.products:
+            product.max_price += rng.choice([-100, 0, 0, 50])
+            product.is_preferred = rng.random() < 0.8
+    db.session.commit()
+
+def _ids(results):
+    return [[subscriber.preference_id for subscriber in recipients] for recipients in results]
+
+def _best(function, repeat=5):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def test_match_batch_equals_match_index(app, seed):
+    _vary(seed(60, products=5), ['Sydney', ' sydney', 'Melbourne', 'Perth '])
+    index = load_match_index(7)
+    matcher = load_batch_matcher(7)
+
+    listings = []
+    for model in IPHONE_MODELS[:6] + ['Nokia 3310']:
+        base = DEFAULT_PRICES.get(model, 500)
+        prices = [0, -5, base - 101, base - 100, base - 1, base, base + 0.5, base + 50, base + 100, base + 101,
+                  base + 150, 10 ** 9]
+        for location in ['Sydney', ' MELBOURNE ', 'perth', 'Hobart', '']:
+            listings.extend((model, price, location) for price in prices)
+    rng = random.Random(1)
+    rng.shuffle(listings)
+
+    results = matcher.match_batch(listings)
+    assert _ids(results) == _ids(index.match(*listing) for listing in listings)
+    # Every listing gets a list of its own, even when listings share their recipients
+    assert len({id(recipients) for recipients in results}) == len(results)
+    assert matcher.match_batch([]) == []
+
+def test_match_batch_beats_one_by_one_matching(app, seed):
+    _vary(seed(400, products=5), [f'Town {number}' for number in range(10)])
+    index = load_match_index(100)
+    matcher = load_batch_matcher(100)
+
+    rng = random.Random(2)
+    burst = [(rng.choice(IPHONE_MODELS), rng.randint(100, 1500), f'Town {rng.randrange(10)}') for _ in range(5000)]
+
+    scalar = _best(lambda: [index.match(*listing) for listing in burst])
+    batched = _best(lambda: matcher.match_batch(burst))
+    assert batched < scalar, f"batched {batched * 1000:.1f}ms vs scalar {scalar * 1000:.1f}ms"
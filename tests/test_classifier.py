@@ -0,0 +1,40 @@
+import pytest
+
+from classifier import TitleClassifier, default_classifier, tokenize
+
+@pytest.mark.parametrize('title, model', [
+    ('Apple iPhone 15 Pro Max 256GB', 'iPhone 15 Pro Max'),
+    ('iphone15 pro, barely used', 'iPhone 15 Pro'),
+    ('IPHONE 13 MINI blue', 'iPhone 13 Mini'),
+    ('iPhone 13 128gb', 'iPhone 13'),
+    ('iPhone SE (2022) red', 'iPhone SE (2022)'),
+    ('iPhone XS Max gold', 'iPhone XS Max'),
+    # The longest match wins wherever it starts; equally long ones go to the earliest
+    ('iPhone 14 like an iPhone 14 Pro Max', 'iPhone 14 Pro Max'),
+    ('iPhone 12 or iPhone 11 swap', 'iPhone 12'),
+    ('Samsung Galaxy S24', None),
+    ('iPhone', None),
+    ('', None),
+])
+def test_longest_model_match(title, model):
+    assert default_classifier().scan(title) == (model, None)
+
+@pytest.mark.parametrize('title, excluded_word', [
+    ('iPhone 15 Pro car mount', 'car'),
+    ('Stand for iPhone 14', 'stand'),
+    ('C@$h paid for iPhones', 'C@$h'),
+    ('iPhone 11 lcd screen', 'LCD'),
+])
+def test_any_excluded_word_rejects_the_title(title, excluded_word):
+    assert default_classifier().scan(title) == (None, excluded_word)
+
+def test_excluded_words_match_whole_tokens():
+    classifier = TitleClassifier(['iPhone 15'], ['screen protector', 'car'])
+    assert classifier.scan('iPhone 15 carbon case, screen intact') == ('iPhone 15', None)
+    assert classifier.scan('iPhone 15 screen protector x3') == (None, 'screen protector')
+    assert classifier.classify('iPhone 15 screen protector x3') is None
+
+def test_scan_tokens_matches_scan():
+    classifier = default_classifier()
+    title = 'Unlocked iPhone 16 Pro 512GB desert titanium'
+    assert classifier.scan_tokens(tokenize(title)) == classifier.scan(title) == ('iPhone 16 Pro', None)
@@ -0,0 +1,118 @@
+import pytest
+
+from dedup import LruDedupStore, BloomDedupStore, listing_fingerprint, open_dedup_store
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_fingerprints_ignore_spacing_and_case_but_not_price():
+    fingerprint = listing_fingerprint('iPhone 15 Pro  256GB', 900, 'Sydney')
+    assert listing_fingerprint(' IPHONE 15 pro 256gb', 900, ' sydney ') == fingerprint
+    assert listing_fingerprint('iPhone 15 Pro 256GB', 850, 'Sydney') != fingerprint
+
+def test_lru_pairs_expire_a_ttl_after_first_notified():
+    clock = FakeClock()
+    store = LruDedupStore(capacity=10, ttl=60, clock=clock)
+    assert store.check_and_add(1, 7) is False
+    assert store.check_and_add(1, 8) is False
+    clock.now = 59
+    assert store.check_and_add(1, 7) is True
+    # Being seen again doesn't extend the TTL
+    clock.now = 60
+    assert store.check_and_add(1, 7) is False
+    assert store.check_and_add(1, 8) is False
+    assert store.stats.as_dict() == {'checked': 5, 'duplicates': 1}
+
+def test_lru_forgets_the_least_recently_seen_pairs_over_capacity():
+    store = LruDedupStore(capacity=3, ttl=60, clock=FakeClock())
+    for fingerprint in range(3):
+        store.check_and_add(fingerprint, 1)
+    assert store.check_and_add(0, 1) is True
+    store.check_and_add(3, 1)
+
+    assert len(store) == 3
+    assert [store.check_and_add(fingerprint, 1) for fingerprint in (0, 2, 3)] == [True, True, True]
+    assert store.check_and_add(1, 1) is False
+
+def test_lru_state_survives_a_restart_minus_expired_pairs(tmp_path):
+    path = str(tmp_path / 'dedup.npz')
+    clock = FakeClock()
+    store = open_dedup_store(path, 'lru', ttl=60, clock=clock)
+    store.check_and_add(1, 1)
+    clock.now = 30
+    store.check_and_add(2, 1)
+    store.check_and_add(3, 1)
+    store.save(path)
+
+    clock.now = 70
+    restored = open_dedup_store(path, 'lru', ttl=60, clock=clock)
+    assert len(restored) == 2
+    assert restored.check_and_add(2, 1) is True
+    assert restored.check_and_add(1, 1) is False
+    # A smaller capacity keeps the most recently seen pairs
+    assert len(open_dedup_store(path, 'lru', capacity=1, ttl=60, clock=clock)) == 1
+
+def test_bloom_pairs_last_between_most_of_the_ttl_and_all_of_it():
+    clock = FakeClock()
+    store = BloomDedupStore(capacity=100, ttl=40, generations=4, clock=clock)
+    assert store.check_and_add(1, 1) is False
+    clock.now = 5
+    assert store.check_and_add(2, 1) is False
+    clock.now = 39
+    assert store.check_and_add(1, 1) is True
+    assert store.check_and_add(2, 1) is True
+    clock.now = 40
+    assert store.check_and_add(1, 1) is False
+    # After a whole TTL without listings every generation has expired
+    clock.now = 1000
+    assert store.check_and_add(1, 1) is False
+    assert len(store) == 1
+
+def test_bloom_has_no_false_negatives_and_few_false_positives():
+    store = BloomDedupStore(capacity=10000, ttl=60, error_rate=0.001, clock=FakeClock())
+    assert not any(store.check_and_add(fingerprint, 3) for fingerprint in range(10000))
+    assert all(store.check_and_add(fingerprint, 3) for fingerprint in range(10000))
+    false_positives = sum(store.check_and_add(fingerprint, 4) for fingerprint in range(10000))
+    assert false_positives <= 20
+
+def test_a_full_bloom_generation_rotates_early():
+    store = BloomDedupStore(capacity=10, ttl=60, generations=2, clock=FakeClock())
+    for fingerprint in range(25):
+        store.check_and_add(fingerprint, 1)
+    # Two rotations: the first ten pairs went with the generation that was cleared
+    assert len(store) == 15
+    assert store.check_and_add(24, 1) is True
+    assert sum(store.check_and_add(fingerprint, 1) for fingerprint in range(10)) <= 1
+
+def test_bloom_state_survives_a_restart_with_the_same_settings(tmp_path):
+    path = str(tmp_path / 'dedup.npz')
+    clock = FakeClock()
+    store = open_dedup_store(path, 'bloom', capacity=1000, ttl=40, clock=clock)
+    for fingerprint in range(50):
+        store.check_and_add(fingerprint, 1)
+    clock.now = 25
+    store.save(path)
+
+    restored = open_dedup_store(path, 'bloom', capacity=1000, ttl=40, clock=clock)
+    assert len(restored) == 50
+    assert all(restored.check_and_add(fingerprint, 1) for fingerprint in range(50))
+    # Rotation carries on from the saved schedule rather than restarting it
+    clock.now = 40
+    assert restored.check_and_add(0, 1) is False
+
+    assert len(open_dedup_store(path, 'bloom', capacity=2000, ttl=40, clock=clock)) == 0
+
+def test_a_store_saved_in_another_mode_starts_empty(tmp_path):
+    path = str(tmp_path / 'dedup.npz')
+    store = open_dedup_store(path, 'lru')
+    store.check_and_add(1, 1)
+    store.save(path)
+
+    assert len(open_dedup_store(path, 'bloom', capacity=1000)) == 0
+    assert len(open_dedup_store(path, 'lru')) == 1
+    with pytest.raises(ValueError):
+        open_dedup_store(path, 'cuckoo')
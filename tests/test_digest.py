@@ -0,0 +1,82 @@
+import asyncio
+from collections import deque
+
+from digest import DigestBuffer, DigestStage, format_digest
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_buffers_flush_when_their_window_runs_out():
+    clock = FakeClock()
+    buffer = DigestBuffer(window=10, max_items=5, max_users=10, clock=clock)
+    assert buffer.add(1, 'a') == [] and buffer.add(2, 'b') == []
+    clock.now = 5
+    assert buffer.add(1, 'c') == []
+    assert buffer.seconds_to_next_flush() == 5
+
+    clock.now = 10
+    assert buffer.expired() == [(1, format_digest(['a', 'c'])), (2, 'b')]
+    assert buffer.seconds_to_next_flush() is None
+    assert buffer.stats.as_dict()['saved'] == 1
+
+def test_full_buffers_and_user_pressure_flush_early():
+    buffer = DigestBuffer(window=10, max_items=2, max_users=2, max_chars=40, clock=FakeClock())
+    assert buffer.add(1, 'a') == []
+    assert buffer.add(1, 'b') == [(1, format_digest(['a', 'b']))]
+    assert buffer.add(1, 'x' * 30) == []
+    # The digest would pass max_chars, so the buffered match goes out alone first
+    assert buffer.add(1, 'y' * 10) == [(1, 'x' * 30)]
+    assert buffer.add(2, 'c') == []
+    assert buffer.add(3, 'd') == [(1, 'y' * 10)]
+    assert len(buffer) == 2
+    assert (buffer.stats.full_flushes, buffer.stats.pressure_flushes) == (2, 1)
+
+async def _run_stage(stage, jobs):
+    inbox, outbox = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.ensure_future(stage.run(inbox, outbox))
+    for job in jobs:
+        await inbox.put(job)
+    await inbox.put(None)
+    await task
+
+    sent = []
+    while True:
+        item = outbox.get_nowait()
+        if item is None:
+            return sent
+        sent.append(item)
+
+class SlowInbox:
+    """Inbox whose get() takes a job and then needs a moment before returning it"""
+
+    def __init__(self, jobs):
+        self.jobs = deque(jobs)
+
+    async def get(self):
+        job = self.jobs.popleft() if self.jobs else None
+        await asyncio.sleep(0.01)
+        return job
+
+def test_a_deadline_never_drops_a_job_the_inbox_already_took():
+    stage = DigestStage(DigestBuffer(window=0.001), modes=['all'])
+    jobs = [(1, f'm{number}', 'all') for number in range(5)]
+
+    async def run():
+        # Made inside the loop: on Python 3.9 a Queue binds to the current loop when created
+        outbox = asyncio.Queue()
+        await stage.run(SlowInbox(jobs), outbox)
+        return [outbox.get_nowait() for _ in range(outbox.qsize())]
+    sent = asyncio.run(run())
+    assert sent[-1] is None
+    assert [text for _, text in sent[:-1]] == [message for _, message, _ in jobs]
+    assert stage.stats.window_flushes == len(jobs)
+
+def test_other_modes_pass_straight_through():
+    stage = DigestStage(DigestBuffer(window=60), modes=['all'])
+    sent = asyncio.run(_run_stage(stage, [(1, 'a', 'all'), (1, 'b', 'good_deal'), (None, 'c'), (1, 'd', 'all')]))
+    assert sent == [(1, 'b'), (None, 'c'), (1, format_digest(['a', 'd']))]
+    assert stage.stats.final_flushes == 1
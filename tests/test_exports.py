@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, update, text
+
+from exports import (stream_export_zip, stream_export_csv, stream_export_xlsx, delta_export, write_through_cache,
+                     cache_path, _deleted_rows)
+from models import db, Preference, DeletedPreference
+
+EXPORTS = {
+    'zip': stream_export_zip,
+    'csv': stream_export_csv,
+    'xlsx': stream_export_xlsx,
+}
+
+@contextmanager
+def count_queries():
+    """Count the statements sent to the database inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+def _export_queries(export, batch_size):
+    db.session.expire_all()
+    with count_queries() as statements:
+        for _ in export(Preference.query, batch_size):
+            pass
+    return len(statements)
+
+@pytest.mark.parametrize('kind', sorted(EXPORTS))
+def test_export_query_count_does_not_grow_with_preferences(app, seed, kind):
+    seed(5)
+    few = _export_queries(EXPORTS[kind], 100)
+    seed(60, start=5)
+    many = _export_queries(EXPORTS[kind], 100)
+
+    assert many == few
+
+@pytest.mark.parametrize('kind', sorted(EXPORTS))
+def test_export_query_count_grows_by_batch_not_by_preference(app, seed, kind):
+    seed(20)
+    two_batches = _export_queries(EXPORTS[kind], 10)
+    seed(40, start=20)
+    six_batches = _export_queries(EXPORTS[kind], 10)
+
+    # Each extra batch costs a fixed number of queries (the page and its products), never one per user
+    per_batch = (six_batches - two_batches) / 4
+    assert per_batch == int(per_batch)
+    assert per_batch <= 2 * 2      # zip reads preferences twice: users.csv and products.csv
+
+def _stamp(model, column, value):
+    db.session.execute(update(model).values({column: value}))
+    db.session.commit()
+
+def test_delta_export_sends_rows_committed_late_with_an_earlier_updated_at(app, seed):
+    synced = seed(3)
+    _, _, watermark = delta_export(None)
+
+    # An import batch stamped before the last sync that only commits after it
+    late = seed(1, start=3)[0]
+    stamped = synced[0].updated_at - timedelta(seconds=1)
+    db.session.execute(update(Preference).where(Preference.id == late.id).values(updated_at=stamped))
+    db.session.commit()
+
+    changed, _, _ = delta_export(watermark)
+    assert late.id in {pref.id for pref in changed}
+
+def test_delta_export_stops_sending_changes_older_than_the_lag(app, seed):
+    preferences = seed(3)
+    db.session.delete(preferences[0])
+    db.session.commit()
+    an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+    _stamp(Preference, 'updated_at', an_hour_ago)
+    _stamp(DeletedPreference, 'deleted_at', an_hour_ago)
+
+    changed, deleted, watermark = delta_export(None, lag=60)
+    assert (changed.count(), deleted.count()) == (2, 1)
+    changed, deleted, watermark = delta_export(watermark, lag=60)
+    assert (changed.count(), deleted.count()) == (0, 0)
+
+    # Recent changes are sent again until they are lag seconds old
+    seed(1, start=3)
+    _, _, watermark = delta_export(watermark, lag=60)
+    changed, _, _ = delta_export(watermark, lag=60)
+    assert changed.count() == 1
+
+def test_tombstones_are_paged_so_writers_are_not_locked_out(app, seed):
+    preferences = seed(5)
+    for preference in preferences:
+        db.session.delete(preference)
+    db.session.commit()
+    _, deleted, _ = delta_export(None)
+
+    rows = []
+    with count_queries() as statements:
+        for row in _deleted_rows(deleted, 2):
+            rows.append(row)
+            # Job progress is written from another connection while the tombstones stream
+            with db.engine.begin() as conn:
+                conn.execute(text("INSERT INTO job (id, kind, status, rows_done) VALUES (:id, 'export', 'running', :done)"),
+                             {'id': f'job{len(rows)}', 'done': len(rows)})
+
+    assert [row[0] for row in rows] == [preference.get_unique_userid() for preference in preferences]
+    assert len([statement for statement in statements if 'deleted_preference' in statement]) == 3
+
+def test_concurrent_downloads_of_one_export_each_write_their_own_temp_file(tmp_path):
+    chunks = [b'users,', b'products,', b'word sets']
+    first = write_through_cache(iter(chunks), str(tmp_path), 'zip', 'etag')
+    second = write_through_cache(iter(chunks), str(tmp_path), 'zip', 'etag')
+
+    # Two threads of the same worker, streaming in lockstep
+    for pair in zip(first, second):
+        assert pair[0] == pair[1]
+    for remaining in (first, second):
+        assert list(remaining) == []
+
+    with open(cache_path(str(tmp_path), 'zip', 'etag'), 'rb') as cached:
+        assert cached.read() == b''.join(chunks)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['zip_etag']
+
+def test_interrupted_download_leaves_no_temp_file(tmp_path):
+    download = write_through_cache(iter([b'a', b'b']), str(tmp_path), 'zip', 'etag')
+    next(download)
+    download.close()
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,90 @@
+import random
+
+import pytest
+
+import models
+from geo import GeoIndex, haversine_km, grid_cell, cells_within, geo_fields
+from geocoder import Gazetteer, default_gazetteer, normalize_place, cache_key
+from models import db, GeocodeCache
+
+SYDNEY = (-33.8688, 151.2093)
+RICHMOND_NSW = (-33.6, 150.75)
+RICHMOND_VIC = (-37.823, 144.998)
+
+@pytest.mark.parametrize('text, place', [
+    ('Richmond, VIC 3121', ('richmond', 'VIC')),
+    ('  SYDNEY new south wales Australia', ('sydney', 'NSW')),
+    ('St. Kilda', ('st kilda', None)),
+    (None, ('', None)),
+])
+def test_normalize_place(text, place):
+    assert normalize_place(text) == place
+
+def test_gazetteer_lookups():
+    gazetteer = default_gazetteer()
+    assert gazetteer.lookup('Sydney') == SYDNEY
+    # Same-named suburbs resolve to the one nearest the city, unless a state is given
+    assert gazetteer.lookup('Sydney', 'Richmond') == RICHMOND_NSW
+    assert gazetteer.lookup('Melbourne', 'Richmond') == RICHMOND_VIC
+    assert gazetteer.lookup('Sydney', 'Richmond VIC') == RICHMOND_VIC
+    # Unknown suburbs fall back to the city
+    assert gazetteer.lookup('sydney nsw', 'Nowhereville') == SYDNEY
+    assert gazetteer.lookup('Atlantis') is None
+
+def test_bare_names_prefer_cities():
+    gazetteer = Gazetteer([('Springfield', 'QLD', 'suburb', '-27.65', '152.9'),
+                           ('Springfield', 'VIC', 'city', '-37.0', '145.0')])
+    assert gazetteer.lookup('Springfield') == (-37.0, 145.0)
+    assert gazetteer.lookup('Springfield QLD') == (-27.65, 152.9)
+
+def test_geocode_cache_remembers_hits_and_misses(app, monkeypatch):
+    lookups = []
+    gazetteer = default_gazetteer()
+
+    class CountingGazetteer:
+        def lookup(self, location, suburb=None):
+            lookups.append((location, suburb))
+            return gazetteer.lookup(location, suburb)
+    monkeypatch.setattr(models, 'default_gazetteer', lambda: CountingGazetteer())
+
+    places = [('Sydney', 'Richmond'), ('SYDNEY ', 'richmond'), ('Atlantis', None)]
+    first = GeocodeCache.resolve_many(places)
+    db.session.commit()
+    second = GeocodeCache.resolve_many(places)
+
+    assert first == second == {cache_key('Sydney', 'Richmond'): RICHMOND_NSW, cache_key('Atlantis', None): None}
+    assert len(lookups) == 2
+
+def test_fixed_coordinates_need_both_values():
+    assert geo_fields('-33.8688', ' 151.2093 ') == {'latitude': -33.8688, 'longitude': 151.2093,
+                                                   'geo_cell': grid_cell(*SYDNEY)}
+    for fixed_lat, fixed_lon in [('-33.8', None), ('abc', '151'), ('91', '151'), ('-33.8', 'nan')]:
+        assert geo_fields(fixed_lat, fixed_lon)['geo_cell'] is None
+
+@pytest.mark.parametrize('center, radius_km', [
+    (SYDNEY, 30),
+    (SYDNEY, 250),
+    ((0.1, 179.9), 80),       # across the antimeridian
+    ((-89.5, 10.0), 150),     # around the pole
+])
+def test_geo_index_finds_exactly_the_points_within_the_radius(center, radius_km):
+    rng = random.Random(radius_km)
+    index = GeoIndex()
+    points = []
+    for number in range(3000):
+        lat = max(-90.0, min(90.0, center[0] + rng.uniform(-4, 4)))
+        lon = (center[1] + rng.uniform(-6, 6) + 180) % 360 - 180
+        index.add(lat, lon, number)
+        points.append((lat, lon, number))
+
+    expected = sorted((haversine_km(*center, lat, lon), number) for lat, lon, number in points
+                      if haversine_km(*center, lat, lon) <= radius_km)
+    found = index.within(*center, radius_km)
+    assert sorted(found) == expected
+    assert [distance for distance, _ in found] == [distance for distance, _ in expected]
+
+def test_cells_within_covers_the_neighbouring_cells():
+    cells = cells_within(*SYDNEY, 1)
+    assert grid_cell(*SYDNEY) in cells
+    assert len(cells) <= 4
+    assert grid_cell(SYDNEY[0] + 0.2, SYDNEY[1]) in cells_within(*SYDNEY, 25)
@@ -0,0 +1,39 @@
+import io
+import zipfile
+import tempfile
+
+from exports import stream_export_zip
+from importer import import_csv_streams, import_zip_stream
+from models import db, Preference, ProductPreference
+
+def _upload(data):
+    """The object Werkzeug hands over for a spooled upload"""
+    stream = tempfile.SpooledTemporaryFile()
+    stream.write(data)
+    stream.seek(0)
+    return stream
+
+def _exported(seed, count):
+    """Export count seeded preferences and empty the tables again; returns the ZIP bytes"""
+    seed(count)
+    data = b''.join(stream_export_zip(Preference.query.order_by(Preference.id), 10))
+    ProductPreference.query.delete()
+    Preference.query.delete()
+    db.session.commit()
+    return data
+
+def test_import_csv_streams_from_spooled_uploads(seed):
+    export = zipfile.ZipFile(io.BytesIO(_exported(seed, 25)))
+
+    result = import_csv_streams(_upload(export.read('users.csv')), _upload(export.read('products.csv')))
+
+    assert result['status'] == 'success', result
+    assert Preference.query.count() == 25
+    assert ProductPreference.query.count() == 75
+
+def test_import_zip_stream_from_spooled_upload(seed):
+    result = import_zip_stream(_upload(_exported(seed, 25)))
+
+    assert result['status'] == 'success', result
+    assert Preference.query.count() == 25
+    assert ProductPreference.query.count() == 75
@@ -0,0 +1,66 @@
+import json
+import signal
+from types import SimpleNamespace
+
+import pytest
+
+from dedup import listing_fingerprint, open_dedup_store
+from ingest import normalize, filter_spam, deduplicate, DedupSaver, save_on_sigterm
+from resellers import ResellerDetector
+
+TITLE = 'iPhone 13 Pro 256GB Sierra Blue unlocked'
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def _listings(*raw):
+    return list(normalize(json.dumps(listing) for listing in raw))
+
+def test_listings_without_id_or_url_are_keyed_by_content_not_position():
+    detector = ResellerDetector(window=86400, post_threshold=20, repost_threshold=5, repost_capacity=1000,
+                                clock=lambda: 0.0)
+    stage = filter_spam(detector)
+    first = _listings({'title': TITLE, 'price': 900, 'location': 'Sydney', 'seller': 'a'})
+    # The same listing later in another stream, e.g. after a restart, is re-seen rather than a repost
+    again = _listings({'title': 'Other iPhone 12', 'price': 300, 'location': 'Perth', 'seller': 'b'},
+                      {'title': TITLE, 'price': 900, 'location': 'Sydney', 'seller': 'a'})
+
+    assert len(list(stage(first))) == 1
+    assert len(list(stage(again))) == 2
+    assert (detector.stats.resightings, detector.stats.reposts) == (1, 0)
+
+def _matches(count):
+    listing = _listings({'title': TITLE, 'price': 900, 'location': 'Sydney'})[0]
+    return [(dict(listing, price=900 + number), [SimpleNamespace(preference_id=1)]) for number in range(count)]
+
+def test_dedup_store_is_saved_every_n_listings_and_every_t_seconds(tmp_path):
+    path = str(tmp_path / 'dedup.npz')
+    clock = FakeClock()
+    store = open_dedup_store(path, 'lru')
+    saver = DedupSaver(store, path, every=3, interval=60, clock=clock)
+
+    assert len(list(deduplicate(store, saver)(_matches(7)))) == 7
+    assert saver.saves == 2
+    assert len(open_dedup_store(path, 'lru')) == 6
+
+    clock.now = 61
+    list(deduplicate(store, saver)(_matches(8)[7:]))
+    assert saver.saves == 3
+    assert len(open_dedup_store(path, 'lru')) == 8
+
+def test_sigterm_saves_the_dedup_store_before_exiting(tmp_path):
+    path = str(tmp_path / 'dedup.npz')
+    store = open_dedup_store(path, 'bloom', capacity=1000)
+    saver = DedupSaver(store, path, every=1000)
+    list(deduplicate(store, saver)(_matches(2)))
+
+    with pytest.raises(SystemExit) as stopped:
+        save_on_sigterm(saver)(signal.SIGTERM, None)
+    assert stopped.value.code == 128 + signal.SIGTERM
+    restored = open_dedup_store(path, 'bloom', capacity=1000)
+    for listing, _ in _matches(2):
+        assert restored.check_and_add(listing_fingerprint(listing['title'], listing['price'], listing['location']), 1)
@@ -0,0 +1,21 @@
+import zipfile
+
+from config import Config
+from jobs import create_job, run_export, _run_job
+from models import db, Job
+
+def test_export_job_spanning_several_batches(app, seed, monkeypatch):
+    monkeypatch.setattr(Config, 'EXPORT_BATCH_SIZE', 10)
+    monkeypatch.setattr(Config, 'EXPORT_WORKERS', 1)
+    seed(60)
+    job_id = create_job('export').id
+
+    # Run on this thread instead of the job pool, so the test can wait for it
+    _run_job(app, job_id, run_export, ())
+
+    job = db.session.get(Job, job_id)
+    assert job.status == 'finished', job.message
+    with zipfile.ZipFile(job.result_path) as export:
+        assert len(export.read('users.csv').decode().splitlines()) == 61
+        assert len(export.read('products.csv').decode().splitlines()) == 181
+    assert job.rows_done >= 60 + 180
@@ -0,0 +1,89 @@
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from matching import MatchIndex, load_match_index, NEAR_GOOD_DEAL_MARGIN
+from models import db, Preference, ProductPreference, IPHONE_MODELS, DEFAULT_PRICES
+
+MODEL = IPHONE_MODELS[0]
+PRICE = DEFAULT_PRICES[MODEL]
+
+def _by_mode(seed):
+    """One Sydney preference per notification mode, each preferring MODEL at PRICE"""
+    modes = ['all', 'only_preferred', 'near_good_deal', 'good_deal', 'unknown_mode']
+    preferences = seed(len(modes), products=1)
+    for preference, mode in zip(preferences, modes):
+        preference.location = ' SYDNEY '
+        preference.notification_mode = mode
+    db.session.commit()
+    return {preference.notification_mode: preference.id for preference in preferences}
+
+def _matched(index, product_name, price, location='sydney'):
+    return [subscriber.preference_id for subscriber in index.match(product_name, price, location)]
+
+def test_each_mode_gets_the_prices_it_asked_for(app, seed):
+    ids = _by_mode(seed)
+    index = load_match_index(10)
+
+    assert _matched(index, MODEL, PRICE) == [ids['all'], ids['good_deal'], ids['near_good_deal'],
+                                             ids['only_preferred']]
+    assert _matched(index, MODEL, PRICE + 1) == [ids['all'], ids['near_good_deal'], ids['only_preferred']]
+    assert _matched(index, MODEL, PRICE + NEAR_GOOD_DEAL_MARGIN) == [ids['all'], ids['near_good_deal'],
+                                                                     ids['only_preferred']]
+    assert _matched(index, MODEL, PRICE + NEAR_GOOD_DEAL_MARGIN + 1) == [ids['all'], ids['only_preferred']]
+    # Models nobody prefers only reach 'all' subscribers, and other locations reach nobody
+    assert _matched(index, IPHONE_MODELS[5], 1) == [ids['all']]
+    assert _matched(index, MODEL, 1, 'Perth') == []
+
+def test_only_preferred_models_count(app, seed):
+    preference, = seed(1, products=2)
+    preference.notification_mode = 'good_deal'
+    preference.products[1].is_preferred = False
+    # A model listed twice keeps its most generous threshold
+    preference.products.append(ProductPreference(product_name=MODEL, max_price=PRICE + 50, is_preferred=True))
+    db.session.commit()
+    index = load_match_index(10)
+
+    assert _matched(index, MODEL, PRICE + 50, preference.location) == [preference.id]
+    assert _matched(index, IPHONE_MODELS[1], 1, preference.location) == []
+
+def test_inactive_and_expired_preferences_are_not_indexed(app, seed):
+    active, paused, expired, expiring_today = seed(4)
+    for preference in (active, paused, expired, expiring_today):
+        preference.location = 'Sydney'
+    paused.activation_status = False
+    expired.expiry_date = date.today() - timedelta(days=1)
+    expiring_today.expiry_date = date.today()
+    db.session.commit()
+
+    assert _matched(load_match_index(10), MODEL, PRICE) == [active.id, expiring_today.id]
+
+def _as_indexed(preference):
+    """A detached copy of what MatchIndex.updated() needs to take a preference out"""
+    products = [SimpleNamespace(product_name=product.product_name, max_price=product.max_price,
+                                is_preferred=product.is_preferred) for product in preference.products]
+    return SimpleNamespace(id=preference.id, location=preference.location,
+                           notification_mode=preference.notification_mode, products=products)
+
+def test_updated_index_equals_a_rebuild(app, seed):
+    _by_mode(seed)
+    seed(6, start=10)
+    preferences = Preference.query.order_by(Preference.id).all()
+    index = MatchIndex.build(preferences)
+
+    changed, removed = preferences[2], preferences[7]
+    old_changed, old_removed = _as_indexed(changed), _as_indexed(removed)
+    changed.notification_mode = 'all'
+    changed.location = 'Melbourne'
+    db.session.delete(removed)
+    db.session.commit()
+    added = seed(1, start=20)
+
+    updated = index.updated([old_changed, old_removed], [changed, *added])
+    rebuilt = MatchIndex.build(Preference.query.order_by(Preference.id).all())
+    for model in IPHONE_MODELS[:4]:
+        for location in ['sydney', 'melbourne']:
+            for price in [1, PRICE, PRICE + 60, PRICE + 200]:
+                assert _matched(updated, model, price, location) == _matched(rebuilt, model, price, location)
+    assert updated.subscriber_count == rebuilt.subscriber_count
+    # The old index is left as it was
+    assert index.subscriber_count == len(preferences)
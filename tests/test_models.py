@@ -0,0 +1,30 @@
+from sqlalchemy import inspect
+
+from models import db, Preference, WordSet, default_word_set_ids
+
+def test_default_word_sets_are_created_at_schema_setup(app):
+    keyword_set_id, excluded_set_id = default_word_set_ids()
+    assert db.session.get(WordSet, keyword_set_id).kind == 'keyword'
+    assert db.session.get(WordSet, excluded_set_id).kind == 'excluded'
+    assert WordSet.query.count() == 2
+
+def test_default_word_set_ids_leaves_the_callers_session_alone(app, seed):
+    loaded, = seed(1)
+    loaded.user_name = 'edited'
+    db.session.add(Preference(location='Perth', notification_mode='all', user_id='2000', user_name='pending'))
+
+    default_word_set_ids()
+
+    assert not inspect(loaded).expired_attributes
+    db.session.rollback()
+    assert Preference.query.filter_by(user_name='pending').count() == 0
+    assert Preference.query.one().user_name == 'user0'
+
+def test_default_word_set_ids_never_commits_sets_it_has_to_add(app):
+    WordSet.query.delete()
+    db.session.commit()
+
+    keyword_set_id, _ = default_word_set_ids()
+    assert db.session.get(WordSet, keyword_set_id) is not None
+    db.session.rollback()
+    assert WordSet.query.count() == 0
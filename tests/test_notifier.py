@@ -0,0 +1,89 @@
+import time
+import asyncio
+
+import pytest
+
+from notifier import (TokenBucket, NotificationDispatcher, RetryAfter, StubTransport, BotApiTransport,
+                      FakeBotApi)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_allows_bursts_then_the_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+    clock.now = 0.5
+    assert bucket.take() == 0.0
+    assert bucket.available_in() == pytest.approx(0.5)
+    # Idle time never saves up more than capacity
+    clock.now = 100
+    assert bucket.is_full()
+    assert [bucket.take() for _ in range(4)][-1] == pytest.approx(0.5)
+
+def test_drains_add_up_but_pauses_do_not():
+    clock = FakeClock()
+    drained, paused = TokenBucket(rate=10, clock=clock), TokenBucket(rate=10, clock=clock)
+    for _ in range(2):
+        drained.drain(3)
+        paused.pause(3)
+    assert drained.available_in() == pytest.approx(6.1)
+    assert paused.available_in() == pytest.approx(3)
+    clock.now = 3
+    assert paused.take() == 0.0
+
+class RateLimitedOnce(StubTransport):
+    """Answers the first send to chat_id with a 429 and records when it did"""
+
+    def __init__(self, chat_id, retry_after):
+        super().__init__()
+        self.chat_id = chat_id
+        self.retry_after = retry_after
+        self.limited_at = None
+
+    async def send(self, chat_id, message, **options):
+        if chat_id == self.chat_id and self.limited_at is None:
+            self.limited_at = time.monotonic()
+            raise RetryAfter(self.retry_after)
+        await super().send(chat_id, message, **options)
+
+def test_a_429_pauses_every_chat_for_retry_after():
+    transport = RateLimitedOnce('a', retry_after=0.3)
+    dispatcher = NotificationDispatcher(transport, global_rate=1000, chat_rate=1000, max_in_flight=1)
+    jobs = [('a', 'first'), ('b', 'second'), ('c', 'third'), ('a', 'fourth')]
+    stats = asyncio.run(dispatcher.dispatch(jobs))
+
+    assert (stats.sent, stats.rate_limited, stats.failed) == (4, 1, 0)
+    assert [message for _, chat_id, message, _ in transport.sent if chat_id == 'a'] == ['first', 'fourth']
+    assert min(sent_at for sent_at, *_ in transport.sent) >= transport.limited_at + 0.29
+
+def test_each_chat_is_paced_and_kept_in_order():
+    transport = StubTransport()
+    dispatcher = NotificationDispatcher(transport, global_rate=1000, chat_rate=20)
+    jobs = [(chat_id, f'{chat_id}{number}') for number in range(5) for chat_id in 'ab']
+    assert asyncio.run(dispatcher.dispatch(jobs)).sent == 10
+
+    for chat_id in 'ab':
+        sent = [(sent_at, message) for sent_at, chat, message, _ in transport.sent if chat == chat_id]
+        assert [message for _, message in sent] == [f'{chat_id}{number}' for number in range(5)]
+        assert min(later - earlier for (earlier, _), (later, _) in zip(sent, sent[1:])) >= 0.045
+
+def test_bot_api_429s_are_retried_after_the_wait():
+    with FakeBotApi(global_rate=30, chat_rate=2) as api:
+        transport = BotApiTransport('token', api.url, max_in_flight=4)
+        try:
+            # Faster than the API allows, so the second message gets a 429 with retry_after 1
+            dispatcher = NotificationDispatcher(transport, global_rate=30, chat_rate=50, max_in_flight=4)
+            stats = asyncio.run(dispatcher.dispatch([('42', 'one'), ('42', 'two')]))
+        finally:
+            transport.close()
+
+    assert (stats.sent, stats.failed) == (2, 0)
+    assert stats.rate_limited == api.rejected >= 1
+    assert len(api.accepted) == 2
+    assert api.min_chat_interval() >= 0.9
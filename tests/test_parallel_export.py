@@ -0,0 +1,36 @@
+import io
+import zipfile
+
+import pytest
+
+import parallel_export
+from exports import stream_export_zip
+from models import db, Preference
+from parallel_export import stream_full_export_zip
+
+def _drain(chunks):
+    return b''.join(chunks)
+
+def test_sharded_export_counts_rows_not_newlines(app, seed):
+    preferences = seed(12)
+    preferences[3].user_name = 'two\nlines'
+    preferences[7].location = 'Sydney\r\nCBD'
+    db.session.commit()
+
+    done = []
+    sharded = _drain(stream_full_export_zip(100, 5, 2, progress=done.append, min_rows=0))
+    serial_done = []
+    serial = zipfile.ZipFile(io.BytesIO(_drain(stream_export_zip(Preference.query, 100, progress=serial_done.append))))
+
+    assert done[-1] == serial_done[-1]
+    for name in serial.namelist():
+        assert zipfile.ZipFile(io.BytesIO(sharded)).read(name) == serial.read(name)
+
+def test_small_exports_stay_serial(app, seed, monkeypatch):
+    seed(5)
+
+    def no_pool(workers):
+        pytest.fail("a small export started the process pool")
+    monkeypatch.setattr(parallel_export, 'export_pool', no_pool)
+
+    _drain(stream_full_export_zip(100, 5, 2, min_rows=6))
@@ -0,0 +1,40 @@
+from resellers import ResellerDetector
+
+TITLE = 'iPhone 13 Pro 256GB Sierra Blue unlocked'
+DESCRIPTION = 'Always in a case, battery health 91 percent, box and cable included. Pickup only.'
+
+def _detector():
+    return ResellerDetector(window=86400, post_threshold=20, repost_threshold=5, repost_capacity=1000,
+                            clock=lambda: 0.0)
+
+def test_rescraped_listing_does_not_flag_its_seller():
+    detector = _detector()
+
+    for _ in range(30):
+        original, is_reseller = detector.check('listing-1', TITLE, DESCRIPTION, 'Sydney', 900, 'honest')
+        assert original is None
+        assert not is_reseller
+
+    assert detector.stats.reposts == 0
+    assert detector.stats.resightings == 29
+    assert 'honest' not in detector.flagged
+
+def test_reposts_under_new_keys_flag_the_seller():
+    detector = _detector()
+
+    verdicts = [detector.check(f'listing-{number}', TITLE if number % 2 else TITLE.upper() + ' !!',
+                               DESCRIPTION, 'Sydney', 900, 'reposter')
+                for number in range(6)]
+
+    assert [original for original, _ in verdicts] == [None] + ['listing-0'] * 5
+    assert [is_reseller for _, is_reseller in verdicts] == [False] * 5 + [True]
+    assert 'reposter' in detector.flagged
+
+def test_rescraped_repost_keeps_its_verdict_without_counting_again():
+    detector = _detector()
+    detector.check('listing-1', TITLE, DESCRIPTION, 'Sydney', 900, 'seller')
+    detector.check('listing-2', TITLE.upper(), DESCRIPTION, 'Sydney', 900, 'seller')
+
+    for _ in range(10):
+        assert detector.check('listing-2', TITLE.upper(), DESCRIPTION, 'Sydney', 900, 'seller') == ('listing-1', False)
+    assert detector.stats.reposts == 1
@@ -0,0 +1,48 @@
+import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects import postgresql
+
+from models import db, User, Preference
+from schema import add_column_statement, ensure_schema
+
+def test_added_columns_are_quoted_for_the_dialect():
+    statement = add_column_statement(User.__table__, User.__table__.c.password_hash, postgresql.dialect())
+    assert statement == 'ALTER TABLE "user" ADD COLUMN password_hash VARCHAR(128)'
+
+def test_added_columns_keep_their_foreign_keys(app):
+    db.drop_all()
+    with db.engine.begin() as conn:
+        conn.execute(text('CREATE TABLE user (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR(64))'))
+        conn.execute(text('CREATE TABLE preference (id INTEGER NOT NULL PRIMARY KEY, user_id VARCHAR(50))'))
+
+    ensure_schema()
+
+    inspector = inspect(db.engine)
+    assert {column['name'] for column in inspector.get_columns('user')} == set(User.__table__.columns.keys())
+    assert {column['name'] for column in inspector.get_columns('preference')} == set(
+        Preference.__table__.columns.keys())
+    foreign_keys = {tuple(key['constrained_columns']): (key['referred_table'], key['referred_columns'])
+                    for key in inspector.get_foreign_keys('preference')}
+    assert foreign_keys[('keyword_set_id',)] == ('word_set', ['id'])
+    assert foreign_keys[('excluded_set_id',)] == ('word_set', ['id'])
+
+def test_adding_the_geo_columns_backfills_existing_rows(app):
+    db.drop_all()
+    updated_at = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    with db.engine.begin() as conn:
+        conn.execute(text('CREATE TABLE preference (id INTEGER NOT NULL PRIMARY KEY, location VARCHAR(100), '
+                          'suburb VARCHAR(100), fixed_lat VARCHAR(20), fixed_lon VARCHAR(20), updated_at DATETIME)'))
+        conn.execute(text("INSERT INTO preference (id, location, updated_at) VALUES (1, 'Sydney', :updated_at)"),
+                      {'updated_at': updated_at})
+        conn.execute(text("INSERT INTO preference (id, location, fixed_lat, fixed_lon) VALUES (2, 'x', '-37.8', '145')"))
+
+    ensure_schema()
+
+    sydney, fixed = db.session.execute(
+        db.select(Preference.latitude, Preference.longitude, Preference.geo_cell, Preference.updated_at)
+        .order_by(Preference.id)
+    ).all()
+    assert sydney.latitude == -33.8688 and sydney.longitude == 151.2093 and sydney.geo_cell
+    assert sydney.updated_at == updated_at
+    assert (fixed.latitude, fixed.longitude) == (-37.8, 145.0)
@@ -0,0 +1,61 @@
+from datetime import date, timedelta
+
+import pytest
+
+from exports import iter_preferences
+from matching import load_match_index, active_preferences_query, IdMatchIndex
+from models import db, IPHONE_MODELS, DEFAULT_PRICES
+from sharded_matching import ShardedMatcher, match_ids, split_ids
+from subscriber_index import write_subscriber_index, MappedSubscriberIndex
+
+# Spellings SQL lower(trim()) and normalize_location() disagree on
+LOCATIONS = [' Sydney\t', 'sydney', 'Sydney\n', 'ÉVORA', 'évora ', 'Melbourne', 'MELBOURNE']
+MODES = ['all', 'only_preferred', 'near_good_deal', 'good_deal']
+
+@pytest.fixture
+def subscribers(app, seed):
+    preferences = seed(28, products=4)
+    for number, preference in enumerate(preferences):
+        preference.location = LOCATIONS[number % len(LOCATIONS)]
+        preference.notification_mode = MODES[number % len(MODES)]
+    preferences[5].expiry_date = date.today() - timedelta(days=1)
+    preferences[9].activation_status = False
+    db.session.commit()
+    return preferences
+
+def _burst():
+    return [(model, DEFAULT_PRICES[model] + offset, location)
+            for model in IPHONE_MODELS[:5]
+            for offset in (-100, 0, 100, 101)
+            for location in ['sydney', ' SYDNEY ', 'évora', 'ÉVORA', 'melbourne', 'Perth']]
+
+def _expected(burst):
+    index = load_match_index(10)
+    return [[subscriber.preference_id for subscriber in index.match(*listing)] for listing in burst]
+
+def test_sharded_matching_routes_like_normalize_location(subscribers):
+    burst = _burst()
+    with ShardedMatcher(3) as sharded:
+        assert sharded.locations == ['melbourne', 'sydney', 'évora']
+        assert [list(ids) for ids in sharded.match_batch(burst)] == _expected(burst)
+
+def test_id_match_index_matches_like_match_index(subscribers):
+    burst = _burst()
+    ends, ids = match_ids(IdMatchIndex(load_match_index(10)), burst)
+    assert [list(recipients) for recipients in split_ids(ends, ids)] == _expected(burst)
+
+def test_index_file_shards_read_only_their_locations(subscribers, tmp_path):
+    path = str(tmp_path / 'subscribers.idx')
+    write_subscriber_index(path, iter_preferences(active_preferences_query(), 10))
+
+    mapped = MappedSubscriberIndex.open(path)
+    sydney = list(mapped.preferences(['sydney']))
+    assert {preference.location for preference in sydney} == {'sydney'}
+    assert [preference.id for preference in sydney] == sorted(
+        preference.id for preference in subscribers
+        if preference.location.strip().lower() == 'sydney' and preference.activation_status is not False
+    )
+
+    burst = _burst()
+    with ShardedMatcher(3, index_path=path) as sharded:
+        assert [list(ids) for ids in sharded.match_batch(burst)] == _expected(burst)
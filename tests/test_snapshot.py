@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+from matching import MatchIndex, load_match_index
+from models import db, Preference, ProductPreference, IPHONE_MODELS, DEFAULT_PRICES
+from snapshot import SnapshotStore
+
+def _contents(index):
+    """Comparable view of a MatchIndex: subscriber ids per list, with the price thresholds"""
+    return (
+        index.subscriber_count,
+        {location: [subscriber.preference_id for subscriber in subscribers]
+         for location, subscribers in index._everything.items() if subscribers},
+        {key: (list(thresholds), [subscriber.preference_id for subscriber in subscribers])
+         for key, (thresholds, subscribers) in index._by_product.items()},
+    )
+
+def _no_full_builds(monkeypatch):
+    def build(cls, preferences):
+        raise AssertionError("refresh rebuilt the whole MatchIndex")
+    monkeypatch.setattr(MatchIndex, 'build', classmethod(build))
+
+def test_refresh_updates_the_match_index_in_place_of_a_rebuild(app, seed, monkeypatch):
+    preferences = seed(40)
+    modes = ['all', 'only_preferred', 'near_good_deal', 'good_deal']
+    for number, preference in enumerate(preferences):
+        preference.notification_mode = modes[number % 4]
+    db.session.commit()
+    # Old enough that refreshes don't send them again (DELTA_EXPORT_LAG)
+    db.session.execute(update(Preference).values(updated_at=datetime.utcnow() - timedelta(hours=1)))
+    db.session.commit()
+
+    store = SnapshotStore(batch_size=7)
+    store.load()
+    before = store.current
+    assert _contents(before.match_index()) == _contents(load_match_index(7))
+
+    # Edits that move subscribers between lists, a deletion, a deactivation and a new preference
+    preferences[1].notification_mode = 'all'
+    preferences[2].location = 'Brisbane'
+    preferences[3].products[0].max_price += 50
+    preferences[4].products[1].is_preferred = False
+    preferences[5].activation_status = False
+    for preference in preferences[3:5]:
+        preference.user_name += ' (edited)'
+    db.session.delete(preferences[6])
+    added = Preference(location='Sydney', notification_mode='good_deal', user_id='9999', user_name='new')
+    added.products = [ProductPreference(product_name=IPHONE_MODELS[0], max_price=DEFAULT_PRICES[IPHONE_MODELS[0]],
+                                        is_preferred=True)]
+    db.session.add(added)
+    db.session.commit()
+
+    _no_full_builds(monkeypatch)
+    assert store.refresh() == (5, 2)
+    refreshed = store.current.match_index()
+    monkeypatch.undo()
+
+    assert _contents(refreshed) == _contents(load_match_index(7))
+    # Readers of the old snapshot keep seeing the old index
+    assert _contents(before.match_index()) != _contents(store.current.match_index())
+    assert before.match_index().match(IPHONE_MODELS[0], 1, 'brisbane') == []
+
+@pytest.mark.parametrize('modes', [['all'], ['good_deal']])
+def test_deleting_the_last_subscriber_of_a_list_drops_the_list(app, seed, modes):
+    preference, = seed(1)
+    preference.notification_mode = modes[0]
+    db.session.commit()
+    store = SnapshotStore(batch_size=10)
+    store.load()
+
+    db.session.delete(preference)
+    db.session.commit()
+    store.refresh()
+
+    assert _contents(store.current.match_index()) == (0, {}, {})
@@ -0,0 +1,85 @@
+from datetime import date, timedelta
+
+import pytest
+
+from exports import iter_preferences
+from matching import load_match_index, active_preferences_query
+from models import db, Preference, WordSet, IPHONE_MODELS, DEFAULT_PRICES
+from subscriber_index import write_subscriber_index, MappedSubscriberIndex
+
+MODES = ['all', 'only_preferred', 'near_good_deal', 'good_deal', 'unknown_mode']
+LOCATIONS = ['Sydney', ' melbourne', 'Évora', 'Perth ']
+LISTINGS = [(model, DEFAULT_PRICES.get(model, 100) + offset, location)
+            for model in IPHONE_MODELS[:6] + ['Nokia 3310']
+            for offset in (-1, 0, 1, 100, 101)
+            for location in ['sydney', 'MELBOURNE', 'évora', 'perth', 'hobart']]
+
+def _fields(subscriber):
+    return (subscriber.preference_id, subscriber.unique_userid, subscriber.user_id, subscriber.user_name,
+            subscriber.notification_mode, subscriber.keyword_set_id, subscriber.excluded_set_id)
+
+@pytest.fixture
+def subscribers(app, seed):
+    pro = WordSet.get_or_create('keyword', ['pro'])
+    preferences = seed(40, products=5)
+    for number, preference in enumerate(preferences):
+        preference.notification_mode = MODES[number % len(MODES)]
+        preference.location = LOCATIONS[number % len(LOCATIONS)]
+        preference.products[number % 5].is_preferred = False
+        preference.products[(number + 1) % 5].max_price += number
+    preferences[15].user_name = None
+    preferences[10].user_id = None
+    preferences[20].user_name = 'Zoë 🙂'
+    preferences[6].keyword_set_id = pro.id
+    preferences[7].expiry_date = date.today() + timedelta(days=1)
+    db.session.commit()
+    return preferences
+
+def _write(path):
+    return write_subscriber_index(str(path), iter_preferences(active_preferences_query(), 7))
+
+def test_mapped_index_matches_like_the_match_index(subscribers, tmp_path):
+    path = tmp_path / 'subscribers.idx'
+    assert _write(path) == 40
+
+    mapped = MappedSubscriberIndex.open(str(path))
+    index = load_match_index(7)
+    assert mapped.subscriber_count == index.subscriber_count
+    for listing in LISTINGS:
+        expected = index.match(*listing)
+        assert [_fields(subscriber) for subscriber in mapped.match(*listing)] == [_fields(s) for s in expected]
+        assert mapped.match_ids(*listing) == [subscriber.preference_id for subscriber in expected]
+
+def test_expired_rows_drop_out_when_their_day_passes(subscribers, tmp_path):
+    path = tmp_path / 'subscribers.idx'
+    _write(path)
+    expiring = subscribers[7]
+
+    listing = (IPHONE_MODELS[0], 1, expiring.location)
+    assert expiring.id in MappedSubscriberIndex.open(str(path)).match_ids(*listing)
+    later = MappedSubscriberIndex.open(str(path), today=date.today() + timedelta(days=2))
+    assert expiring.id not in later.match_ids(*listing)
+
+def test_rewriting_leaves_open_mappings_alone(subscribers, tmp_path):
+    path = tmp_path / 'subscribers.idx'
+    _write(path)
+    old = MappedSubscriberIndex.open(str(path))
+    listing = (IPHONE_MODELS[0], 1, 'sydney')
+    before = old.match_ids(*listing)
+
+    Preference.query.filter(Preference.id == before[0]).delete()
+    db.session.commit()
+    _write(path)
+
+    assert old.match_ids(*listing) == before
+    assert MappedSubscriberIndex.open(str(path)).match_ids(*listing) == before[1:]
+
+def test_empty_and_foreign_files(app, tmp_path):
+    path = tmp_path / 'empty.idx'
+    assert write_subscriber_index(str(path), []) == 0
+    assert MappedSubscriberIndex.open(str(path)).match(IPHONE_MODELS[0], 1, 'sydney') == []
+
+    other = tmp_path / 'other.idx'
+    other.write_bytes(b'not an index at all' * 10)
+    with pytest.raises(ValueError):
+        MappedSubscriberIndex.open(str(other))
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+from urllib.parse import urlsplit
+
+from notifier import StubTransport
+from webhook_bot import WebhookBot
+
+def _sent_link(app, text):
+    bot = WebhookBot(app, StubTransport()).start()
+    try:
+        bot.submit({'update_id': 1, 'message': {'text': text, 'chat': {'id': 7},
+                                                'from': {'id': 42, 'first_name': 'Ann', 'last_name': 'Lee'}}})
+        assert bot.wait_idle(5)
+    finally:
+        bot.stop()
+    (_, chat_id, _, options), = bot.transport.sent
+    assert chat_id == 7
+    return options['reply_markup']['inline_keyboard'][0][0]['url']
+
+def test_links_are_signed_with_the_app_config(app):
+    app.config.update(SECRET_KEY='app-secret', WEBAPP_URL='https://flippers.example')
+    for command in ('/start', '/check'):
+        link = urlsplit(_sent_link(app, command))
+        assert f'{link.scheme}://{link.netloc}' == 'https://flippers.example'
+
+        response = app.test_client().get(f'{link.path}?{link.query}')
+        assert response.status_code == 200, response.headers.get('Location')
+
+def test_importing_the_webhook_bot_leaves_the_polling_bot_alone():
+    check = "import logging, sys, webhook_bot; sys.exit(int('telegram_bot' in sys.modules or bool(logging.root.handlers)))"
+    assert subprocess.run([sys.executable, '-c', check]).returncode == 0
@@ -0,0 +1,50 @@
+import word_filters
+from matching import Subscriber
+from models import db, WordSet, default_word_set_ids
+from word_filters import load_word_filters
+
+def _subscriber(number, keyword_set_id=None, excluded_set_id=None):
+    return Subscriber(number, f'user{number}', str(number), f'user{number}', 'all', keyword_set_id, excluded_set_id)
+
+def _ids(subscribers):
+    return [subscriber.preference_id for subscriber in subscribers]
+
+def test_subscribers_with_the_same_word_sets_share_one_filter(app, monkeypatch):
+    compiled = []
+    real_classifier = word_filters.TitleClassifier
+
+    def counting_classifier(*args):
+        compiled.append(args)
+        return real_classifier(*args)
+    monkeypatch.setattr(word_filters, 'TitleClassifier', counting_classifier)
+
+    keyword_set_id, excluded_set_id = default_word_set_ids()
+    pro = WordSet.get_or_create('keyword', ['pro', 'max'])
+    db.session.commit()
+    bank = load_word_filters()
+    # None means the default set, so those subscribers share the defaults' filter
+    recipients = ([_subscriber(number) for number in range(500)]
+                  + [_subscriber(number, keyword_set_id, excluded_set_id) for number in range(500, 1000)]
+                  + [_subscriber(number, pro.id) for number in range(1000, 1500)])
+
+    for title in ['iPhone 15 Pro', 'iPhone 15', 'Charger for iPhone 15 Pro']:
+        bank.filter_recipients(title, recipients)
+    assert len(compiled) == 2
+
+def test_keywords_are_required_and_excluded_words_reject(app):
+    pro = WordSet.get_or_create('keyword', ['pro', 'max'])
+    no_keywords = WordSet.get_or_create('keyword', [])
+    cracked = WordSet.get_or_create('excluded', ['cracked'])
+    db.session.commit()
+    bank = load_word_filters()
+    defaults = _subscriber(1)
+    pro_only = _subscriber(2, pro.id)
+    anything_uncracked = _subscriber(3, no_keywords.id, cracked.id)
+    recipients = [pro_only, anything_uncracked, defaults]
+
+    assert _ids(bank.filter_recipients('iPhone 15 Pro', recipients)) == [2, 3, 1]
+    assert _ids(bank.filter_recipients('Phone 15 Pro', recipients)) == [2, 3]
+    assert _ids(bank.filter_recipients('iPhone 15', recipients)) == [3, 1]
+    assert _ids(bank.filter_recipients('Cracked iPhone 15 Max', recipients)) == [2, 1]
+    # The default excluded words still apply to sets that only change the keywords
+    assert _ids(bank.filter_recipients('Stand for iPhone 15 Pro', recipients)) == [3]
@@ -0,0 +1,223 @@
+import html
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+from config import Config
+from models import Preference
+from notifier import BotApiTransport, TokenBucket, NotificationError, TemporaryError, RetryAfter
+from telegram_auth import generate_secure_link
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+HELP_TEXT = (
+    "iPhone Flippers Bot Help:\n\n"
+    "/start - Get access to your iPhone preferences\n"
+    "/check - Check your current preferences\n"
+    "/help - Show this help message"
+)
+
+def display_name(user):
+    """The name signed into preference links, as telegram_bot.py does: first name, plus last name if set"""
+    first_name = user.get('first_name', '')
+    return f"{first_name} {user['last_name']}" if user.get('last_name') else first_name
+
+def parse_command(text):
+    """'start' for '/start' or '/start@SomeBot args'; None if the text isn't a command"""
+    if not text or not text.startswith('/'):
+        return None
+    return text.split()[0][1:].split('@')[0].lower() or None
+
+def link_keyboard(label, url):
+    return {'inline_keyboard': [[{'text': label, 'url': url}]]}
+
+async def start(bot, message):
+    """Send a message when the command /start is issued."""
+    user = message['from']
+    user_name = display_name(user)
+    logger.info(f"Start command from user: {user['id']} ({user_name})")
+
+    mention = f'<a href="tg://user?id={user["id"]}">{html.escape(user_name)}</a>'
+    link = generate_secure_link(bot.app.config, user['id'], user_name)
+    await bot.reply(
+        message['chat']['id'],
+        f"Hi {mention}! Welcome to iPhone Flippers bot.\n\n"
+        f"Click the button below to access your iPhone preferences form:",
+        parse_mode='HTML',
+        reply_markup=link_keyboard("🔒 Manage iPhone Preferences", link)
+    )
+
+def preference_summary(user_id):
+    """One line describing a Telegram user's saved preferences, or None if they have none"""
+    preference = Preference.query.filter_by(user_id=str(user_id)).first()
+    if preference is None:
+        return None
+    status = 'on' if preference.activation_status else 'paused'
+    place = ', '.join(part.strip() for part in (preference.suburb, preference.location) if part and part.strip())
+    return f"Alerts are {status} for {len(preference.products)} models around {place} ({preference.notification_mode})."
+
+async def check_preferences(bot, message):
+    """Summarise the user's current preferences, with a link to change them"""
+    user = message['from']
+    user_name = display_name(user)
+    logger.info(f"Check preferences command from user: {user['id']} ({user_name})")
+
+    summary = await bot.run_in_app(preference_summary, user['id'])
+    text = summary or "You haven't set any preferences yet."
+    link = generate_secure_link(bot.app.config, user['id'], user_name)
+    await bot.reply(
+        message['chat']['id'],
+        f"{text}\n\nClick the button below to view or update your iPhone preferences:",
+        reply_markup=link_keyboard("🔒 View/Update Preferences", link)
+    )
+
+async def help_command(bot, message):
+    """Send a message when the command /help is issued."""
+    await bot.reply(message['chat']['id'], HELP_TEXT)
+
+COMMANDS = {'start': start, 'help': help_command, 'check': check_preferences}
+
+class WebhookStats:
+    def __init__(self):
+        self.received = 0
+        self.duplicates = 0
+        self.handled = 0
+        self.failed = 0
+        self.replies = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+class WebhookBot:
+    """Asyncio Telegram bot fed with updates from the Flask webhook route.
+
+    The bot runs its own event loop on a background thread of the web
+    worker. submit() only schedules an update, so the route answers
+    Telegram at once. Updates are handled concurrently on the loop, up to
+    max_concurrency at a time. Database lookups run on the loop's thread
+    pool inside the Flask app context, and replies go through a notifier
+    transport behind the same global rate limit the notifier uses. Telegram
+    redelivers updates it got no answer for, so recently seen update_ids
+    are skipped.
+    """
+
+    def __init__(self, app, transport, max_concurrency=None, global_rate=None, max_retries=None,
+                 recent_updates=10000):
+        self.app = app
+        self.transport = transport
+        self.max_concurrency = max_concurrency or Config.WEBHOOK_MAX_CONCURRENCY
+        self.max_retries = Config.NOTIFY_MAX_RETRIES if max_retries is None else max_retries
+        self.global_bucket = TokenBucket(global_rate or Config.NOTIFY_GLOBAL_RATE)
+        self.recent_updates = recent_updates
+        self.stats = WebhookStats()
+        self._seen = OrderedDict()      # recent update_ids, oldest first
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name='webhook-bot', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def _run_loop(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        # Created on the loop's own thread, where it will be used
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+        if isinstance(self.transport, BotApiTransport):
+            self.transport.close()
+
+    def submit(self, update):
+        """Schedule one Update (decoded JSON) for handling; False if it was already seen"""
+        with self._idle:
+            self.stats.received += 1
+            update_id = update.get('update_id')
+            if update_id in self._seen:
+                self.stats.duplicates += 1
+                return False
+            self._seen[update_id] = True
+            if len(self._seen) > self.recent_updates:
+                self._seen.popitem(last=False)
+            self._pending += 1
+        asyncio.run_coroutine_threadsafe(self._handle(update), self._loop)
+        return True
+
+    def wait_idle(self, timeout=None):
+        """Block until every submitted update has been handled; False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    async def _handle(self, update):
+        try:
+            async with self._slots:
+                message = update.get('message') or update.get('edited_message')
+                handler = COMMANDS.get(parse_command(message.get('text'))) if message else None
+                if handler is not None:
+                    await handler(self, message)
+            self.stats.handled += 1
+        except Exception:
+            self.stats.failed += 1
+            logger.exception(f"Error handling update {update.get('update_id')}")
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    async def run_in_app(self, function, *args):
+        """Run a blocking function (e.g. a database query) on the loop's thread pool, in the app context"""
+        def call():
+            with self.app.app_context():
+                return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    async def reply(self, chat_id, text, **options):
+        """Send a message, retrying 429s and temporary errors like the notifier does"""
+        for attempt in range(self.max_retries + 1):
+            await self.global_bucket.acquire()
+            try:
+                await self.transport.send(chat_id, text, **options)
+                self.stats.replies += 1
+                return True
+            except RetryAfter as error:
+                backoff = error.seconds
+            except TemporaryError as error:
+                backoff = min(30, 2 ** attempt)
+                logger.warning(f"Reply to {chat_id} failed ({error}), retrying in {backoff}s")
+            except NotificationError as error:
+                logger.warning(f"Reply to {chat_id} dropped: {error}")
+                return False
+            if attempt < self.max_retries:
+                await asyncio.sleep(backoff)
+        logger.warning(f"Reply to {chat_id} dropped after {self.max_retries} retries")
+        return False
+
+_bot_lock = threading.Lock()
+
+def get_webhook_bot(app, transport=None):
+    """The app's running WebhookBot, started on first use in each worker process.
+
+    transport defaults to the Bot API at TELEGRAM_API_URL; pass one (e.g. a
+    StubTransport) before the first update to record replies instead.
+    """
+    with _bot_lock:
+        bot = app.extensions.get('webhook_bot')
+        if bot is None:
+            if transport is None:
+                transport = BotApiTransport(app.config['TELEGRAM_BOT_TOKEN'], app.config['TELEGRAM_API_URL'])
+            bot = app.extensions['webhook_bot'] = WebhookBot(app, transport).start()
+        return bot
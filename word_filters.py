@@ -0,0 +1,63 @@
+import logging
+
+from models import WordSet, default_word_set_ids
+from classifier import TitleClassifier, tokenize
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class WordFilterBank:
+    """Keyword/excluded-word filters shared by every subscriber with the same word sets.
+
+    Subscribers are grouped by (keyword_set_id, excluded_set_id) and one
+    TitleClassifier automaton is compiled per distinct pair, so a listing
+    title is tokenized once and evaluated once per pair in use, however many
+    subscribers share it. A title passes a pair's filter when it contains one
+    of the keywords (or the keyword set is empty) and none of the excluded
+    words.
+    """
+
+    def __init__(self, word_sets, default_set_ids):
+        self._words = {word_set.id: word_set.word_list for word_set in word_sets}
+        self._default_set_ids = default_set_ids
+        self._filters = {}
+
+    def key(self, subscriber):
+        """The (keyword set id, excluded set id) pair a subscriber filters with"""
+        return (subscriber.keyword_set_id or self._default_set_ids[0],
+                subscriber.excluded_set_id or self._default_set_ids[1])
+
+    def _filter(self, key):
+        if key not in self._filters:
+            keyword_set_id, excluded_set_id = key
+            keywords = self._words.get(keyword_set_id, [])
+            self._filters[key] = (TitleClassifier(keywords, self._words.get(excluded_set_id, [])), bool(keywords))
+        return self._filters[key]
+
+    def passes(self, key, tokens):
+        """Whether a tokenized title gets through one word set pair"""
+        classifier, needs_keyword = self._filter(key)
+        keyword, excluded_word = classifier.scan_tokens(tokens)
+        if excluded_word is not None:
+            return False
+        return keyword is not None or not needs_keyword
+
+    def filter_recipients(self, title, recipients):
+        """Keep the recipients whose word sets let the title through, in their original order"""
+        tokens = tokenize(title)
+        verdicts = {}
+        kept = []
+        for subscriber in recipients:
+            key = self.key(subscriber)
+            if key not in verdicts:
+                verdicts[key] = self.passes(key, tokens)
+            if verdicts[key]:
+                kept.append(subscriber)
+        return kept
+
+def load_word_filters():
+    """Build a WordFilterBank over every stored word set"""
+    default_set_ids = default_word_set_ids()
+    word_sets = WordSet.query.all()
+    logger.info(f"Loaded {len(word_sets)} word sets for filtering")
+    return WordFilterBank(word_sets, default_set_ids)